@@ -0,0 +1,650 @@
+"""
+قياس أداء خط المعالجة دون اتصال بالإنترنت
+
+يشغل معالجات البوت الحقيقية (handle_photo_message وطابور الاستخراج و OUTBOX)
+مقابل خوادم وهمية محلية تحاكي Bot API وتحميل الملفات و Gemini و OCR.space،
+مع زمن استجابة ونسبة أخطاء قابلة للضبط، ثم يعرض عدد الرسائل في الثانية
+وزمن الاستجابة الكامل (p50 / p99) واستهلاك الذاكرة.
+
+أمثلة:
+    python benchmark.py --messages 200 --concurrency 20
+    python benchmark.py --engine ocr --engine-latency 1500 --engine-errors 0.05
+    python benchmark.py --mode engine --messages 100 --concurrency 8
+    python benchmark.py --telegram-429 0.02 --json results.json
+    python benchmark.py --mode text --messages 2000 --lines-per-page 40
+
+متغيرات البيئة الخاصة بالبوت (EXTRACTION_WORKERS، OUTGOING_RATE، ...) تُحترم كما هي.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+BENCH_TOKEN = '123456:BENCHMARK'
+BENCH_USER_BASE = 10_000_000
+# بدايات الرسائل النهائية الفاشلة (أخطاء الاستخراج، انتهاء المهلة، امتلاء الطابور)
+FAILURE_PREFIXES = ('❌', '⏱️ **انتهت مهلة', '⏳ **الخادم مشغول')
+
+# ============= نموذج زمن الاستجابة والأخطاء =============
+class LatencyModel:
+    """زمن استجابة عشوائي (بالمللي ثانية) ونسبة أخطاء لخادم وهمي"""
+
+    def __init__(self, mean_ms, distribution='exp', error_rate=0.0):
+        self.mean = mean_ms / 1000
+        self.distribution = distribution
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.mean <= 0:
+            return 0.0
+        if self.distribution == 'fixed':
+            return self.mean
+        if self.distribution == 'uniform':
+            return random.uniform(0, 2 * self.mean)
+        if self.distribution == 'lognormal':
+            # ذيل طويل بنفس المتوسط (sigma = 0.8)
+            sigma = 0.8
+            return random.lognormvariate(math.log(self.mean) - sigma ** 2 / 2, sigma)
+        return random.expovariate(1 / self.mean)
+
+    def wait(self):
+        time.sleep(self.delay())
+
+    def should_fail(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+# ============= الخوادم الوهمية =============
+def build_sample_image(width=1280, height=960):
+    """صورة بطاقة تجريبية (JPEG) بخطوط نصية مزيفة"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height), (235, 232, 225))
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(42)
+    for row in range(12):
+        y = 80 + row * 65
+        x = 60
+        while x < width - 120:
+            word = rng.randint(40, 140)
+            draw.rectangle((x, y, x + word, y + 28), fill=(40, 40, 50))
+            x += word + rng.randint(15, 35)
+
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=85)
+    return output.getvalue()
+
+GEMINI_JSON_TEXT = json.dumps({
+    'name': 'محمد أحمد علي',
+    'document_number': 'A1234567',
+    'dates': [{'label': 'تاريخ الميلاد', 'value': '1990-01-01'}],
+    'mrz': [],
+    'arabic_texts': ['الجمهورية اليمنية', 'بطاقة شخصية', 'الاسم: محمد أحمد علي'],
+    'english_texts': ['REPUBLIC OF YEMEN', 'ID CARD']
+}, ensure_ascii=False)
+
+GEMINI_LINES_TEXT = (
+    "الاسم الكامل: محمد أحمد علي\n"
+    "النصوص العربية:\n"
+    "الجمهورية اليمنية\n"
+    "بطاقة شخصية\n"
+    "النصوص الإنجليزية:\n"
+    "REPUBLIC OF YEMEN\n"
+    "ID CARD"
+)
+
+OCR_TEXT = "الجمهورية اليمنية\nالاسم: محمد أحمد علي\nREPUBLIC OF YEMEN\nID CARD"
+
+class StubState:
+    """حالة الخوادم الوهمية: عدادات الطلبات وتتبع اكتمال كل محادثة"""
+
+    def __init__(self, args, image_bytes):
+        self.telegram = LatencyModel(args.telegram_latency, args.latency_dist, args.telegram_429)
+        self.download = LatencyModel(args.download_latency, args.latency_dist)
+        self.engine = LatencyModel(args.engine_latency, args.latency_dist, args.engine_errors)
+        self.image_bytes = image_bytes
+        self.requests = {}
+        self.on_done = None
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def done(self, chat_id, ok):
+        if self.on_done is not None:
+            self.on_done(chat_id, ok)
+
+class StubHandler(BaseHTTPRequestHandler):
+    """خادم واحد لكل الواجهات: /bot<token>/<method> و /file/... و Gemini و OCR.space"""
+
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _params(self, body):
+        """معاملات الطلب من الرابط أو من جسم الطلب (form أو JSON)"""
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()})
+        elif content_type.startswith('application/json') and body:
+            params.update(json.loads(body))
+        elif content_type.startswith('multipart/form-data'):
+            for name, value in re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', body):
+                params.setdefault(name.decode(), value.decode('utf-8', 'replace'))
+        return params
+
+    def do_GET(self):
+        self._route(b'')
+
+    def do_POST(self):
+        self._route(self._read_body())
+
+    def _route(self, body):
+        path = urlparse(self.path).path
+        if path.startswith('/file/'):
+            return self._download(path)
+        if ':generateContent' in path:
+            return self._gemini(body)
+        if path.startswith('/parse/image'):
+            return self._ocr()
+        match = re.match(r'^/bot[^/]+/(\w+)$', path)
+        if match:
+            return self._telegram(match.group(1), self._params(body))
+        self._send_json(404, {'error': 'not found'})
+
+    def _download(self, path):
+        state = self.state
+        state.count('download')
+        state.download.wait()
+        # بايتات مختلفة لكل ملف حتى لا تصيب ذاكرة النتائج (PIL يتجاهل ما بعد نهاية JPEG)
+        body = state.image_bytes + path.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _gemini(self, body):
+        state = self.state
+        state.count('gemini')
+        state.engine.wait()
+        if state.engine.should_fail():
+            return self._send_json(503, {'error': {'code': 503, 'message': 'overloaded', 'status': 'UNAVAILABLE'}})
+
+        request = json.loads(body or b'{}')
+        config = request.get('generationConfig') or request.get('generation_config') or {}
+        json_mode = 'responseMimeType' in config or 'response_mime_type' in config
+        self._send_json(200, {
+            'candidates': [{
+                'content': {'parts': [{'text': GEMINI_JSON_TEXT if json_mode else GEMINI_LINES_TEXT}], 'role': 'model'},
+                'finishReason': 'STOP',
+                'index': 0
+            }],
+            'usageMetadata': {'promptTokenCount': 600, 'candidatesTokenCount': 120, 'totalTokenCount': 720}
+        })
+
+    def _ocr(self):
+        state = self.state
+        state.count('ocr')
+        state.engine.wait()
+        if state.engine.should_fail():
+            return self._send_json(500, {'IsErroredOnProcessing': True, 'ErrorMessage': ['stub error']})
+        self._send_json(200, {
+            'ParsedResults': [{'ParsedText': OCR_TEXT}],
+            'IsErroredOnProcessing': False
+        })
+
+    def _message(self, chat_id, **fields):
+        return dict({
+            'message_id': self.state.next_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id or 0), 'type': 'private'}
+        }, **fields)
+
+    def _telegram(self, method, params):
+        state = self.state
+        state.count(f'telegram.{method}')
+        state.telegram.wait()
+        if method != 'getMe' and state.telegram.should_fail():
+            return self._send_json(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            })
+
+        chat_id = params.get('chat_id')
+        text = params.get('text', '')
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'getFile':
+            file_id = params.get('file_id', '')
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(state.image_bytes), 'file_path': f'photos/{file_id}.jpg'}
+        elif method == 'sendDocument':
+            result = self._message(chat_id, document={'file_id': 'result', 'file_unique_id': 'result'})
+        elif method in ('deleteMessage', 'sendChatAction', 'answerCallbackQuery'):
+            result = True
+        else:
+            result = self._message(chat_id, text=text)
+
+        self._send_json(200, {'ok': True, 'result': result})
+
+        # اكتمال الرسالة: ملف النتائج، أو رسالة خطأ نهائية، أو رفض الطابور
+        if method == 'sendDocument':
+            state.done(chat_id, True)
+        elif method in ('sendMessage', 'editMessageText') and text.startswith(FAILURE_PREFIXES):
+            state.done(chat_id, False)
+
+def start_stub_server(state):
+    """تشغيل الخادم الوهمي على منفذ عشوائي في الخلفية"""
+    handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# ============= تشغيل القياس =============
+def percentile(values, percent):
+    """النسبة المئوية (أقرب رتبة) من قائمة قيم"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))]
+
+class MemorySampler:
+    """أخذ عينات RSS دورياً لمعرفة الذروة أثناء القياس"""
+
+    def __init__(self, read_rss, interval=0.1):
+        self.read_rss = read_rss
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start = self.read_rss()
+        self.peak = self.start
+        threading.Thread(target=self._run, name="rss-sampler", daemon=True).start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.read_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self.end = self.read_rss()
+        self.peak = max(self.peak, self.end)
+
+def make_photo_update(main, index):
+    """تحديث تيليجرام لرسالة صورة من مستخدم مستقل"""
+    user_id = BENCH_USER_BASE + index
+    file_id = f"bench{index}"
+    return main.telebot.types.Update.de_json(json.dumps({
+        'update_id': index,
+        'message': {
+            'message_id': index,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960}]
+        }
+    }))
+
+def run_pipeline(main, state, args):
+    """إرسال الرسائل عبر معالجات البوت بحد أقصى args.concurrency رسالة قيد التنفيذ"""
+    slots = threading.Semaphore(args.concurrency)
+    started = {}
+    latencies = {'ok': [], 'failed': []}
+    lock = threading.Lock()
+
+    def on_done(chat_id, ok):
+        with lock:
+            start = started.pop(int(chat_id), None)
+        if start is None:
+            return
+        latencies['ok' if ok else 'failed'].append(time.perf_counter() - start)
+        slots.release()
+
+    def wait_idle():
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            with lock:
+                if not started:
+                    return
+            time.sleep(0.01)
+
+    def send(indexes):
+        stalled = 0
+        for index in indexes:
+            # رسالة لم تكتمل خلال المهلة تُحسب عالقة ويُستأنف الإرسال
+            if not slots.acquire(timeout=args.timeout):
+                stalled += 1
+            update = make_photo_update(main, index)
+            with lock:
+                started[BENCH_USER_BASE + index] = time.perf_counter()
+            main.bot.process_new_updates([update])
+        wait_idle()
+        return stalled
+
+    state.on_done = on_done
+    send(range(args.warmup))
+    latencies['ok'].clear()
+    latencies['failed'].clear()
+
+    bench_started = time.perf_counter()
+    stalled = send(range(args.warmup, args.warmup + args.messages))
+    elapsed = time.perf_counter() - bench_started
+
+    with lock:
+        stalled += len(started)
+    return latencies, stalled, elapsed
+
+def run_engine_only(main, state, args):
+    """استدعاء extract_text_from_image مباشرة (بدون تيليجرام) لقياس مسار المحركات وحده"""
+    latencies = {'ok': [], 'failed': []}
+
+    def call(index):
+        image_bytes = state.image_bytes + f"engine{index}".encode()
+        started = time.perf_counter()
+        try:
+            result = main.extract_text_from_image(image_bytes)
+            ok = main.has_extracted_text(result)
+        except Exception:
+            ok = False
+        latencies['ok' if ok else 'failed'].append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(call, range(args.warmup)))
+        latencies = {'ok': [], 'failed': []}
+        started = time.perf_counter()
+        list(pool.map(call, range(args.warmup, args.warmup + args.messages)))
+    return latencies, 0, time.perf_counter() - started
+
+SAMPLE_OCR_LINES = (
+    'جمهورية مصر العربية', 'بطاقة تحقيق الشخصية', 'الاسم: محمد أحمد علي حسن', 'تاريخ الميلاد 1990/01/01',
+    'محل الإقامة: القاهرة - مدينة نصر', 'الرقم القومي ٢٩٠٠١٠١١٢٣٤٥٦٧', 'ARAB REPUBLIC OF EGYPT', 'NAME: MOHAMED AHMED',
+    'DATE OF BIRTH 01.01.1990', 'P<EGYMOHAMED<<AHMED<ALI<<<<<<<<<<<<<<<<<<<<', 'A123456782EGY9001011M3001019<<<<<<<<<<<<<<06',
+    'الاسم / Name: MOHAMED AHMED', 'تاريخ الإصدار Issue Date 2020/05/10', '12345678', ''
+)
+
+def build_ocr_pages(pages, lines_per_page, seed=7):
+    """صفحات نص OCR تجريبية تجمع أسطراً عربية ولاتينية ومختلطة"""
+    rng = random.Random(seed)
+    return [
+        '\n'.join('  ' + rng.choice(SAMPLE_OCR_LINES) + ' ' for _ in range(lines_per_page))
+        for _ in range(pages)
+    ]
+
+def legacy_parse_ocr_text(text):
+    """التنفيذ السابق (حلقة بايثون مع re.search غير مجهز) للمقارنة فقط"""
+    arabic_texts, english_texts = [], []
+    for line in text.split('\n'):
+        line = line.strip()
+        if line:
+            if re.search(r'[\u0600-\u06FF]', line):
+                arabic_texts.append(line)
+            else:
+                english_texts.append(line)
+    name = ""
+    for line in arabic_texts:
+        if re.search(r'(اسم|الاسم|Name)', line, re.IGNORECASE):
+            name = re.sub(r'(اسم|الاسم|Name)[:\s]*', '', line, flags=re.IGNORECASE).strip()
+            break
+    return {'name': name, 'arabic_texts': arabic_texts, 'english_texts': english_texts}
+
+def legacy_transliterate(name, arabic_to_latin):
+    """التحويل السابق حرفاً حرفاً مع += للمقارنة فقط"""
+    latin_name = ""
+    for char in str(name):
+        if char in arabic_to_latin:
+            latin_name += arabic_to_latin[char]
+        elif char.isalpha() and char.isascii():
+            latin_name += char.lower()
+    latin_name = re.sub(r'[^a-z.]', '', latin_name)
+    return re.sub(r'\.+', '.', latin_name).strip('.')
+
+def time_best(func, items, rounds):
+    """أفضل زمن من عدة جولات لتطبيق func على كل العناصر"""
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def run_text_benchmark(args):
+    """قياس معالجة النصوص بعد المحرك (تصنيف الأسطر واستخراج الاسم والتحويل) على مخرجات جماعية كبيرة"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from text_processing import ARABIC_TO_LATIN, classify_lines, transliterate_name
+
+    pages = build_ocr_pages(args.messages, args.lines_per_page)
+    total_lines = args.messages * args.lines_per_page
+    megabytes = sum(len(page.encode('utf-8')) for page in pages) / (1024 * 1024)
+    names = [classify_lines(page)['name'] or 'مستخدم' for page in pages]
+
+    timings = {
+        'legacy_parse': time_best(legacy_parse_ocr_text, pages, args.rounds),
+        'classify': time_best(lambda page: classify_lines(page, False), pages, args.rounds),
+        'classify_split': time_best(classify_lines, pages, args.rounds),
+        'legacy_transliterate': time_best(lambda name: legacy_transliterate(name, ARABIC_TO_LATIN), names, args.rounds),
+        'transliterate': time_best(transliterate_name, names, args.rounds)
+    }
+    report = {
+        'mode': 'text',
+        'pages': args.messages,
+        'lines': total_lines,
+        'megabytes': round(megabytes, 3),
+        'seconds': {name: round(value, 5) for name, value in timings.items()},
+        'lines_per_second': {
+            name: round(total_lines / timings[name]) for name in ('legacy_parse', 'classify', 'classify_split')
+        },
+        'names_per_second': {
+            name: round(len(names) / timings[name]) for name in ('legacy_transliterate', 'transliterate')
+        }
+    }
+
+    print("\n" + "=" * 60)
+    print("📊 نتائج قياس معالجة النصوص")
+    print("=" * 60)
+    print(f"• الصفحات: {args.messages} | الأسطر: {total_lines} | الحجم: {megabytes:.2f} MB | أفضل {args.rounds} جولات")
+    for name in ('legacy_parse', 'classify', 'classify_split'):
+        print(
+            f"• {name}: {timings[name] * 1000:.1f} ms | {report['lines_per_second'][name]:,} سطر/ث | "
+            f"{megabytes / timings[name]:.1f} MB/ث | ×{timings['legacy_parse'] / timings[name]:.2f}"
+        )
+    for name in ('legacy_transliterate', 'transliterate'):
+        print(
+            f"• {name}: {report['names_per_second'][name]:,} اسم/ث | "
+            f"×{timings['legacy_transliterate'] / timings[name]:.2f}"
+        )
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+        print(f"💾 حُفظت النتائج في {args.json_path}")
+
+def configure_environment(base_url, args):
+    """توجيه البوت إلى الخوادم الوهمية قبل استيراد main (القيم المحددة مسبقاً تُحترم)"""
+    os.environ['TELEGRAM_TOKEN'] = BENCH_TOKEN
+    os.environ['TELEGRAM_API_URL'] = base_url
+    os.environ['OCR_API_URL'] = f"{base_url}/parse/image"
+    os.environ['GEMINI_API_ENDPOINT'] = base_url
+    os.environ['EXTRACTION_ENGINES'] = args.engine
+    if args.engine == 'gemini':
+        os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    else:
+        os.environ['GEMINI_API_KEY'] = ''
+    os.environ.setdefault('GEMINI_HEALTH_CHECK', '0')
+    os.environ.setdefault('USER_STORE_BACKEND', 'memory')
+    os.environ.setdefault('CACHE_BACKEND', 'memory')
+    os.environ.setdefault('MRZ_FAST_PATH', '0')
+    if not args.keep_rate_limits:
+        # حدود الحصة (RPM) تقيس الحصة لا خط المعالجة: تُعطل ما لم يُطلب غير ذلك
+        os.environ.setdefault('GEMINI_RPM', '0')
+        os.environ.setdefault('OCR_RPM', '0')
+    os.environ.setdefault('EXTRACTION_QUEUE_SIZE', str(max(50, args.concurrency * 2)))
+    if args.workers:
+        # هذه العملية تستقبل فقط، والاستخراج في عمليات عمال منفصلة عبر طابور SQLite مؤقت
+        os.environ['BOT_ROLE'] = 'ingest'
+        os.environ.setdefault('JOB_QUEUE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'jobs.db'))
+        os.environ.setdefault('JOB_POLL_INTERVAL', '0.05')
+
+def start_worker_processes(count):
+    """تشغيل عمليات main.py --worker بنفس إعدادات البيئة"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    return [
+        subprocess.Popen([sys.executable, script, '--worker'], env=os.environ.copy(),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(count)
+    ]
+
+def print_report(report):
+    """طباعة ملخص القياس"""
+    print("\n" + "=" * 60)
+    print("📊 نتائج القياس")
+    print("=" * 60)
+    print(f"• الوضع: {report['mode']} | المحرك: {report['engine']} | التزامن: {report['concurrency']}")
+    print(f"• الرسائل: {report['messages']} (نجحت {report['ok']} | فشلت {report['failed']} | عالقة {report['stalled']})")
+    print(f"• المدة: {report['duration']:.2f} ث")
+    print(f"• الإنتاجية: {report['throughput']:.2f} رسالة/ث")
+    latency = report['latency']
+    print(f"• زمن الاستجابة: p50 {latency['p50']:.3f} ث | p90 {latency['p90']:.3f} ث | p99 {latency['p99']:.3f} ث | الأقصى {latency['max']:.3f} ث")
+    memory = report['memory_mb']
+    print(f"• الذاكرة (RSS): البداية {memory['start']:.0f} MB | الذروة {memory['peak']:.0f} MB | النهاية {memory['end']:.0f} MB")
+    if report['stages_p95']:
+        print("• p95 المراحل: " + " | ".join(f"{stage} {value:.3f} ث" for stage, value in report['stages_p95'].items()))
+    if report['stub_requests']:
+        print("• طلبات الخوادم الوهمية: " + ", ".join(f"{name}={count}" for name, count in sorted(report['stub_requests'].items())))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء البوت مقابل خوادم وهمية محلية")
+    parser.add_argument('--mode', choices=('pipeline', 'engine', 'text'), default='pipeline',
+                        help="pipeline: معالجات تيليجرام كاملة، engine: extract_text_from_image فقط، "
+                             "text: معالجة نصوص OCR فقط (--messages = عدد الصفحات)")
+    parser.add_argument('--engine', choices=('gemini', 'ocr'), default='gemini')
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="عدد عمليات main.py --worker (0 = عملية واحدة BOT_ROLE=all)")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=120, help="أقصى انتظار لاكتمال رسالة (ث)")
+    parser.add_argument('--latency-dist', choices=('fixed', 'uniform', 'exp', 'lognormal'), default='exp')
+    parser.add_argument('--telegram-latency', type=float, default=40, help="متوسط زمن Bot API (مللي ثانية)")
+    parser.add_argument('--download-latency', type=float, default=80, help="متوسط زمن تحميل الملف (مللي ثانية)")
+    parser.add_argument('--engine-latency', type=float, default=1200, help="متوسط زمن المحرك (مللي ثانية)")
+    parser.add_argument('--engine-errors', type=float, default=0.0, help="نسبة أخطاء المحرك (0-1)")
+    parser.add_argument('--telegram-429', type=float, default=0.0, help="نسبة ردود 429 من Bot API (0-1)")
+    parser.add_argument('--keep-rate-limits', action='store_true', help="إبقاء حدود GEMINI_RPM و OCR_RPM الافتراضية")
+    parser.add_argument('--image-size', default='1280x960', help="أبعاد الصورة التجريبية")
+    parser.add_argument('--lines-per-page', type=int, default=40, help="أسطر كل صفحة في وضع text")
+    parser.add_argument('--rounds', type=int, default=5, help="عدد الجولات في وضع text (يُعرض أفضلها)")
+    parser.add_argument('--json', dest='json_path', help="حفظ النتائج في ملف JSON")
+    return parser.parse_args(argv)
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    if args.mode == 'text':
+        run_text_benchmark(args)
+        return
+    width, height = (int(value) for value in args.image_size.lower().split('x'))
+    state = StubState(args, build_sample_image(width, height))
+    server, base_url = start_stub_server(state)
+    configure_environment(base_url, args)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.open_stores()
+
+    print(f"\n🧪 الخوادم الوهمية على {base_url}")
+    print(f"🚀 {args.messages} رسالة (+{args.warmup} إحماء) بتزامن {args.concurrency}...")
+    workers = start_worker_processes(args.workers) if args.workers else []
+    if workers:
+        print(f"⚙️ {len(workers)} عملية عامل (الذاكرة المعروضة لعملية الاستقبال فقط)")
+
+    runner = run_pipeline if args.mode == 'pipeline' else run_engine_only
+    try:
+        with MemorySampler(main.process_rss_bytes) as memory:
+            latencies, stalled, elapsed = runner(main, state, args)
+    finally:
+        for worker in workers:
+            worker.terminate()
+    server.shutdown()
+
+    all_latencies = latencies['ok'] + latencies['failed']
+    stages_p95 = {}
+    for stage in main.STAGE_ORDER:
+        value = main.STAGE_SECONDS.quantile(0.95, stage=stage)
+        if value is not None:
+            stages_p95[stage] = round(value, 4)
+
+    report = {
+        'mode': args.mode,
+        'engine': args.engine,
+        'concurrency': args.concurrency,
+        'workers': args.workers,
+        'messages': args.messages,
+        'ok': len(latencies['ok']),
+        'failed': len(latencies['failed']),
+        'stalled': stalled,
+        'duration': elapsed,
+        'throughput': len(all_latencies) / elapsed if elapsed else 0.0,
+        'latency': {
+            'p50': percentile(all_latencies, 50),
+            'p90': percentile(all_latencies, 90),
+            'p99': percentile(all_latencies, 99),
+            'max': max(all_latencies, default=0.0)
+        },
+        'memory_mb': {
+            'start': memory.start / (1024 * 1024),
+            'peak': memory.peak / (1024 * 1024),
+            'end': memory.end / (1024 * 1024)
+        },
+        'stages_p95': stages_p95,
+        'stub_requests': dict(state.requests)
+    }
+    print_report(report)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+        print(f"💾 حُفظت النتائج في {args.json_path}")
+
+    # عمال البوت خيوط daemon: الخروج مباشرة دون انتظارها
+    os._exit(0 if report['ok'] else 1)
+
+if __name__ == "__main__":
+    main_benchmark()
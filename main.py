@@ -11,13 +11,65 @@ import re
 import random
 import string
 import json
-import base64
+import asyncio
+import time
+import hashlib
+import sqlite3
+import shutil
+import socket
+import threading
+import queue
+import csv
+import zipfile
+import tempfile
+import math
+import importlib.util
+import multiprocessing
+import contextvars
+from collections import deque, OrderedDict
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
-print("=" * 60)
-print("🚀 بوت استخراج النصوص بالذكاء الاصطناعي")
-print("=" * 60)
+from text_processing import classify_lines, transliterate_name
+from tesseract_worker import run_tesseract
+
+# ============= قياس زمن بدء التشغيل =============
+# python main.py --startup-profile يطبع زمن كل مرحلة وزمن الوصول لأول رسالة
+STARTUP_PROFILE = {
+    'enabled': '--startup-profile' in sys.argv or os.environ.get('STARTUP_PROFILE') == '1',
+    'started': time.perf_counter(),
+    'last_mark': time.perf_counter(),
+    'phases': [],
+    'first_message': None
+}
+
+def mark_startup_phase(name):
+    """تسجيل انتهاء مرحلة من مراحل بدء التشغيل"""
+    now = time.perf_counter()
+    STARTUP_PROFILE['phases'].append((name, now - STARTUP_PROFILE['last_mark']))
+    STARTUP_PROFILE['last_mark'] = now
+
+def report_startup_profile():
+    """طباعة تقرير زمن بدء التشغيل"""
+    if not STARTUP_PROFILE['enabled']:
+        return
+    print("\n⏱️ **تقرير بدء التشغيل:**")
+    for name, duration in STARTUP_PROFILE['phases']:
+        print(f"• {name}: {duration * 1000:.0f}ms")
+    total = time.perf_counter() - STARTUP_PROFILE['started']
+    print(f"• المجموع حتى الآن: {total * 1000:.0f}ms")
+
+def on_first_update(messages):
+    """تسجيل زمن الوصول لأول رسالة (مستمع تحديثات البوت)"""
+    if STARTUP_PROFILE['first_message'] is None:
+        STARTUP_PROFILE['first_message'] = time.perf_counter() - STARTUP_PROFILE['started']
+        if STARTUP_PROFILE['enabled']:
+            print(f"⏱️ أول رسالة بعد {STARTUP_PROFILE['first_message']:.2f} ث من بدء التشغيل")
 
 # ============= الكشف عن المنصة والتثبيت التلقائي =============
 def detect_platform():
@@ -34,13 +86,12 @@ def detect_platform():
     
     for env_var, platform in platforms.items():
         if os.environ.get(env_var) or os.environ.get(f'{env_var}_APP'):
-            print(f"📍 المنصة: {platform}")
             return platform
     
-    print("📍 المنصة: محلي/غير معروف")
     return "LOCAL"
 
 PLATFORM = detect_platform()
+mark_startup_phase('الكشف عن المنصة')
 
 # ============= تثبيت المكتبات تلقائياً =============
 def install_requirements():
@@ -48,7 +99,7 @@ def install_requirements():
     required_packages = [
         'pyTelegramBotAPI==4.14.1',
         'requests==2.31.0',
-        'google-generativeai==0.3.2'
+        'google-generativeai==0.7.2'
     ]
     
     print("📦 جاري تثبيت المكتبات...")
@@ -72,19 +123,42 @@ def install_requirements():
     
     print("✅ جميع المكتبات جاهزة!\n")
 
-# تثبيت المتطلبات
-install_requirements()
+# التثبيت وقت التشغيل اختياري فقط (المتطلبات تُثبت أثناء البناء من requirements.txt)
+# وعند تشغيل الملف مباشرة فقط، لا عند استيراده (الاختبارات، أو عمليات Tesseract التي تعيد تنفيذه)
+if __name__ == "__main__" and (os.environ.get('AUTO_INSTALL') == '1' or '--install' in sys.argv):
+    install_requirements()
+    mark_startup_phase('تثبيت المكتبات')
 
 # ============= استيراد المكتبات بعد التثبيت =============
 try:
     import telebot
-    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+    from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, File
+    from telebot.apihelper import ApiTelegramException
     import requests
-    import google.generativeai as genai
     print("✅ المكتبات الرئيسية تم تحميلها بنجاح")
 except Exception as e:
     print(f"❌ خطأ في تحميل المكتبات: {e}")
     sys.exit(1)
+mark_startup_phase('استيراد telebot و requests')
+
+# مكتبات معالجة الصور (اختيارية)
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# NumPy وحده يكفي لبصمة pHash، وOpenCV (ثقيل التحميل) يُستورد فقط عند الحاجة للقص التلقائي
+NUMPY_AVAILABLE = importlib.util.find_spec('numpy') is not None
+CV2_AVAILABLE = importlib.util.find_spec('cv2') is not None and NUMPY_AVAILABLE
+
+# PyMuPDF (اختياري): لتحويل صفحات PDF إلى صور في وضع الاستخراج الجماعي
+PYMUPDF_AVAILABLE = importlib.util.find_spec('fitz') is not None
+
+# محرك OCR محلي (اختياري): يتطلب pytesseract وبرنامج tesseract مع حزمة اللغة العربية
+# المكتبة تُستورد داخل عمليات Tesseract فقط (tesseract_worker.py)
+TESSERACT_AVAILABLE = importlib.util.find_spec('pytesseract') is not None and shutil.which('tesseract') is not None
+mark_startup_phase('المكتبات الاختيارية')
 
 # ============= إعداد التوكنات والمفاتيح =============
 def setup_tokens():
@@ -116,57 +190,385 @@ GEMINI_API_KEY = TOKENS['GEMINI_API_KEY']
 OCR_API_KEY = TOKENS['OCR_API_KEY']
 
 # ============= إعداد الذكاء الاصطناعي =============
+GEMINI_MODEL_NAME = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash')
+GEMINI_HEALTH_CHECK = os.environ.get('GEMINI_HEALTH_CHECK', '1') == '1'
+# عنوان بديل لواجهة Gemini عبر REST (مثل http://127.0.0.1:9000 لخوادم benchmark.py الوهمية)
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT', '')
+# مخرجات JSON منظمة بمخطط ثابت (تتطلب google-generativeai بدعم response_schema)
+GEMINI_JSON_OUTPUT = os.environ.get('GEMINI_JSON_OUTPUT', '1') == '1'
+
 def setup_ai():
-    """إعداد نموذج الذكاء الاصطناعي"""
+    """
+    إعداد نموذج الذكاء الاصطناعي دون أي اتصال بالشبكة
+    مكتبة google.generativeai تُحمّل عند أول استخدام، والتحقق من الاتصال يجري في الخلفية
+    """
+    if GEMINI_API_KEY:
+        return {'model': None, 'type': 'gemini', 'available': True}
+    
+    print("⚠️ Gemini AI غير متوفر، سيتم استخدام OCR البديل")
+    return {'model': None, 'type': 'ocr', 'available': False}
+
+AI_SETUP = setup_ai()
+_gemini_lock = threading.Lock()
+
+def get_gemini_model():
+    """تحميل مكتبة Gemini وإنشاء النموذج عند أول استخدام"""
+    if AI_SETUP['model'] is None:
+        with _gemini_lock:
+            if AI_SETUP['model'] is None:
+                import google.generativeai as genai
+                if GEMINI_API_ENDPOINT:
+                    genai.configure(
+                        api_key=GEMINI_API_KEY,
+                        transport='rest',
+                        client_options={'api_endpoint': GEMINI_API_ENDPOINT}
+                    )
+                else:
+                    genai.configure(api_key=GEMINI_API_KEY)
+                
+                # الإصدارات القديمة من المكتبة لا تدعم المخطط: الرجوع لتنسيق الأسطر النصية
+                supports_schema = 'response_schema' in getattr(genai.GenerationConfig, '__dataclass_fields__', {})
+                AI_SETUP['json_mode'] = GEMINI_JSON_OUTPUT and supports_schema
+                generation_config = {
+                    'response_mime_type': 'application/json',
+                    'response_schema': GEMINI_RESPONSE_SCHEMA
+                } if AI_SETUP['json_mode'] else None
+                AI_SETUP['model'] = genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=generation_config)
+    return AI_SETUP['model']
+
+def check_gemini_health():
+    """التحقق من مفتاح Gemini (استعلام بيانات النموذج فقط، بدون استهلاك الحصة)"""
+    started = time.perf_counter()
     try:
-        if GEMINI_API_KEY:
-            genai.configure(api_key=GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            
-            # اختبار الاتصال
-            test_response = model.generate_content("اختبار اتصال")
-            print("✅ Gemini AI متصل وجاهز")
-            return {'model': model, 'type': 'gemini', 'available': True}
-        else:
-            print("⚠️ Gemini AI غير متوفر، سيتم استخدام OCR البديل")
-            return {'model': None, 'type': 'ocr', 'available': False}
+        get_gemini_model()
+        import google.generativeai as genai
+        genai.get_model(f"models/{GEMINI_MODEL_NAME}")
+        print("✅ Gemini AI متصل وجاهز")
     except Exception as e:
         print(f"⚠️ خطأ في إعداد Gemini AI: {e}")
-        return {'model': None, 'type': 'ocr', 'available': False}
+        AI_SETUP['available'] = False
+        AI_SETUP['type'] = 'ocr'
+    
+    if STARTUP_PROFILE['enabled']:
+        print(f"⏱️ فحص Gemini في الخلفية: {(time.perf_counter() - started) * 1000:.0f}ms")
 
-AI_SETUP = setup_ai()
+def start_background_health_check():
+    """تشغيل فحص المحركات في الخلفية حتى لا يتأخر بدء الاستقبال"""
+    if AI_SETUP['available'] and GEMINI_HEALTH_CHECK:
+        threading.Thread(target=check_gemini_health, name="gemini-health", daemon=True).start()
+
+# ============= اتصالات HTTP المشتركة =============
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# حدود حجم التحميل (Bot API لا يسمح بتحميل ملفات أكبر من 20MB أصلاً)
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', str(10 * 1024 * 1024)))
+DOCUMENT_MAX_BYTES = int(os.environ.get('DOCUMENT_MAX_BYTES', str(20 * 1024 * 1024)))
+
+def create_http_session():
+    """جلسة requests باتصالات مُعاد استخدامها (keep-alive) لتحميل الملفات و OCR.space"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+HTTP_SESSION = create_http_session()
+
+class FileTooLargeError(Exception):
+    """حجم الملف يتجاوز الحد المسموح للتحميل"""
+
+    def __init__(self, size, limit):
+        super().__init__(f"حجم الملف {size} بايت يتجاوز الحد {limit} بايت")
+        self.size = size
+        self.limit = limit
+
+def check_file_size(size, limit):
+    """رفض الملف مبكراً إذا كان حجمه المعلن يتجاوز الحد (الحجم قد يكون غير معروف)"""
+    if size and size > limit:
+        raise FileTooLargeError(size, limit)
+
+def stream_download(url, fileobj, max_bytes, timeout=30):
+    """تحميل رابط على دفعات إلى fileobj دون تجاوز max_bytes، تعيد False عند فشل HTTP"""
+    with HTTP_SESSION.get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            return False
+        check_file_size(int(response.headers.get('Content-Length') or 0), max_bytes)
+        
+        received = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            received += len(chunk)
+            # Content-Length قد يغيب أو يكون غير صحيح: الحد يُفحص أثناء التحميل أيضاً
+            check_file_size(received, max_bytes)
+            fileobj.write(chunk)
+    return True
 
 # ============= إعداد البوت =============
+# عنوان Bot API (خادم telegram-bot-api محلي، أو خوادم benchmark.py الوهمية)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+if TELEGRAM_API_URL != 'https://api.telegram.org':
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
+bot.set_update_listener(on_first_update)
+mark_startup_phase('إعداد البوت')
+
+# ============= قاعدة بيانات المستخدمين =============
+USER_STORE_BACKEND = os.environ.get('USER_STORE_BACKEND', 'sqlite').lower()  # sqlite | memory
+USER_DB_PATH = os.environ.get('USER_DB_PATH', 'bot_data.db')
+
+def today_key():
+    """مفتاح عداد اليوم الحالي"""
+    return datetime.now().strftime('%Y-%m-%d')
+
+class UserStore(ABC):
+    """
+    واجهة تخزين بيانات المستخدمين
+    العدادات (المستخدمون، إجمالي العمليات، عمليات كل يوم) تُحدَّث تدريجياً
+    حتى تُقرأ شاشات الإحصائيات في زمن ثابت مهما زاد عدد المستخدمين
+    """
+
+    @abstractmethod
+    def register_user(self, user_id, profile):
+        """إضافة مستخدم جديد (لا يغير المستخدم الموجود)"""
+
+    @abstractmethod
+    def record_extraction(self, user_id, data):
+        """تسجيل عملية استخراج للمستخدم وتحديث العدادات"""
+
+    @abstractmethod
+    def get_user(self, user_id):
+        """بيانات المستخدم أو None"""
+
+    @abstractmethod
+    def delete_user(self, user_id):
+        """حذف بيانات المستخدم، تعيد True إذا كان موجوداً"""
+
+    @abstractmethod
+    def get_counter(self, name):
+        """قراءة عداد"""
+
+    @abstractmethod
+    def record_usage(self, user_id, prompt_tokens, output_tokens):
+        """تسجيل استهلاك رموز Gemini للمستخدم ولليوم"""
+
+    def _usage_counters(self, user_id, prompt_tokens, output_tokens):
+        """العدادات التي يحدثها تسجيل الاستهلاك: (الاسم، القيمة)"""
+        day = today_key()
+        return [
+            (f"tokens:{user_id}:{day}", prompt_tokens + output_tokens),
+            (f"tokens:{day}", prompt_tokens + output_tokens),
+            (f"tokens_in:{day}", prompt_tokens),
+            (f"tokens_out:{day}", output_tokens),
+            (f"gemini_requests:{day}", 1)
+        ]
+
+    def _usage_day_changed(self):
+        """هل بدأ يوم جديد منذ آخر تنظيف لعدادات المستخدمين؟ (تُستدعى داخل القفل)"""
+        day = today_key()
+        if getattr(self, '_pruned_day', None) == day:
+            return False
+        self._pruned_day = day
+        return True
+
+    def tokens_today(self, user_id=None):
+        """رموز Gemini المستهلكة اليوم للمستخدم (أو للجميع)"""
+        if user_id is None:
+            return self.get_counter(f"tokens:{today_key()}")
+        return self.get_counter(f"tokens:{user_id}:{today_key()}")
+
+    def count_users(self):
+        return self.get_counter('users')
+
+    def total_extractions(self):
+        return self.get_counter('extractions')
+
+    def extractions_today(self):
+        return self.get_counter(f"day:{today_key()}")
+
+class MemoryUserStore(UserStore):
+    """تخزين مؤقت في الذاكرة (يُمسح عند إعادة التشغيل)"""
+
+    def __init__(self):
+        self._users = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _increment(self, name, amount=1):
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def register_user(self, user_id, profile):
+        with self._lock:
+            if user_id in self._users:
+                return False
+            self._users[user_id] = dict(profile, join_date=datetime.now().isoformat(), extractions=0)
+            self._increment('users')
+            return True
+
+    def record_extraction(self, user_id, data):
+        with self._lock:
+            if user_id not in self._users:
+                self._users[user_id] = {'join_date': datetime.now().isoformat(), 'extractions': 0}
+                self._increment('users')
+            user = self._users[user_id]
+            user['timestamp'] = datetime.now().isoformat()
+            user['data'] = data
+            user['extractions'] += 1
+            self._increment('extractions')
+            self._increment(f"day:{today_key()}")
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            return dict(user) if user else None
+
+    def delete_user(self, user_id):
+        with self._lock:
+            if self._users.pop(user_id, None) is None:
+                return False
+            self._increment('users', -1)
+            return True
+
+    def get_counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def record_usage(self, user_id, prompt_tokens, output_tokens):
+        with self._lock:
+            if self._usage_day_changed():
+                self._prune_user_tokens()
+            for name, amount in self._usage_counters(user_id, prompt_tokens, output_tokens):
+                self._increment(name, amount)
+
+    def _prune_user_tokens(self):
+        # عدادات الرموز لكل مستخدم لا تلزم بعد انتهاء يومها (الميزانية يومية)
+        # العدادات الإجمالية لكل يوم تبقى للإحصائيات
+        today = today_key()
+        stale = [
+            name for name in self._counters
+            if name.startswith('tokens:') and name.count(':') == 2 and not name.endswith(today)
+        ]
+        for name in stale:
+            del self._counters[name]
+
+class SQLiteUserStore(UserStore):
+    """تخزين دائم في SQLite بنمط WAL"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "user_id TEXT PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT, "
+                "join_date TEXT NOT NULL, extractions INTEGER NOT NULL DEFAULT 0, "
+                "timestamp TEXT, data TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def _increment(self, name, amount=1):
+        self._db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def _insert_user(self, user_id, profile):
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, profile.get('username'), profile.get('first_name'),
+             profile.get('last_name'), datetime.now().isoformat())
+        )
+        if cursor.rowcount:
+            self._increment('users')
+        return bool(cursor.rowcount)
+
+    def register_user(self, user_id, profile):
+        with self._lock, self._db:
+            return self._insert_user(user_id, profile)
+
+    def record_extraction(self, user_id, data):
+        with self._lock, self._db:
+            self._insert_user(user_id, {})
+            self._db.execute(
+                "UPDATE users SET extractions = extractions + 1, timestamp = ?, data = ? "
+                "WHERE user_id = ?",
+                (datetime.now().isoformat(), json.dumps(data, ensure_ascii=False), user_id)
+            )
+            self._increment('extractions')
+            self._increment(f"day:{today_key()}")
+
+    def get_user(self, user_id):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        user['data'] = json.loads(user['data']) if user['data'] else None
+        return user
+
+    def delete_user(self, user_id):
+        with self._lock, self._db:
+            cursor = self._db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            if cursor.rowcount:
+                self._increment('users', -1)
+            return bool(cursor.rowcount)
+
+    def get_counter(self, name):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def record_usage(self, user_id, prompt_tokens, output_tokens):
+        with self._lock, self._db:
+            if self._usage_day_changed():
+                self._prune_user_tokens()
+            for name, amount in self._usage_counters(user_id, prompt_tokens, output_tokens):
+                self._increment(name, amount)
 
-# ============= قاعدة بيانات مبسطة (في الذاكرة) =============
+    def _prune_user_tokens(self):
+        # tokens:{user}:{day} فقط (نقطتان)، أما tokens:{day} فتبقى للإحصائيات
+        cursor = self._db.execute(
+            "DELETE FROM counters WHERE name LIKE 'tokens:%:%' AND substr(name, -10) < ?",
+            (today_key(),)
+        )
+        if cursor.rowcount:
+            print(f"🧹 حذف {cursor.rowcount} عداد رموز منتهٍ")
+
+def create_user_store():
+    """إنشاء مخزن بيانات المستخدمين حسب الإعدادات"""
+    if USER_STORE_BACKEND == 'sqlite':
+        try:
+            store = SQLiteUserStore(USER_DB_PATH)
+            print(f"✅ قاعدة بيانات المستخدمين: SQLite ({USER_DB_PATH})")
+            return store
+        except Exception as e:
+            print(f"⚠️ تعذر فتح قاعدة البيانات، سيتم استخدام الذاكرة: {e}")
+    return MemoryUserStore()
+
+# المخزن المحدد في الإعدادات يُفتح في open_stores() عند التشغيل؛ الاستيراد وحده لا يفتح قاعدة البيانات
+USER_STORE = MemoryUserStore()
+# جلسات المستخدمين النشطين: أوقات آخر الملفات المرسلة (لحد المعدل) وآخر رسالة رفض
 user_sessions = {}
-user_data = {}
+_sessions_lock = threading.Lock()
 
 def save_user_data(user_id, data):
     """حفظ بيانات المستخدم"""
-    user_data[user_id] = {
-        'timestamp': datetime.now().isoformat(),
-        'data': data,
-        'extractions': user_data.get(user_id, {}).get('extractions', 0) + 1
-    }
+    USER_STORE.record_extraction(user_id, data)
     return True
 
 def get_user_data(user_id):
     """الحصول على بيانات المستخدم"""
-    return user_data.get(user_id, {'extractions': 0})
+    return USER_STORE.get_user(user_id) or {'extractions': 0}
 
 # ============= وظائف استخراج النصوص =============
-def extract_with_gemini(image_bytes):
-    """استخراج النصوص باستخدام Gemini AI"""
-    try:
-        model = AI_SETUP['model']
-        
-        # تحويل الصورة إلى base64
-        image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # إعداد الـ prompt
-        prompt = """
+GEMINI_PROMPT = """
         أنت خبير في استخراج النصوص من وثائق الهوية.
         
         استخرج جميع النصوص من هذه الصورة وأجب بالتنسيق التالي:
@@ -186,285 +588,2334 @@ def extract_with_gemini(image_bytes):
         2. فصل النصوص العربية عن الإنجليزية
         3. كتابة الاسم كاملاً إذا وجد
         """
-        
-        # إرسال الطلب
-        response = model.generate_content([
-            prompt,
-            {"mime_type": "image/jpeg", "data": image_b64}
-        ])
-        
-        # تحليل الاستجابة
-        result = {
-            'name': '',
-            'arabic_texts': [],
-            'english_texts': []
-        }
-        
-        lines = response.text.split('\n')
-        current_section = None
-        
-        for line in lines:
-            line = line.strip()
-            
-            if line.startswith('الاسم الكامل:'):
-                result['name'] = line.replace('الاسم الكامل:', '').strip()
-            elif line.startswith('النصوص العربية:'):
-                current_section = 'arabic'
-            elif line.startswith('النصوص الإنجليزية:'):
-                current_section = 'english'
-            elif line and current_section:
-                if line != 'لا يوجد':
-                    if current_section == 'arabic':
-                        result['arabic_texts'].append(line)
-                    elif current_section == 'english':
-                        result['english_texts'].append(line)
-        
-        return result
-        
-    except Exception as e:
-        print(f"❌ خطأ في Gemini AI: {e}")
-        return {'name': '', 'arabic_texts': [], 'english_texts': []}
 
-def extract_with_ocr(image_bytes):
-    """استخراج النصوص باستخدام خدمة OCR مجانية (بديل)"""
-    try:
-        # تحويل الصورة إلى base64
-        image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # إرسال إلى خدمة OCR.space المجانية
-        payload = {
-            'base64Image': f'data:image/jpeg;base64,{image_b64}',
-            'language': 'ara+eng',
-            'isOverlayRequired': False,
-            'OCREngine': 2,
-            'apikey': OCR_API_KEY
-        }
-        
-        response = requests.post(
-            'https://api.ocr.space/parse/image',
-            data=payload,
-            timeout=30
-        )
+GEMINI_JSON_PROMPT = """
+        أنت خبير في استخراج النصوص من وثائق الهوية.
         
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('IsErroredOnProcessing'):
-                return {'name': '', 'arabic_texts': [], 'english_texts': []}
-            
-            # استخراج النصوص
-            all_texts = []
-            for parsed_result in result.get('ParsedResults', []):
-                text = parsed_result.get('ParsedText', '').strip()
-                if text:
-                    all_texts.append(text)
-            
-            # فصل النصوص العربية والإنجليزية
-            arabic_texts = []
-            english_texts = []
-            
-            for text in all_texts:
-                lines = text.split('\n')
-                for line in lines:
-                    line = line.strip()
-                    if line:
-                        if re.search(r'[\u0600-\u06FF]', line):
-                            arabic_texts.append(line)
-                        else:
-                            english_texts.append(line)
-            
-            # محاولة استخراج اسم من النصوص العربية
-            name = ""
-            for text in arabic_texts:
-                if re.search(r'(اسم|الاسم|Name)', text, re.IGNORECASE):
-                    name = re.sub(r'(اسم|الاسم|Name)[:\s]*', '', text, flags=re.IGNORECASE).strip()
-                    break
-            
-            return {
-                'name': name,
-                'arabic_texts': arabic_texts,
-                'english_texts': english_texts
+        استخرج جميع النصوص من هذه الصورة وأجب بكائن JSON فقط بالحقول التالية:
+        - name: الاسم الكامل كما في الوثيقة (نص فارغ إن لم يوجد)
+        - arabic_texts: النصوص العربية، كل سطر عنصر مستقل
+        - english_texts: النصوص الإنجليزية، كل سطر عنصر مستقل
+        - document_number: رقم الوثيقة أو الهوية أو الجواز (نص فارغ إن لم يوجد)
+        - dates: التواريخ الظاهرة، كل تاريخ بوصفه (label) وقيمته كما هي (value)
+        - mrz: أسطر المنطقة المقروءة آلياً في أسفل الجواز كما هي (قائمة فارغة إن لم توجد)
+        """
+
+# نسخ مختصرة من التعليمات: مع مخطط JSON يكفي سطر واحد بدل الشرح الكامل
+GEMINI_COMPACT_PROMPT = """استخرج نصوص وثيقة الهوية بالتنسيق:
+الاسم الكامل: ...
+النصوص العربية:
+...
+النصوص الإنجليزية:
+...
+سطر لكل نص، واكتب: لا يوجد عند عدم وجود نص."""
+
+GEMINI_COMPACT_JSON_PROMPT = "استخرج كل نصوص وثيقة الهوية حسب المخطط، عنصر لكل سطر، مع فصل العربية عن الإنجليزية."
+
+GEMINI_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'arabic_texts': {'type': 'array', 'items': {'type': 'string'}},
+        'english_texts': {'type': 'array', 'items': {'type': 'string'}},
+        'document_number': {'type': 'string'},
+        'dates': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'label': {'type': 'string'}, 'value': {'type': 'string'}},
+                'required': ['label', 'value']
             }
+        },
+        'mrz': {'type': 'array', 'items': {'type': 'string'}}
+    },
+    'required': ['name', 'arabic_texts', 'english_texts']
+}
+
+GEMINI_REPAIR_PROMPT = """
+        النص التالي كان يفترض أن يكون كائن JSON بالحقول:
+        name, arabic_texts, english_texts, document_number, dates, mrz
+        أعد كتابته ككائن JSON صالح بهذه الحقول فقط دون إضافة أو حذف أي بيانات:
         
-        return {'name': '', 'arabic_texts': [], 'english_texts': []}
-        
-    except Exception as e:
-        print(f"❌ خطأ في OCR: {e}")
-        return {'name': '', 'arabic_texts': [], 'english_texts': []}
-
-def extract_text_from_image(image_bytes):
-    """الدالة الرئيسية لاستخراج النصوص"""
-    if AI_SETUP['available']:
-        print("🤖 استخدام Gemini AI للاستخراج...")
-        result = extract_with_gemini(image_bytes)
-    else:
-        print("🔤 استخدام OCR البديل...")
-        result = extract_with_ocr(image_bytes)
-    
-    return result
+        """
 
-# ============= وظائف إنشاء البيانات =============
-def generate_email(name):
-    """إنشاء بريد إلكتروني من الاسم"""
-    if not name or name.strip() == "":
-        name = "user"
-    
-    # تحويل الاسم العربي إلى حروف لاتينية
-    arabic_to_latin = {
-        'أ': 'a', 'ا': 'a', 'إ': 'e', 'آ': 'a',
-        'ب': 'b', 'ت': 't', 'ث': 'th',
-        'ج': 'j', 'ح': 'h', 'خ': 'kh',
-        'د': 'd', 'ذ': 'dh', 'ر': 'r', 'ز': 'z',
-        'س': 's', 'ش': 'sh', 'ص': 's', 'ض': 'd',
-        'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'gh',
-        'ف': 'f', 'ق': 'q', 'ك': 'k', 'ل': 'l',
-        'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w',
-        'ي': 'y', 'ى': 'a', 'ئ': 'e',
-        'ة': 'h', ' ': '.'
-    }
-    
-    latin_name = ""
-    for char in str(name):
-        if char in arabic_to_latin:
-            latin_name += arabic_to_latin[char]
-        elif char.isalpha() and char.isascii():
-            latin_name += char.lower()
-        elif char == ' ':
-            latin_name += '.'
-    
-    # تنظيف النتيجة
-    latin_name = re.sub(r'[^a-z.]', '', latin_name)
-    latin_name = re.sub(r'\.+', '.', latin_name)
-    latin_name = latin_name.strip('.')
-    
-    if len(latin_name) < 3:
-        latin_name = f"user{random.randint(1000, 9999)}"
+OCR_API_URL = os.environ.get('OCR_API_URL', 'https://api.ocr.space/parse/image')
+TESSERACT_LANG = os.environ.get('TESSERACT_LANG', 'ara+eng')
+TESSERACT_PROCESSES = int(os.environ.get('TESSERACT_PROCESSES', str(os.cpu_count() or 2)))
+TESSERACT_TIMEOUT = int(os.environ.get('TESSERACT_TIMEOUT', '60'))
+
+class ExtractionError(Exception):
+    """فشل محرك الاستخراج في معالجة الصورة"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        # الأخطاء المؤقتة (الحصة، ضغط الخادم) يمكن إعادة محاولتها
+        self.retryable = retryable
+
+def empty_result():
+    """نتيجة استخراج فارغة"""
+    return {'name': '', 'arabic_texts': [], 'english_texts': []}
+
+def has_extracted_text(extraction_result):
+    """التحقق من وجود نصوص مستخرجة"""
+    return bool(extraction_result['arabic_texts'] or extraction_result['english_texts'])
+
+GEMINI_BATCH_NOTE = """
+        الصور المرفقة أوجه مختلفة لوثيقة واحدة (مثل وجهي البطاقة):
+        اجمع نصوصها في إجابة واحدة بنفس التنسيق دون تكرار الأسطر المتطابقة.
+        """
+
+def build_gemini_request(image_bytes, mime_type='image/jpeg'):
+    """إعداد محتوى طلب Gemini (الـ prompt + الصورة)"""
+    return build_gemini_batch_request([(image_bytes, mime_type)])
+
+def build_gemini_batch_request(images):
+    """إعداد طلب Gemini لصورة أو عدة صور من وثيقة واحدة: images قائمة (bytes, mime_type)"""
+    prompt = get_gemini_prompt()
+    if len(images) > 1:
+        prompt += GEMINI_BATCH_NOTE
+    request = [prompt]
+    for image_bytes, mime_type in images:
+        # البايتات تُمرر كما هي: المكتبة ترسلها مباشرة دون نسخ base64 إضافية
+        request.append({"mime_type": mime_type, "data": image_bytes})
+    return request
+
+def parse_gemini_response(text):
+    """تحليل استجابة Gemini النصية إلى نتيجة منظمة"""
+    result = empty_result()
     
-    # خيارات النطاقات
-    domains = [
-        "idcard.me", "official-id.com", "passport.info",
-        "verify.id", "document.space", "identity.pro"
-    ]
+    lines = text.split('\n')
+    current_section = None
     
-    domain = random.choice(domains)
-    email = f"{latin_name}@{domain}"
+    for line in lines:
+        line = line.strip()
+        
+        if line.startswith('الاسم الكامل:'):
+            result['name'] = line.replace('الاسم الكامل:', '').strip()
+        elif line.startswith('النصوص العربية:'):
+            current_section = 'arabic'
+        elif line.startswith('النصوص الإنجليزية:'):
+            current_section = 'english'
+        elif line and current_section:
+            if line != 'لا يوجد':
+                if current_section == 'arabic':
+                    result['arabic_texts'].append(line)
+                elif current_section == 'english':
+                    result['english_texts'].append(line)
     
-    return email
+    return result
 
-def generate_password():
-    """إنشاء كلمة مرور قوية"""
-    # يجب أن تحتوي على حرف كبير، صغير، رقم ورمز
-    uppercase = random.choice(string.ascii_uppercase)
-    lowercase = random.choice(string.ascii_lowercase)
-    digit = random.choice(string.digits)
-    symbol = random.choice("!@#$%^&*")
+def _string_list(value, field):
+    """التحقق من أن الحقل قائمة نصوص، مع حذف الأسطر الفارغة"""
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"الحقل {field} ليس قائمة نصوص")
+    return [item.strip() for item in value if item.strip()]
+
+def parse_gemini_json(text):
+    """تحليل إجابة Gemini بصيغة JSON والتحقق من مطابقتها للمخطط (ValueError عند المخالفة)"""
+    # إزالة إطار ```json إن وُجد قبل اللجوء إلى طلب إصلاح
+    text = re.sub(r'^\s*```(?:json)?\s*|\s*```\s*$', '', text)
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("الإجابة ليست كائن JSON")
     
-    # باقي الأحرف
-    all_chars = string.ascii_letters + string.digits + "!@#$%^&*"
-    remaining = ''.join(random.choice(all_chars) for _ in range(8))
+    name = data.get('name') or ''
+    document_number = data.get('document_number') or ''
+    if not isinstance(name, str) or not isinstance(document_number, str):
+        raise ValueError("الحقلان name و document_number يجب أن يكونا نصوصاً")
     
-    # دمج وخلط
-    password = uppercase + lowercase + digit + symbol + remaining
-    password_list = list(password)
-    random.shuffle(password_list)
+    dates = data.get('dates') or []
+    if not isinstance(dates, list) or not all(
+        isinstance(item, dict) and isinstance(item.get('value'), str) for item in dates
+    ):
+        raise ValueError("الحقل dates غير صالح")
     
-    return ''.join(password_list)
+    result = {
+        'name': name.strip(),
+        'arabic_texts': _string_list(data.get('arabic_texts'), 'arabic_texts'),
+        'english_texts': _string_list(data.get('english_texts'), 'english_texts')
+    }
+    fields = {
+        'document_number': document_number.strip(),
+        'dates': [
+            {'label': str(item.get('label') or '').strip(), 'value': item['value'].strip()}
+            for item in dates if item['value'].strip()
+        ],
+        'mrz': _string_list(data.get('mrz') or [], 'mrz')
+    }
+    if any(fields.values()):
+        result['fields'] = fields
+    return result
 
-# ============= وظائف إنشاء الملفات =============
-def create_text_file_content(name, arabic_texts, english_texts, email, password, platform):
-    """إنشاء محتوى الملف النصي"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def repair_gemini_json(text):
+    """طلب نصي فقط (بدون الصورة) لإصلاح JSON غير صالح: أرخص بكثير من إعادة الاستخراج"""
+    request = GEMINI_REPAIR_PROMPT + text
+    response = get_gemini_model().generate_content(request)
+    record_gemini_usage(response, [request], [])
+    return response.text
+
+def parse_gemini_output(text, repair=None):
+    """
+    تحليل إجابة Gemini: JSON مع التحقق من المخطط، ثم محاولة إصلاح نصية واحدة عند الفشل،
+    ثم تحليل الأسطر القديم إذا كانت الإجابة بذلك التنسيق
+    إذا فشل كل ذلك يُرفع ExtractionError لينتقل الموجه للمحرك التالي بدلاً من نتيجة فارغة
+    """
+    if not AI_SETUP.get('json_mode'):
+        return parse_gemini_response(text)
     
-    content = "=" * 60 + "\n"
-    content += "📄 المعلومات المستخرجة من الوثيقة\n"
-    content += "=" * 60 + "\n\n"
+    try:
+        return parse_gemini_json(text)
+    except ValueError as e:
+        print(f"⚠️ إجابة Gemini لا تطابق المخطط: {e}")
     
-    if name:
-        content += f"👤 **اسم الشخص:** {name}\n\n"
+    if repair:
+        try:
+            return parse_gemini_json(repair(text))
+        except Exception as e:
+            print(f"⚠️ تعذر إصلاح إجابة Gemini: {e}")
     
-    content += "🔤 **النصوص العربية المستخرجة:**\n"
-    content += "-" * 40 + "\n"
-    if arabic_texts:
-        for i, text in enumerate(arabic_texts, 1):
-            content += f"{i:02d}. {text}\n"
-    else:
-        content += "❌ لم يتم العثور على نصوص عربية\n"
+    # JSON معطوب يعطي دائماً نتيجة فارغة من تحليل الأسطر
+    result = parse_gemini_response(text)
+    if has_extracted_text(result):
+        return result
+    raise ExtractionError("Gemini: تعذر تحليل الإجابة")
+
+def extract_with_gemini(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص باستخدام Gemini AI (الأخطاء تُمرر لموجه المحركات)"""
+    return extract_with_gemini_batch([(image_bytes, mime_type)])
+
+def extract_with_gemini_batch(images):
+    """استخراج نصوص عدة صور من وثيقة واحدة في استدعاء Gemini واحد"""
+    model = get_gemini_model()
     
-    content += "\n" + "=" * 60 + "\n\n"
+    # دقة الصور تُخفض تلقائياً إذا اقتربت ميزانية المستخدم من النفاد
+    images = fit_images_to_budget(images)
+    request = build_gemini_batch_request(images)
     
-    content += "🔤 **النصوص الإنجليزية المستخرجة:**\n"
-    content += "-" * 40 + "\n"
-    if english_texts:
-        for i, text in enumerate(english_texts, 1):
-            content += f"{i:02d}. {text}\n"
-    else:
-        content += "❌ لم يتم العثور على نصوص إنجليزية\n"
+    response = model.generate_content(request)
+    record_gemini_usage(response, request, images)
+    return parse_gemini_output(response.text, repair=repair_gemini_json)
+
+def merge_results(results):
+    """دمج نتائج عدة صور في نتيجة واحدة مع حذف الأسطر المكررة"""
+    merged = empty_result()
+    for result in results:
+        merged['name'] = merged['name'] or result['name']
+        for key in ('arabic_texts', 'english_texts'):
+            merged[key].extend(line for line in result[key] if line not in merged[key])
+        if 'engine' in result:
+            merged.setdefault('engine', result['engine'])
+        for key, value in result.get('fields', {}).items():
+            merged.setdefault('fields', {})
+            if value and not merged['fields'].get(key):
+                merged['fields'][key] = value
+    return merged
+
+OCR_FILE_TYPES = {'image/jpeg': 'JPG', 'image/png': 'PNG', 'image/gif': 'GIF', 'image/bmp': 'BMP', 'image/tiff': 'TIF'}
+
+def build_ocr_payload(mime_type='image/jpeg'):
+    """إعداد حقول طلب OCR.space (الصورة تُرفع كملف multipart بدلاً من base64)"""
+    return {
+        'language': 'ara+eng',
+        'isOverlayRequired': False,
+        'OCREngine': 2,
+        'filetype': OCR_FILE_TYPES.get(mime_type, 'JPG'),
+        'apikey': OCR_API_KEY
+    }
+
+def ocr_file_name(mime_type):
+    """اسم ملف الصورة في طلب multipart"""
+    return f"image.{OCR_FILE_TYPES.get(mime_type, 'JPG').lower()}"
+
+# تقسيم الأسطر التي تجمع العربية واللاتينية (مثل "الاسم / Name") بين القائمتين (اختياري:
+# أبطأ من التصنيف العادي، وبدونه يبقى السطر المختلط كاملاً ضمن النصوص العربية كما كان)
+OCR_SPLIT_MIXED_LINES = os.environ.get('OCR_SPLIT_MIXED_LINES', '0') == '1'
+
+def parse_ocr_text(text):
+    """فصل نص OCR الخام إلى نصوص عربية وإنجليزية ومحاولة استخراج الاسم"""
+    return classify_lines(text, OCR_SPLIT_MIXED_LINES)
+
+def parse_ocr_response(result):
+    """تحليل استجابة OCR.space وفصل النصوص العربية والإنجليزية"""
+    if result.get('IsErroredOnProcessing'):
+        raise ExtractionError(f"OCR.space: {result.get('ErrorMessage')}")
     
-    content += "\n" + "=" * 60 + "\n\n"
+    # استخراج النصوص
+    all_texts = []
+    for parsed_result in result.get('ParsedResults', []):
+        text = parsed_result.get('ParsedText', '').strip()
+        if text:
+            all_texts.append(text)
     
-    content += "📧 **بيانات الدخول المنشأة تلقائياً:**\n"
-    content += "-" * 40 + "\n"
-    content += f"📧 البريد الإلكتروني: {email}\n"
-    content += f"🔐 كلمة المرور: {password}\n\n"
+    return parse_ocr_text('\n'.join(all_texts))
+
+def extract_with_ocr(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص باستخدام خدمة OCR مجانية (بديل)"""
+    # إرسال إلى خدمة OCR.space المجانية
+    response = HTTP_SESSION.post(
+        OCR_API_URL,
+        data=build_ocr_payload(mime_type),
+        files={'file': (ocr_file_name(mime_type), image_bytes, mime_type)},
+        timeout=30
+    )
     
-    content += "=" * 60 + "\n"
-    content += f"📅 تاريخ الإستخراج: {timestamp}\n"
-    content += f"🌐 المنصة المستخدمة: {platform}\n"
-    content += f"🤖 المحرك: {'Gemini AI' if AI_SETUP['available'] else 'OCR Space'}\n"
-    content += "=" * 60 + "\n"
+    if response.status_code != 200:
+        raise ExtractionError(
+            f"OCR.space HTTP {response.status_code}",
+            retryable=response.status_code == 429 or response.status_code >= 500
+        )
     
-    return content
+    return parse_ocr_response(response.json())
 
-def create_filename(name):
-    """إنشاء اسم للملف"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    if name and name != "مستخدم":
-        safe_name = re.sub(r'[^\w\s]', '', name)
-        safe_name = safe_name.strip().replace(' ', '_')[:20]
-        return f"معلومات_{safe_name}_{timestamp}.txt"
-    return f"معلومات_{timestamp}.txt"
+_tesseract_pool = None
+_tesseract_pool_lock = threading.Lock()
 
-# ============= معالجات البوت =============
-@bot.message_handler(commands=['start', 'help', 'ابدأ'])
-def handle_start(message):
-    """معالجة أمر /start"""
-    try:
-        user = message.from_user
-        user_id = str(user.id)
-        
-        # حفظ معلومات المستخدم
-        if user_id not in user_data:
-            user_data[user_id] = {
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'join_date': datetime.now().isoformat(),
-                'extractions': 0
-            }
-        
-        # رسالة الترحيب
-        welcome_text = f"""
-🌟 أهلاً بك {user.first_name}! 
+def get_tesseract_pool():
+    """
+    مجموعة العمليات الخاصة بـ Tesseract (تُنشأ عند أول استخدام)
+    بطريقة spawn: fork من عملية متعددة الخيوط غير آمن (انظر tesseract_worker.py)
+    """
+    global _tesseract_pool
+    with _tesseract_pool_lock:
+        if _tesseract_pool is None:
+            _tesseract_pool = ProcessPoolExecutor(
+                max_workers=TESSERACT_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _tesseract_pool
 
-🤖 **بوت استخراج النصوص من البطاقة والجواز**
+def is_tesseract_available():
+    """Tesseract متوفر إذا وُجدت المكتبة والبرنامج معاً"""
+    return TESSERACT_AVAILABLE and PIL_AVAILABLE
 
-✨ **المميزات:**
-✅ استخراج تلقائي للنصوص العربية والإنجليزية
-✅ إنشاء بريد إلكتروني من الاسم
-✅ توليد كلمة مرور قوية
-✅ حفظ النتائج في ملف نصي
-✅ دعم الذكاء الاصطناعي (Gemini AI)
+def extract_with_tesseract(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص محلياً باستخدام Tesseract (بدون اتصال بالإنترنت)"""
+    future = get_tesseract_pool().submit(run_tesseract, image_bytes, TESSERACT_LANG)
+    return parse_ocr_text(future.result(timeout=TESSERACT_TIMEOUT))
 
-📸 **كيفية الاستخدام:**
-1. أرسل صورة البطاقة أو الجواز
-2. انتظر قليلاً للمعالجة
-3. استلم الملف مع جميع المعلومات
+# ============= حماية استدعاءات المحركات (تحديد المعدل وقاطع الدائرة) =============
+# الحصة بالطلبات في الدقيقة لكل محرك (0 = بدون حد)
+ENGINE_RATE_LIMITS = {
+    'gemini': int(os.environ.get('GEMINI_RPM', '15')),
+    'ocr': int(os.environ.get('OCR_RPM', '60')),
+    'tesseract': 0
+}
+RATE_LIMIT_WAIT = float(os.environ.get('RATE_LIMIT_WAIT', '5'))
+ENGINE_MAX_RETRIES = int(os.environ.get('ENGINE_MAX_RETRIES', '2'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = 8.0
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', '5'))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', '60'))
 
-⚡ **الآن:** أرسل صورة مباشرة أو استخدم الأزرار!
-"""
-        
-        # إنشاء لوحة المفاتيح
-        keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-        keyboard.add(
+# أسماء أخطاء google-api-core المؤقتة (دون استيراد المكتبة مباشرة)
+RETRYABLE_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable',
+    'DeadlineExceeded', 'InternalServerError', 'GatewayTimeout', 'BadGateway',
+    # أخطاء الاتصال في aiohttp (نمط asyncio)
+    'ClientConnectorError', 'ClientOSError', 'ServerDisconnectedError'
+}
+
+class EngineUnavailableError(ExtractionError):
+    """المحرك مرفوض مؤقتاً (قاطع الدائرة مفتوح أو الحصة نفدت)"""
+
+class TokenBucket:
+    """دلو رموز لتحديد معدل الطلبات: rate رمز في الثانية بسعة capacity (rate <= 0 = بدون حد)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """أخذ رمز إن وجد، وإلا تعيد المدة اللازمة لتوفره"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout):
+        """انتظار رمز حتى timeout ثانية، تعيد False عند انتهاء المهلة"""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait_time = self.try_acquire()
+            if wait_time == 0.0:
+                return True
+            if time.monotonic() + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return int(self._tokens)
+
+class CircuitBreaker:
+    """قاطع دائرة: يفتح بعد أخطاء متتالية ويسمح بطلب تجريبي بعد مهلة"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._state = self.CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        هل يُسمح بالطلب؟ بعد انتهاء المهلة يُسمح بطلب تجريبي واحد فقط
+        (ويُسمح بطلب تجريبي جديد إذا لم تصل نتيجة السابق خلال المهلة)
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+def is_retryable_error(error):
+    """الأخطاء المؤقتة التي تستحق إعادة المحاولة"""
+    if isinstance(error, ExtractionError):
+        return error.retryable
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, asyncio.TimeoutError)):
+        return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+def retry_delay(attempt):
+    """مدة الانتظار قبل إعادة المحاولة (تراجع أسي مع عشوائية كاملة)"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class EngineClient:
+    """غلاف استدعاءات محرك: تحديد المعدل، إعادة المحاولة، وقاطع الدائرة"""
+
+    def __init__(self, name, requests_per_minute):
+        self.name = name
+        self.bucket = TokenBucket(requests_per_minute / 60, requests_per_minute / 4) if requests_per_minute else None
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            raise EngineUnavailableError(f"{self.name}: قاطع الدائرة مفتوح")
+
+    def _rate_limited(self):
+        return EngineUnavailableError(f"{self.name}: تم تجاوز حد الطلبات")
+
+    async def _acquire_token_async(self):
+        """انتظار رمز دون حجز حلقة asyncio"""
+        deadline = time.monotonic() + RATE_LIMIT_WAIT
+        while True:
+            wait_time = self.bucket.try_acquire()
+            if wait_time == 0.0:
+                return True
+            if time.monotonic() + wait_time > deadline:
+                return False
+            await asyncio.sleep(wait_time)
+
+    def _should_retry(self, error, attempt):
+        """
+        تسجيل الخطأ، تعيد True إذا كان يجب إعادة المحاولة
+        قاطع الدائرة يحسب أخطاء النقل وضغط الخادم (5xx و429) فقط؛ أخطاء المحتوى
+        (نتيجة فارغة أو غير قابلة للتحليل) لا تفتح القاطع ولا تمسح أخطاء النقل السابقة
+        """
+        retryable = is_retryable_error(error)
+        if attempt < ENGINE_MAX_RETRIES and retryable:
+            print(f"🔁 إعادة محاولة {self.name} ({attempt + 1}/{ENGINE_MAX_RETRIES}): {error}")
+            return True
+        if retryable:
+            self.breaker.record_failure()
+        return False
+
+    def call(self, func, *args):
+        """استدعاء متزامن محمي"""
+        for attempt in range(ENGINE_MAX_RETRIES + 1):
+            self._check_breaker()
+            if self.bucket and not self.bucket.acquire(RATE_LIMIT_WAIT):
+                raise self._rate_limited()
+            try:
+                result = func(*args)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                time.sleep(retry_delay(attempt))
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, func, *args):
+        """استدعاء غير متزامن محمي"""
+        for attempt in range(ENGINE_MAX_RETRIES + 1):
+            self._check_breaker()
+            if self.bucket and not await self._acquire_token_async():
+                raise self._rate_limited()
+            try:
+                result = await func(*args)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                await asyncio.sleep(retry_delay(attempt))
+                continue
+            self.breaker.record_success()
+            return result
+
+    def status(self):
+        """ملخص الحالة للعرض في /status"""
+        state = {
+            CircuitBreaker.CLOSED: '🟢 مغلق',
+            CircuitBreaker.OPEN: '🔴 مفتوح',
+            CircuitBreaker.HALF_OPEN: '🟡 نصف مفتوح'
+        }[self.breaker.state]
+        tokens = f"{self.bucket.available()}/{int(self.bucket.capacity)}" if self.bucket else "∞"
+        return f"القاطع {state} | الرموز المتاحة {tokens}"
+
+# ============= المقاييس (Prometheus) =============
+# منفذ مستقل لـ /metrics في نمط Polling (في نمط Webhook تُعرض على منفذ الخادم نفسه)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+# ترتيب عرض مراحل المعالجة في /status
+STAGE_ORDER = ('get_file', 'download', 'phash', 'preprocess', 'mrz', 'extract', 'build', 'send')
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+START_TIME = time.time()
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+    """أساس المقاييس: قيمة لكل مجموعة تسميات (labels)"""
+
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        """أسطر القيم بصيغة Prometheus النصية"""
+        with self._lock:
+            return [f"{self.name}{self._labels(key)} {value}" for key, value in self._values.items()]
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"] + self.samples())
+
+class Counter(Metric):
+    """عداد متزايد"""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """قيمة لحظية: تُحدد مباشرة أو تُحسب عند القراءة من الدالة func"""
+
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), func=None):
+        super().__init__(name, help_text, label_names)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        # الدالة تعيد رقماً، أو قاموساً {قيم التسميات: الرقم}
+        values = value if isinstance(value, dict) else {(): value}
+        return [f"{self.name}{self._labels(key)} {amount}" for key, amount in values.items()]
+
+class Histogram(Metric):
+    """توزيع القيم على حدود ثابتة (buckets) مع المجموع والعدد"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, entry in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry['counts']):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {entry['count']}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{self._labels(key)} {entry['count']}")
+        return lines
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry['count'] if entry else 0
+
+    def quantile(self, q, **labels):
+        """تقدير النسبة المئوية من الحدود (بنفس طريقة histogram_quantile)، أو None"""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            if not entry or not entry['count']:
+                return None
+            counts = list(entry['counts'])
+            total = entry['count']
+        
+        rank = q * total
+        cumulative, lower = 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+METRICS = []
+
+def render_metrics():
+    """كل المقاييس بصيغة Prometheus النصية"""
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+def process_rss_bytes():
+    """الذاكرة المقيمة الفعلية للعملية (RSS) من /proc، أو أقصى قيمة من getrusage"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except Exception:
+        return 0
+
+def format_uptime(seconds):
+    """مدة التشغيل بصيغة مقروءة"""
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    prefix = f"{days} يوم و " if days else ""
+    return f"{prefix}{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def format_stage_latencies():
+    """سطر لكل مرحلة: p50 و p95 وعدد القياسات"""
+    lines = []
+    for stage in STAGE_ORDER:
+        p50 = STAGE_SECONDS.quantile(0.5, stage=stage)
+        if p50 is None:
+            continue
+        p95 = STAGE_SECONDS.quantile(0.95, stage=stage)
+        count = STAGE_SECONDS.count(stage=stage)
+        lines.append(f"• {stage}: {p50:.2f} / {p95:.2f} ث ({count})")
+    return "\n".join(lines)
+
+STAGE_SECONDS = Histogram('bot_stage_seconds', 'Duration of each processing stage', ('stage',))
+ENGINE_SECONDS = Histogram('bot_engine_request_seconds', 'Successful extraction engine call latency', ('engine',))
+ENGINE_REQUESTS = Counter('bot_engine_requests_total', 'Extraction engine calls by outcome', ('engine', 'outcome'))
+ENGINE_ERRORS = Counter('bot_engine_errors_total', 'Extraction engine errors by type', ('engine', 'error_type'))
+EXTRACTIONS = Counter('bot_extractions_total', 'Extraction jobs by kind and outcome', ('kind', 'outcome'))
+ADMISSION_REJECTIONS = Counter('bot_admission_rejections_total', 'Uploads rejected by per-user limits', ('reason',))
+OUTGOING_REQUESTS = Counter('bot_outgoing_requests_total', 'Bot API send calls by outcome', ('outcome',))
+OUTGOING_WAIT = Histogram('bot_outgoing_queue_wait_seconds', 'Time spent in the outbound send queue')
+GEMINI_TOKENS = Counter('bot_gemini_tokens_total', 'Gemini tokens by kind', ('kind',))
+PHOTO_ESCALATIONS = Counter('bot_photo_escalations_total', 'Photos re-extracted from the largest size after a weak result')
+SIMILAR_IMAGE_HITS = Counter('bot_similar_image_hits_total', 'Extractions reused from a near-duplicate image')
+
+Gauge('bot_extraction_queue_depth', 'Jobs waiting in the extraction queue', func=lambda: EXTRACTION_QUEUE.stats()['depth'])
+Gauge('bot_extraction_workers_busy', 'Busy extraction workers', func=lambda: EXTRACTION_QUEUE.stats()['busy'])
+Gauge('bot_outgoing_queue_depth', 'Calls waiting in the outbound send queue', func=lambda: OUTBOX.stats()['depth'])
+Gauge('bot_cache_hit_ratio', 'Extraction cache hit ratio', func=lambda: EXTRACTION_CACHE.stats()['hit_rate'])
+Gauge('bot_cache_entries', 'Entries in the extraction cache', func=lambda: EXTRACTION_CACHE.stats()['entries'])
+Gauge('bot_similar_index_entries', 'Perceptual hashes in the near-duplicate index', func=lambda: SIMILAR_IMAGES.stats()['entries'])
+Gauge(
+    'bot_engine_circuit_open', 'Whether the engine circuit breaker is open', ('engine',),
+    func=lambda: {
+        (name,): int(engine['client'].breaker.state == CircuitBreaker.OPEN)
+        for name, engine in ENGINES.items()
+    }
+)
+Gauge('process_resident_memory_bytes', 'Resident memory size in bytes', func=process_rss_bytes)
+Gauge('process_start_time_seconds', 'Start time of the process since unix epoch', func=lambda: START_TIME)
+
+# ============= إحصائيات أداء المحركات =============
+ENGINE_STATS_WINDOW = int(os.environ.get('ENGINE_STATS_WINDOW', '100'))
+# إرسال طلب احتياطي لمحرك ثانٍ إذا تجاوز المحرك الأساسي زمن p95 الخاص به
+HEDGE_REQUESTS = os.environ.get('HEDGE_REQUESTS', '0') == '1'
+HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', '10'))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', '8'))
+# المحرك الذي تتجاوز نسبة أخطائه هذا الحد يُؤخر إلى نهاية الترتيب
+UNHEALTHY_ERROR_RATE = float(os.environ.get('UNHEALTHY_ERROR_RATE', '0.5'))
+UNHEALTHY_MIN_SAMPLES = 10
+
+class EngineStats:
+    """إحصائيات متحركة لمحرك: أزمنة الاستجابة (p50/p95) ونسبة الأخطاء"""
+
+    def __init__(self, window):
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self._lock:
+            self._outcomes.append(ok)
+            if ok:
+                self._latencies.append(latency)
+
+    def percentile(self, p):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def error_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+    def samples(self):
+        with self._lock:
+            return len(self._outcomes)
+
+    def is_healthy(self):
+        return self.samples() < UNHEALTHY_MIN_SAMPLES or self.error_rate() < UNHEALTHY_ERROR_RATE
+
+    def hedge_delay(self):
+        """المدة التي يُنتظر فيها المحرك قبل إرسال طلب احتياطي"""
+        with self._lock:
+            enough = len(self._latencies) >= HEDGE_MIN_SAMPLES
+        return self.percentile(95) if enough else HEDGE_DEFAULT_DELAY
+
+# ============= محركات الاستخراج =============
+# ترتيب المحركات حسب الأفضلية، مثلاً "tesseract" فقط للعمل بدون إنترنت
+EXTRACTION_ENGINES = [
+    name.strip()
+    for name in os.environ.get('EXTRACTION_ENGINES', 'gemini,ocr,tesseract').split(',')
+    if name.strip()
+]
+
+# الحد الأقصى للطلبات المتزامنة لكل محرك (لحماية الحصة وتجنب الاختناق)
+ENGINE_CONCURRENCY = {
+    'gemini': int(os.environ.get('GEMINI_CONCURRENCY', '4')),
+    'ocr': int(os.environ.get('OCR_CONCURRENCY', '2')),
+    'tesseract': TESSERACT_PROCESSES
+}
+
+ENGINES = {}
+ENGINE_SEMAPHORES = {}
+
+def register_engine(name, label, extract, is_available):
+    """
+    تسجيل محرك استخراج
+    extract(image_bytes, mime_type) تعيد نتيجة بالشكل {'name', 'arabic_texts', 'english_texts'}
+    """
+    ENGINES[name] = {
+        'name': name,
+        'label': label,
+        'extract': extract,
+        'available': is_available,
+        # نسخة غير متزامنة اختيارية تُستخدم في نمط asyncio
+        'extract_async': None,
+        # استخراج عدة صور في طلب واحد (اختياري)؛ بدونه تُعالج الصور واحدة تلو الأخرى
+        'extract_batch': None,
+        # فحص اختياري قبل الاستدعاء: هل تسمح ميزانية المستخدم الحالي بهذا المحرك؟
+        'within_budget': None,
+        'stats': EngineStats(ENGINE_STATS_WINDOW),
+        'client': EngineClient(name, ENGINE_RATE_LIMITS.get(name, 0))
+    }
+    ENGINE_SEMAPHORES[name] = threading.BoundedSemaphore(ENGINE_CONCURRENCY.get(name, 2))
+
+register_engine('gemini', 'Gemini AI', extract_with_gemini, lambda: AI_SETUP['available'])
+register_engine('ocr', 'OCR Space', extract_with_ocr, lambda: True)
+register_engine('tesseract', 'Tesseract (محلي)', extract_with_tesseract, is_tesseract_available)
+ENGINES['gemini']['extract_batch'] = extract_with_gemini_batch
+ENGINES['gemini']['within_budget'] = lambda: gemini_within_budget()
+
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="engine-call")
+
+def rank_engines():
+    """
+    المحركات المتوفرة حسب الأفضلية، مع استبعاد المحركات ذات القاطع المفتوح
+    أو التي نفدت ميزانية المستخدم الحالي فيها، وتأخير المحركات كثيرة الأخطاء
+    """
+    available = [
+        ENGINES[name] for name in EXTRACTION_ENGINES
+        if name in ENGINES and ENGINES[name]['available']()
+        and ENGINES[name]['client'].breaker.state != CircuitBreaker.OPEN
+        and (ENGINES[name]['within_budget'] is None or ENGINES[name]['within_budget']())
+    ]
+    healthy = [engine for engine in available if engine['stats'].is_healthy()]
+    unhealthy = [engine for engine in available if not engine['stats'].is_healthy()]
+    return healthy + unhealthy
+
+def select_engine():
+    """المحرك الأساسي الحالي"""
+    ranked = rank_engines()
+    return ranked[0] if ranked else None
+
+def record_engine_call(engine, elapsed, error=None):
+    """تسجيل نتيجة استدعاء محرك في الإحصائيات المتحركة وفي المقاييس"""
+    engine['stats'].record(elapsed, error is None)
+    ENGINE_REQUESTS.inc(engine=engine['name'], outcome='ok' if error is None else 'error')
+    if error is None:
+        ENGINE_SECONDS.observe(elapsed, engine=engine['name'])
+    else:
+        ENGINE_ERRORS.inc(engine=engine['name'], error_type=type(error).__name__)
+
+def run_engine(engine, image_bytes, mime_type):
+    """استدعاء محرك واحد مع حد التزامن وتسجيل الزمن والنتيجة"""
+    started = time.monotonic()
+    try:
+        with ENGINE_SEMAPHORES[engine['name']]:
+            result = engine['client'].call(engine['extract'], image_bytes, mime_type)
+    except Exception as e:
+        record_engine_call(engine, time.monotonic() - started, e)
+        raise
+    
+    record_engine_call(engine, time.monotonic() - started)
+    result['engine'] = engine['name']
+    return result
+
+def extract_with_fallback(engines, image_bytes, mime_type):
+    """تجربة المحركات بالترتيب حتى يعيد أحدها نصوصاً"""
+    result = None
+    for engine in engines:
+        print(f"🤖 استخدام {engine['label']} للاستخراج...")
+        try:
+            result = run_engine(engine, image_bytes, mime_type)
+        except Exception as e:
+            print(f"❌ خطأ في {engine['label']}: {e}")
+            continue
+        if has_extracted_text(result):
+            return result
+    return result or empty_result()
+
+def extract_hedged(engines, image_bytes, mime_type):
+    """
+    إرسال الطلب للمحرك الأساسي، وإذا تجاوز زمن p95 الخاص به يُرسل طلب احتياطي
+    للمحرك التالي. أول نتيجة تحتوي نصوصاً تفوز
+    """
+    primary, secondary = engines[0], engines[1]
+    futures = {HEDGE_EXECUTOR.submit(contextvars.copy_context().run, run_engine, primary, image_bytes, mime_type): primary}
+    hedge_delay = primary['stats'].hedge_delay()
+    hedged = False
+    
+    while futures:
+        timeout = None if hedged else hedge_delay
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        
+        if not done:
+            # المحرك الأساسي تأخر: إرسال الطلب الاحتياطي
+            print(f"⏳ {primary['label']} تجاوز {hedge_delay:.1f} ث، إرسال طلب احتياطي إلى {secondary['label']}")
+            futures[HEDGE_EXECUTOR.submit(contextvars.copy_context().run, run_engine, secondary, image_bytes, mime_type)] = secondary
+            hedged = True
+            continue
+        
+        for future in done:
+            engine = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"❌ خطأ في {engine['label']}: {e}")
+                continue
+            if has_extracted_text(result):
+                return result
+        
+        # فشل الأساسي قبل انتهاء المهلة: لا داعي للانتظار، جرّب الاحتياطي مباشرة
+        if not hedged and not futures:
+            futures[HEDGE_EXECUTOR.submit(contextvars.copy_context().run, run_engine, secondary, image_bytes, mime_type)] = secondary
+            hedged = True
+    
+    return extract_with_fallback(engines[2:], image_bytes, mime_type)
+
+def extract_text_from_image(image_bytes, mime_type='image/jpeg'):
+    """الدالة الرئيسية لاستخراج النصوص: توجيه الطلب مع التبديل التلقائي عند الفشل"""
+    engines = rank_engines()
+    if not engines:
+        print("❌ لا يوجد محرك استخراج متوفر")
+        return empty_result()
+    
+    if HEDGE_REQUESTS and len(engines) > 1:
+        return extract_hedged(engines, image_bytes, mime_type)
+    return extract_with_fallback(engines, image_bytes, mime_type)
+
+def run_engine_batch(engine, images):
+    """استدعاء محرك لعدة صور: طلب واحد إن دعمه المحرك، وإلا صورة بصورة مع دمج النتائج"""
+    if engine['extract_batch'] is None:
+        return merge_results([run_engine(engine, image_bytes, mime_type) for image_bytes, mime_type in images])
+    
+    started = time.monotonic()
+    try:
+        with ENGINE_SEMAPHORES[engine['name']]:
+            result = engine['client'].call(engine['extract_batch'], images)
+    except Exception as e:
+        record_engine_call(engine, time.monotonic() - started, e)
+        raise
+    
+    record_engine_call(engine, time.monotonic() - started)
+    result['engine'] = engine['name']
+    return result
+
+def extract_text_from_images(images):
+    """
+    استخراج نصوص عدة صور لوثيقة واحدة (ألبوم) مع التبديل التلقائي بين المحركات
+    images قائمة (bytes, mime_type)
+    """
+    result = None
+    for engine in rank_engines():
+        print(f"🤖 استخدام {engine['label']} لاستخراج {len(images)} صور...")
+        try:
+            result = run_engine_batch(engine, images)
+        except Exception as e:
+            print(f"❌ خطأ في {engine['label']}: {e}")
+            continue
+        if has_extracted_text(result):
+            return result
+    return result or empty_result()
+
+def get_engine_label():
+    """اسم محرك الاستخراج الحالي للعرض"""
+    engine = select_engine()
+    return engine['label'] if engine else 'غير متوفر'
+
+def format_engines_status():
+    """حالة جميع المحركات المفعلة للعرض"""
+    return " | ".join(
+        f"{ENGINES[name]['label']} {'✅' if ENGINES[name]['available']() else '⚠️'}"
+        for name in EXTRACTION_ENGINES if name in ENGINES
+    )
+
+def format_engine_latency(engine):
+    """ملخص أداء محرك: p50/p95 ونسبة الأخطاء"""
+    stats = engine['stats']
+    p50, p95 = stats.percentile(50), stats.percentile(95)
+    if p50 is None:
+        if stats.samples():
+            return f"{engine['label']}: أخطاء {stats.error_rate() * 100:.0f}% ({stats.samples()} طلب)"
+        return f"{engine['label']}: لا توجد بيانات بعد"
+    return (
+        f"{engine['label']}: p50 {p50:.1f} ث | p95 {p95:.1f} ث | "
+        f"أخطاء {stats.error_rate() * 100:.0f}% ({stats.samples()} طلب)"
+    )
+
+def format_engine_guard(engine):
+    """حالة قاطع الدائرة وحد المعدل لمحرك"""
+    return f"{engine['label']}: {engine['client'].status()}"
+
+# ============= ميزانية الرموز واستهلاك Gemini =============
+# الحد اليومي لرموز Gemini لكل مستخدم (0 = بدون حد)
+GEMINI_USER_DAILY_TOKENS = int(os.environ.get('GEMINI_USER_DAILY_TOKENS', '0'))
+# full | compact | auto (المختصرة عند استخدام مخطط JSON)
+GEMINI_PROMPT_STYLE = os.environ.get('GEMINI_PROMPT_STYLE', 'auto').lower()
+# درجات دقة الصورة المرسلة لـ Gemini (أكبر ضلع)، تُختار الأعلى ضمن الميزانية المتبقية
+GEMINI_IMAGE_TIERS = sorted(
+    (int(side) for side in os.environ.get('GEMINI_IMAGE_TIERS', '1600,1024,768').split(',') if side.strip()),
+    reverse=True
+)
+GEMINI_OUTPUT_TOKENS_ESTIMATE = int(os.environ.get('GEMINI_OUTPUT_TOKENS_ESTIMATE', '500'))
+# تقدير رموز الصورة: 258 رمزاً لكل مربع 768×768
+GEMINI_IMAGE_TILE = 768
+GEMINI_TOKENS_PER_TILE = 258
+
+# المستخدم صاحب المهمة الحالية (يُنسب إليه الاستهلاك)
+CURRENT_USER = contextvars.ContextVar('current_user', default=None)
+
+def get_gemini_prompt():
+    """التعليمات المرسلة لـ Gemini حسب النمط ووضع JSON"""
+    json_mode = AI_SETUP.get('json_mode')
+    compact = GEMINI_PROMPT_STYLE == 'compact' or (GEMINI_PROMPT_STYLE == 'auto' and json_mode)
+    if json_mode:
+        return GEMINI_COMPACT_JSON_PROMPT if compact else GEMINI_JSON_PROMPT
+    return GEMINI_COMPACT_PROMPT if compact else GEMINI_PROMPT
+
+def estimate_text_tokens(text):
+    """تقدير تقريبي لرموز النص (العربية أكثف من الإنجليزية)"""
+    return len(text) // 3 + 1
+
+def image_size(image_bytes):
+    """أبعاد الصورة من الترويسة فقط دون فك ترميزها، أو None"""
+    try:
+        return Image.open(BytesIO(image_bytes)).size
+    except Exception:
+        return None
+
+def estimate_image_tokens(image_bytes):
+    """تقدير رموز الصورة من أبعادها"""
+    size = image_size(image_bytes)
+    if size is None:
+        return GEMINI_TOKENS_PER_TILE
+    width, height = size
+    return GEMINI_TOKENS_PER_TILE * math.ceil(width / GEMINI_IMAGE_TILE) * math.ceil(height / GEMINI_IMAGE_TILE)
+
+def estimate_request_tokens(images):
+    """تقدير رموز طلب كامل: التعليمات + الصور + الإجابة المتوقعة"""
+    return (
+        estimate_text_tokens(get_gemini_prompt())
+        + sum(estimate_image_tokens(image_bytes) for image_bytes, _ in images)
+        + GEMINI_OUTPUT_TOKENS_ESTIMATE
+    )
+
+def gemini_budget_remaining():
+    """الرموز المتبقية اليوم للمستخدم الحالي، أو None إذا لم يوجد حد"""
+    user_id = CURRENT_USER.get()
+    if not GEMINI_USER_DAILY_TOKENS or user_id is None:
+        return None
+    return GEMINI_USER_DAILY_TOKENS - USER_STORE.tokens_today(user_id)
+
+def gemini_within_budget():
+    """هل تكفي الميزانية المتبقية لأرخص طلب ممكن (صورة بمربع واحد)؟"""
+    remaining = gemini_budget_remaining()
+    if remaining is None:
+        return True
+    cheapest = estimate_text_tokens(get_gemini_prompt()) + GEMINI_TOKENS_PER_TILE + GEMINI_OUTPUT_TOKENS_ESTIMATE
+    return remaining >= cheapest
+
+def fit_images_to_budget(images):
+    """
+    اختيار أعلى درجة دقة يبقى معها الطلب ضمن الميزانية
+    إذا لم تكفِ أي درجة (أو تعذر تصغير الصور) يُرفض الطلب لينتقل الموجه للمحرك التالي
+    """
+    remaining = gemini_budget_remaining()
+    if remaining is None or estimate_request_tokens(images) <= remaining:
+        return images
+    
+    largest_side = max(max(image_size(image_bytes) or (0, 0)) for image_bytes, _ in images)
+    for max_side in GEMINI_IMAGE_TIERS:
+        # الدرجات التي لا تصغر الصورة لا توفر شيئاً
+        if max_side >= largest_side:
+            continue
+        resized = [preprocess_image(image_bytes, max_side=max_side) for image_bytes, _ in images]
+        # preprocess_image تعيد الصورة كما هي إذا كانت المعالجة معطلة أو PIL غير متوفرة
+        if estimate_request_tokens(resized) <= remaining:
+            print(f"🪙 تخفيض دقة الصورة إلى {max_side}px للبقاء ضمن الميزانية ({remaining} رمز متبقٍ)")
+            return resized
+    
+    raise ExtractionError(f"Gemini: الطلب يتجاوز ميزانية المستخدم ({remaining} رمز متبقٍ)")
+
+def record_gemini_usage(response, request, images):
+    """تسجيل رموز الطلب من usage_metadata (أو تقديرها إن غابت) للمستخدم واليوم"""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None and getattr(usage, 'total_token_count', 0):
+        prompt_tokens = usage.prompt_token_count
+        output_tokens = usage.candidates_token_count
+    else:
+        prompt_tokens = (
+            sum(estimate_text_tokens(part) for part in request if isinstance(part, str))
+            + sum(estimate_image_tokens(image_bytes) for image_bytes, _ in images)
+        )
+        output_tokens = estimate_text_tokens(response.text)
+    
+    user_id = CURRENT_USER.get() or 'system'
+    USER_STORE.record_usage(user_id, prompt_tokens, output_tokens)
+    GEMINI_TOKENS.inc(prompt_tokens, kind='prompt')
+    GEMINI_TOKENS.inc(output_tokens, kind='output')
+    print(f"🪙 Gemini: {prompt_tokens} + {output_tokens} رمز (المستخدم {user_id})")
+
+# ============= المعالجة المسبقة للصور =============
+PREPROCESS_ENABLED = os.environ.get('PREPROCESS_ENABLED', '1') == '1'
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', '1600'))
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', '85'))
+AUTO_CROP = os.environ.get('AUTO_CROP', '0') == '1'
+
+class StageTimer:
+    """قياس زمن كل مرحلة من مراحل المعالجة وطباعته في السجل"""
+
+    def __init__(self, label):
+        self.label = label
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self.stages.append((name, duration))
+            STAGE_SECONDS.observe(duration, stage=name)
+
+    def report(self):
+        if not self.stages:
+            return
+        timings = " | ".join(f"{name}={duration * 1000:.0f}ms" for name, duration in self.stages)
+        total = sum(duration for _, duration in self.stages)
+        print(f"⏱️ {self.label}: {timings} | المجموع={total * 1000:.0f}ms")
+
+def detect_mime_type(image_bytes):
+    """تحديد نوع الصورة من بداية محتواها"""
+    if image_bytes.startswith(b'\x89PNG'):
+        return 'image/png'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    if image_bytes.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+def crop_to_document(image):
+    """قص الصورة إلى حدود الوثيقة (أكبر شكل واضح في الصورة)"""
+    import numpy as np
+    import cv2
+    
+    gray = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2GRAY)
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=2)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return image
+    
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    # تجاهل القص إذا كان الشكل صغيراً جداً (غالباً ليس الوثيقة)
+    if w * h < 0.2 * image.width * image.height:
+        return image
+    
+    margin = int(0.02 * max(w, h))
+    return image.crop((
+        max(0, x - margin),
+        max(0, y - margin),
+        min(image.width, x + w + margin),
+        min(image.height, y + h + margin)
+    ))
+
+def preprocess_image(image_bytes, max_side=None):
+    """
+    تجهيز الصورة قبل إرسالها للمحرك: تصحيح الاتجاه حسب EXIF، القص الاختياري،
+    تصغير أكبر ضلع ثم إعادة الترميز بصيغة JPEG
+    تعيد (البيانات، نوع الصورة)
+    """
+    original_mime = detect_mime_type(image_bytes)
+    if not PREPROCESS_ENABLED or not PIL_AVAILABLE:
+        return image_bytes, original_mime
+    
+    max_side = max_side or IMAGE_MAX_SIDE
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        original_size = image.size
+        transposed = image.getexif().get(0x0112, 1) != 1
+        image = ImageOps.exif_transpose(image)
+        
+        if AUTO_CROP and CV2_AVAILABLE:
+            image = crop_to_document(image)
+        
+        # الصور الشفافة (PNG) توضع على خلفية بيضاء
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+        
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        changed = transposed or image.size != original_size
+        
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+        processed = output.getvalue()
+        
+        # صورة JPEG صغيرة لم تتغير: إعادة الترميز لا توفر شيئاً
+        if original_mime == 'image/jpeg' and not changed and len(processed) >= len(image_bytes):
+            return image_bytes, original_mime
+        
+        print(
+            f"🖼️ المعالجة المسبقة: {original_size[0]}x{original_size[1]} → {image.width}x{image.height}, "
+            f"{len(image_bytes) // 1024}KB → {len(processed) // 1024}KB"
+        )
+        return processed, 'image/jpeg'
+        
+    except Exception as e:
+        print(f"⚠️ تعذرت المعالجة المسبقة للصورة: {e}")
+        return image_bytes, original_mime
+
+# ============= المسار السريع لمنطقة MRZ (الجوازات) =============
+# عند نجاح أرقام التحقق تُؤخذ البيانات من MRZ مباشرة دون استدعاء النماذج الكبيرة
+MRZ_FAST_PATH = os.environ.get('MRZ_FAST_PATH', '1') == '1'
+# مصدر النصوص العربية بعد نجاح MRZ: tesseract (محلي) | auto (ترتيب المحركات) | none
+MRZ_ARABIC_ENGINE = os.environ.get('MRZ_ARABIC_ENGINE', 'tesseract').lower()
+MRZ_OCR_CONFIG = '--psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<'
+MRZ_WEIGHTS = (7, 3, 1)
+# أخطاء OCR الشائعة في الحقول الرقمية
+MRZ_DIGIT_FIXES = str.maketrans('OQDIULZSBG', '0001112586')
+
+def is_mrz_available():
+    """المسار السريع يتطلب OpenCV لتحديد المنطقة و Tesseract لقراءتها"""
+    return MRZ_FAST_PATH and CV2_AVAILABLE and is_tesseract_available()
+
+def find_mrz_band(image_bytes):
+    """
+    تحديد شريط MRZ أسفل صفحة الجواز: عملية blackhat تُبرز النص الداكن على خلفية فاتحة،
+    ثم يُبحث عن منطقة عريضة منخفضة الارتفاع في النصف السفلي. تعيد صورة الشريط PNG أو None
+    """
+    import numpy as np
+    import cv2
+    
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    
+    scale = 600 / gray.shape[0]
+    small = cv2.resize(gray, (int(gray.shape[1] * scale), 600))
+    rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (13, 5))
+    square_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (21, 21))
+    
+    blackhat = cv2.morphologyEx(cv2.GaussianBlur(small, (3, 3), 0), cv2.MORPH_BLACKHAT, rect_kernel)
+    gradient = np.absolute(cv2.Sobel(blackhat, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=-1))
+    gradient = (255 * (gradient - gradient.min()) / (gradient.max() - gradient.min() + 1e-6)).astype('uint8')
+    gradient = cv2.morphologyEx(gradient, cv2.MORPH_CLOSE, rect_kernel)
+    mask = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    mask = cv2.erode(cv2.morphologyEx(mask, cv2.MORPH_CLOSE, square_kernel), None, iterations=4)
+    
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True):
+        x, y, w, h = cv2.boundingRect(contour)
+        if w / h > 5 and w > 0.6 * small.shape[1] and y + h / 2 > small.shape[0] / 2:
+            # إعادة الإحداثيات إلى الصورة الأصلية مع هامش صغير
+            pad = int(0.03 * w)
+            x0, y0 = max(0, int((x - pad) / scale)), max(0, int((y - pad) / scale))
+            x1, y1 = int((x + w + pad) / scale), int((y + h + pad) / scale)
+            ok, encoded = cv2.imencode('.png', gray[y0:y1, x0:x1])
+            return encoded.tobytes() if ok else None
+    return None
+
+def mrz_check_digit(data):
+    """رقم التحقق حسب ICAO 9303: الأرقام بقيمتها، A-Z من 10 إلى 35، '<' صفر، بأوزان 7 3 1"""
+    total = 0
+    for i, char in enumerate(data):
+        if char.isdigit():
+            value = int(char)
+        elif char.isalpha():
+            value = ord(char) - 55
+        else:
+            value = 0
+        total += value * MRZ_WEIGHTS[i % 3]
+    return str(total % 10)
+
+def _mrz_digits(text):
+    return text.translate(MRZ_DIGIT_FIXES)
+
+def _mrz_checks_pass(checks):
+    """كل (البيانات، رقم التحقق) يجب أن يتطابق؛ '<' في رقم التحقق تعني صفراً"""
+    return all(mrz_check_digit(data) == check.replace('<', '0') for data, check in checks)
+
+def _mrz_date(value, future=False):
+    """تحويل YYMMDD إلى YYYY-MM-DD (تواريخ الانتهاء في المستقبل والميلاد في الماضي)"""
+    year = int(value[:2])
+    current = datetime.now().year % 100
+    century = 2000 if future or year <= current else 1900
+    return f"{century + year}-{value[2:4]}-{value[4:6]}"
+
+def _mrz_names(field):
+    surname, _, given_names = field.partition('<<')
+    return surname.replace('<', ' ').strip(), given_names.replace('<', ' ').strip()
+
+def parse_mrz_td3(lines):
+    """جواز السفر (TD3): سطران بطول 44"""
+    line1, line2 = lines
+    number, number_check = line2[0:9], _mrz_digits(line2[9])
+    birth, birth_check = _mrz_digits(line2[13:19]), _mrz_digits(line2[19])
+    expiry, expiry_check = _mrz_digits(line2[21:27]), _mrz_digits(line2[27])
+    optional, optional_check = line2[28:42], _mrz_digits(line2[42])
+    composite = number + number_check + birth + birth_check + expiry + expiry_check + optional + optional_check
+    
+    if not _mrz_checks_pass([
+        (number, number_check), (birth, birth_check), (expiry, expiry_check),
+        (optional, optional_check), (composite, _mrz_digits(line2[43]))
+    ]):
+        return None
+    
+    # الأسطر تُحفظ بعد تصحيح الحقول الرقمية
+    line2 = (
+        number + number_check + line2[10:13] + birth + birth_check + line2[20]
+        + expiry + expiry_check + optional + optional_check + _mrz_digits(line2[43])
+    )
+    surname, given_names = _mrz_names(line1[5:])
+    return {
+        'format': 'TD3', 'document_type': line1[0:2].strip('<'), 'issuing_country': line1[2:5].strip('<'),
+        'document_number': number.strip('<'), 'nationality': line2[10:13].strip('<'),
+        'birth_date': birth, 'expiry_date': expiry, 'sex': line2[20].replace('<', ''),
+        'surname': surname, 'given_names': given_names, 'lines': [line1, line2]
+    }
+
+def parse_mrz_td1(lines):
+    """بطاقة الهوية (TD1): ثلاثة أسطر بطول 30"""
+    line1, line2, line3 = lines
+    number, number_check = line1[5:14], _mrz_digits(line1[14])
+    birth, birth_check = _mrz_digits(line2[0:6]), _mrz_digits(line2[6])
+    expiry, expiry_check = _mrz_digits(line2[8:14]), _mrz_digits(line2[14])
+    composite = number + number_check + line1[15:30] + birth + birth_check + expiry + expiry_check + line2[18:29]
+    
+    if not _mrz_checks_pass([
+        (number, number_check), (birth, birth_check), (expiry, expiry_check),
+        (composite, _mrz_digits(line2[29]))
+    ]):
+        return None
+    
+    line1 = line1[:14] + number_check + line1[15:]
+    line2 = birth + birth_check + line2[7] + expiry + expiry_check + line2[15:29] + _mrz_digits(line2[29])
+    surname, given_names = _mrz_names(line3)
+    return {
+        'format': 'TD1', 'document_type': line1[0:2].strip('<'), 'issuing_country': line1[2:5].strip('<'),
+        'document_number': number.strip('<'), 'nationality': line2[15:18].strip('<'),
+        'birth_date': birth, 'expiry_date': expiry, 'sex': line2[7].replace('<', ''),
+        'surname': surname, 'given_names': given_names, 'lines': [line1, line2, line3]
+    }
+
+MRZ_FORMATS = (('TD3', 2, 44, parse_mrz_td3), ('TD1', 3, 30, parse_mrz_td1))
+
+def parse_mrz(text):
+    """البحث في نص OCR عن MRZ صالح (كل أرقام التحقق صحيحة)، تعيد الحقول أو None"""
+    lines = [re.sub(r'[^A-Z0-9<]', '', line.upper()) for line in text.splitlines()]
+    lines = [line for line in lines if len(line) >= 28]
+    
+    for _, count, length, parser in MRZ_FORMATS:
+        for start in range(len(lines) - count + 1):
+            window = lines[start:start + count]
+            # فرق حرف أو حرفين في الطول شائع في OCR: يُكمل بـ '<' أو يُقص
+            if all(abs(len(line) - length) <= 2 for line in window):
+                parsed = parser([line[:length].ljust(length, '<') for line in window])
+                if parsed:
+                    return parsed
+    return None
+
+def build_mrz_result(mrz):
+    """تحويل حقول MRZ إلى نتيجة استخراج بالشكل المعتاد"""
+    name = f"{mrz['given_names']} {mrz['surname']}".strip()
+    return {
+        'name': name,
+        'arabic_texts': [],
+        'english_texts': [
+            f"Surname: {mrz['surname']}",
+            f"Given names: {mrz['given_names']}",
+            f"Nationality: {mrz['nationality']}",
+            f"Sex: {mrz['sex']}",
+            f"Document number: {mrz['document_number']}"
+        ],
+        'fields': {
+            'document_number': mrz['document_number'],
+            'dates': [
+                {'label': 'تاريخ الميلاد', 'value': _mrz_date(mrz['birth_date'])},
+                {'label': 'تاريخ الانتهاء', 'value': _mrz_date(mrz['expiry_date'], future=True)}
+            ],
+            'mrz': mrz['lines']
+        },
+        'engine': 'tesseract'
+    }
+
+def extract_arabic_after_mrz(image_bytes, mime_type):
+    """النصوص العربية المتبقية بعد MRZ: Tesseract المحلي افتراضياً، أو سلسلة المحركات عند الطلب"""
+    if MRZ_ARABIC_ENGINE == 'none':
+        return []
+    if MRZ_ARABIC_ENGINE == 'auto':
+        return extract_text_from_image(image_bytes, mime_type)['arabic_texts']
+    
+    future = get_tesseract_pool().submit(run_tesseract, image_bytes, 'ara')
+    return parse_ocr_text(future.result(timeout=TESSERACT_TIMEOUT))['arabic_texts']
+
+def extract_mrz_fast_path(image_bytes, mime_type='image/jpeg'):
+    """
+    محاولة استخراج بيانات الجواز من MRZ محلياً
+    تعيد نتيجة كاملة عند صحة أرقام التحقق، أو None للرجوع إلى المحركات المعتادة
+    """
+    if not is_mrz_available():
+        return None
+    
+    try:
+        band = find_mrz_band(image_bytes)
+        if band is None:
+            return None
+        
+        future = get_tesseract_pool().submit(run_tesseract, band, 'eng', MRZ_OCR_CONFIG)
+        mrz = parse_mrz(future.result(timeout=TESSERACT_TIMEOUT))
+        if mrz is None:
+            return None
+        
+        print(f"🛂 تم التحقق من MRZ ({mrz['format']}): تخطي النماذج الكبيرة")
+        result = build_mrz_result(mrz)
+        result['arabic_texts'] = extract_arabic_after_mrz(image_bytes, mime_type)
+        return result
+    except Exception as e:
+        print(f"⚠️ تعذر المسار السريع لـ MRZ: {e}")
+        return None
+
+# ============= ذاكرة تخزين نتائج الاستخراج =============
+CACHE_TTL = int(os.environ.get('CACHE_TTL', str(24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '1000'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory').lower()  # memory | sqlite
+CACHE_PATH = os.environ.get('CACHE_PATH', 'extraction_cache.db')
+
+class ExtractionCache:
+    """
+    ذاكرة LRU لنتائج الاستخراج مع مدة صلاحية وحد للحجم
+    مع تخزين اختياري على القرص (SQLite) للاحتفاظ بالنتائج بعد إعادة التشغيل
+    """
+
+    def __init__(self, ttl, max_entries, max_bytes, db_path=None):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self._entries = OrderedDict()  # key -> (expires_at, size, result)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS extraction_cache ("
+                "key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM extraction_cache WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+    def get(self, key):
+        """البحث عن نتيجة محفوظة (None إذا لم توجد أو انتهت صلاحيتها)"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, _, result = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                self._remove(key)
+            
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, expires_at FROM extraction_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    result = json.loads(row[0])
+                    self._store(key, result, row[1])
+                    self.hits += 1
+                    return result
+            
+            self.misses += 1
+            return None
+
+    def set(self, key, result):
+        """حفظ نتيجة استخراج"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, result, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO extraction_cache (key, result, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(result, ensure_ascii=False), expires_at)
+                )
+                self._db.commit()
+
+    def _store(self, key, result, expires_at):
+        """إضافة عنصر للذاكرة مع إخراج الأقدم استخداماً عند تجاوز الحدود"""
+        if key in self._entries:
+            self._remove(key)
+        
+        size = len(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+        self._entries[key] = (expires_at, size, result)
+        self._bytes += size
+        
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """إحصائيات الذاكرة"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'backend': 'sqlite' if self._db is not None else 'memory'
+            }
+
+def cache_key_for_file(file_unique_id):
+    """مفتاح الذاكرة حسب المعرف الفريد للملف في تيليجرام"""
+    return f"file:{file_unique_id}"
+
+def cache_key_for_content(image_bytes):
+    """مفتاح الذاكرة حسب بصمة محتوى الصورة"""
+    return f"sha256:{hashlib.sha256(image_bytes).hexdigest()}"
+
+def cache_key_for_album(file_unique_ids):
+    """مفتاح الذاكرة لألبوم صور حسب معرفات ملفاته (بنفس الترتيب)"""
+    return f"album:{hashlib.sha256('|'.join(file_unique_ids).encode()).hexdigest()}"
+
+# ============= الصور شبه المطابقة (البصمة الإدراكية) =============
+# الصورة نفسها بعد إعادة الضغط أو التصغير (أو المرسلة كصورة ثم كملف) تختلف بايتاتها
+# لكن بصمتها الإدراكية متقاربة: تُعاد نتيجتها المحفوظة بدل استدعاء المحرك مرة أخرى.
+# البحث محصور في صور المستخدم نفسه حتى لا تظهر بيانات وثيقة لمستخدم آخر
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', '6'))  # من 64 بت، 0 = تعطيل
+# تأكيد ثانٍ ببصمة أدق (256 بت) لأن وثائق القالب نفسه تتشابه في البصمة الخشنة
+PHASH_VERIFY_DISTANCE = int(os.environ.get('PHASH_VERIFY_DISTANCE', '24'))
+PHASH_MAX_PER_USER = int(os.environ.get('PHASH_MAX_PER_USER', '200'))
+PHASH_MAX_USERS = int(os.environ.get('PHASH_MAX_USERS', '5000'))
+PHASH_DCT_SIZE = 32
+
+def hamming_distance(a, b):
+    """عدد البتات المختلفة بين بصمتين"""
+    return bin(a ^ b).count('1')
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+def _dct_matrix(size):
+    """مصفوفة DCT-II (تُحسب مرة واحدة) لحساب pHash بضرب المصفوفات"""
+    import numpy as np
+    k = np.arange(size).reshape(-1, 1)
+    n = np.arange(size).reshape(1, -1)
+    return np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+
+_DCT_MATRICES = {}
+
+def compute_phash(gray):
+    """pHash بطول 64 بت: معاملات DCT منخفضة التردد لصورة 32x32 مقارنة بوسيطها"""
+    import numpy as np
+    if PHASH_DCT_SIZE not in _DCT_MATRICES:
+        _DCT_MATRICES[PHASH_DCT_SIZE] = _dct_matrix(PHASH_DCT_SIZE)
+    matrix = _DCT_MATRICES[PHASH_DCT_SIZE]
+    
+    pixels = np.asarray(gray.resize((PHASH_DCT_SIZE, PHASH_DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (matrix @ pixels @ matrix.T)[:8, :8].flatten()
+    # معامل DC يمثل متوسط الإضاءة فقط فيُستبعد من حساب الوسيط
+    return _bits_to_int(low > np.median(low[1:]))
+
+def compute_dhash(gray, size=8):
+    """dHash بطول size² بت: اتجاه تغير الإضاءة بين كل بكسلين متجاورين أفقياً"""
+    pixels = list(gray.resize((size + 1, size), Image.LANCZOS).getdata())
+    return _bits_to_int(
+        pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1]
+        for row in range(size) for col in range(size)
+    )
+
+def perceptual_hashes(image_bytes):
+    """
+    بصمتا الصورة الإدراكيتان (الخشنة 64 بت للبحث، والدقيقة 256 بت للتأكيد)
+    تعيد None إذا كانت الميزة معطلة أو تعذرت قراءة الصورة
+    البصمة الخشنة pHash دائماً (تتطلب NumPy): خلط نوعي بصمة في فهرس واحد يجعل المسافات بلا معنى
+    """
+    if PHASH_MAX_DISTANCE <= 0 or not PIL_AVAILABLE or not NUMPY_AVAILABLE:
+        return None
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        # فك JPEG بدقة مخفضة مباشرة: لا حاجة للصورة الكاملة لبصمة 32x32
+        image.draft('L', (PHASH_DCT_SIZE * 4, PHASH_DCT_SIZE * 4))
+        gray = ImageOps.exif_transpose(image).convert('L')
+        return compute_phash(gray), compute_dhash(gray, 16)
+    except Exception as e:
+        print(f"⚠️ تعذر حساب بصمة الصورة: {e}")
+        return None
+
+class BKTree:
+    """
+    شجرة BK لمسافة Hamming: كل ابن مفهرس بمسافته عن أبيه، فيكفي عند البحث
+    زيارة الأبناء ضمن [d - max_distance, d + max_distance] (متباينة المثلث)
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, hash_value, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [hash_value, [item], {}]
+            return
+        
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [item], {}]
+                return
+            node = child
+
+    def search(self, hash_value, max_distance):
+        """كل العناصر ضمن المسافة المحددة: قائمة (المسافة، العنصر) مرتبة من الأقرب"""
+        found = []
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    pending.append(child)
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+class SimilarImageIndex:
+    """
+    فهرس البصمات لكل مستخدم: شجرة BK للبحث السريع، وقائمة بترتيب الإضافة لإخراج الأقدم
+    (شجرة BK لا تدعم الحذف فتُبنى من جديد، لذا يُسمح بتجاوز الحد بدفعة كاملة
+    ثم يُخرج الأقدم دفعة واحدة: إعادة بناء واحدة لكل دفعة بدلاً من كل إضافة)
+    """
+
+    def __init__(self, max_users, max_per_user):
+        self.max_users = max(1, max_users)
+        self.max_per_user = max(1, max_per_user)
+        self.evict_batch = max(1, self.max_per_user // 4)
+        self._users = OrderedDict()  # user_id -> (BKTree, deque[(coarse, fine, key)])
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def add(self, user_id, hashes, key):
+        coarse, fine = hashes
+        with self._lock:
+            if user_id in self._users:
+                self._users.move_to_end(user_id)
+                tree, entries = self._users[user_id]
+            else:
+                tree, entries = self._users[user_id] = (BKTree(), deque())
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            
+            entries.append((coarse, fine, key))
+            if len(entries) <= self.max_per_user + self.evict_batch:
+                tree.add(coarse, (fine, key))
+                return
+            
+            while len(entries) > self.max_per_user:
+                entries.popleft()
+            tree = BKTree()
+            for entry_coarse, entry_fine, entry_key in entries:
+                tree.add(entry_coarse, (entry_fine, entry_key))
+            self._users[user_id] = (tree, entries)
+
+    def find(self, user_id, hashes, max_distance, verify_distance):
+        """مفاتيح الذاكرة لصور المستخدم القريبة التي تجتاز التأكيد بالبصمة الدقيقة، الأقرب أولاً"""
+        coarse, fine = hashes
+        with self._lock:
+            if user_id not in self._users:
+                return []
+            tree, _ = self._users[user_id]
+            candidates = tree.search(coarse, max_distance)
+        return [
+            key for _, (candidate_fine, key) in candidates
+            if hamming_distance(fine, candidate_fine) <= verify_distance
+        ]
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+        SIMILAR_IMAGE_HITS.inc()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'entries': sum(tree.size for tree, _ in self._users.values()),
+                'hits': self.hits
+            }
+
+def find_similar_result(hashes):
+    """نتيجة محفوظة لصورة شبه مطابقة أرسلها المستخدم الحالي، أو None"""
+    user_id = CURRENT_USER.get()
+    if hashes is None or user_id is None:
+        return None
+    
+    for key in SIMILAR_IMAGES.find(user_id, hashes, PHASH_MAX_DISTANCE, PHASH_VERIFY_DISTANCE):
+        result = EXTRACTION_CACHE.get(key)
+        if result is not None:
+            SIMILAR_IMAGES.record_hit()
+            print("🪞 صورة شبه مطابقة لصورة سابقة: إعادة استخدام نتيجتها")
+            return result
+    return None
+
+def remember_similar_image(hashes, content_key):
+    """إضافة بصمة صورة استُخرجت نصوصها إلى فهرس المستخدم الحالي"""
+    user_id = CURRENT_USER.get()
+    if hashes is not None and user_id is not None:
+        SIMILAR_IMAGES.add(user_id, hashes, content_key)
+
+def extract_text_cached(image_bytes, file_key=None, timer=None, similar=True):
+    """
+    استخراج النصوص مع البحث أولاً في الذاكرة حسب بصمة المحتوى ثم البصمة الإدراكية
+    (similar=False للمعالجة الجماعية: ملفاتها وثائق مختلفة غالباً من القالب نفسه)
+    """
+    timer = timer or StageTimer("استخراج")
+    content_key = cache_key_for_content(image_bytes)
+    result = EXTRACTION_CACHE.get(content_key)
+    
+    if result is None:
+        hashes = None
+        if similar:
+            with timer.stage('phash'):
+                hashes = perceptual_hashes(image_bytes)
+            result = find_similar_result(hashes)
+    
+    if result is None:
+        with timer.stage('preprocess'):
+            prepared_bytes, mime_type = preprocess_image(image_bytes)
+        with timer.stage('mrz'):
+            result = extract_mrz_fast_path(prepared_bytes, mime_type)
+        if result is None:
+            with timer.stage('extract'):
+                result = extract_text_from_image(prepared_bytes, mime_type)
+        if not has_extracted_text(result):
+            return result
+        EXTRACTION_CACHE.set(content_key, result)
+        remember_similar_image(hashes, content_key)
+    
+    if file_key:
+        EXTRACTION_CACHE.set(file_key, result)
+    return result
+
+# النسخة الدائمة (CACHE_BACKEND=sqlite) تُفتح في open_stores() عند التشغيل
+EXTRACTION_CACHE = ExtractionCache(CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+SIMILAR_IMAGES = SimilarImageIndex(PHASH_MAX_USERS, PHASH_MAX_PER_USER)
+# نتائج getFile (مسار الملف وحجمه) حسب file_unique_id: روابط تيليجرام صالحة لساعة على الأقل
+FILE_INFO_TTL = int(os.environ.get('FILE_INFO_TTL', '3000'))
+FILE_INFO_CACHE = ExtractionCache(FILE_INFO_TTL, 5000, 1024 * 1024)
+
+# ============= وظائف إنشاء البيانات =============
+def generate_email(name):
+    """إنشاء بريد إلكتروني من الاسم"""
+    if not name or name.strip() == "":
+        name = "user"
+    
+    # تحويل الاسم العربي إلى حروف لاتينية
+    latin_name = transliterate_name(name)
+    
+    if len(latin_name) < 3:
+        latin_name = f"user{random.randint(1000, 9999)}"
+    
+    # خيارات النطاقات
+    domains = [
+        "idcard.me", "official-id.com", "passport.info",
+        "verify.id", "document.space", "identity.pro"
+    ]
+    
+    domain = random.choice(domains)
+    email = f"{latin_name}@{domain}"
+    
+    return email
+
+def generate_password():
+    """إنشاء كلمة مرور قوية"""
+    # يجب أن تحتوي على حرف كبير، صغير، رقم ورمز
+    uppercase = random.choice(string.ascii_uppercase)
+    lowercase = random.choice(string.ascii_lowercase)
+    digit = random.choice(string.digits)
+    symbol = random.choice("!@#$%^&*")
+    
+    # باقي الأحرف
+    all_chars = string.ascii_letters + string.digits + "!@#$%^&*"
+    remaining = ''.join(random.choice(all_chars) for _ in range(8))
+    
+    # دمج وخلط
+    password = uppercase + lowercase + digit + symbol + remaining
+    password_list = list(password)
+    random.shuffle(password_list)
+    
+    return ''.join(password_list)
+
+# ============= وظائف إنشاء الملفات =============
+def format_structured_fields(fields):
+    """قسم البيانات المنظمة (رقم الوثيقة، التواريخ، MRZ) في الملف النصي"""
+    content = "📑 **البيانات المنظمة:**\n"
+    content += "-" * 40 + "\n"
+    if fields.get('document_number'):
+        content += f"🆔 رقم الوثيقة: {fields['document_number']}\n"
+    for date in fields.get('dates', []):
+        content += f"📅 {date['label'] or 'تاريخ'}: {date['value']}\n"
+    if fields.get('mrz'):
+        content += "🔢 MRZ:\n"
+        for line in fields['mrz']:
+            content += f"    {line}\n"
+    return content + "\n" + "=" * 60 + "\n\n"
+
+def create_text_file_content(name, arabic_texts, english_texts, email, password, platform, engine_label=None, fields=None):
+    """إنشاء محتوى الملف النصي"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    content = "=" * 60 + "\n"
+    content += "📄 المعلومات المستخرجة من الوثيقة\n"
+    content += "=" * 60 + "\n\n"
+    
+    if name:
+        content += f"👤 **اسم الشخص:** {name}\n\n"
+    
+    content += "🔤 **النصوص العربية المستخرجة:**\n"
+    content += "-" * 40 + "\n"
+    if arabic_texts:
+        for i, text in enumerate(arabic_texts, 1):
+            content += f"{i:02d}. {text}\n"
+    else:
+        content += "❌ لم يتم العثور على نصوص عربية\n"
+    
+    content += "\n" + "=" * 60 + "\n\n"
+    
+    content += "🔤 **النصوص الإنجليزية المستخرجة:**\n"
+    content += "-" * 40 + "\n"
+    if english_texts:
+        for i, text in enumerate(english_texts, 1):
+            content += f"{i:02d}. {text}\n"
+    else:
+        content += "❌ لم يتم العثور على نصوص إنجليزية\n"
+    
+    content += "\n" + "=" * 60 + "\n\n"
+    
+    if fields:
+        content += format_structured_fields(fields)
+    
+    content += "📧 **بيانات الدخول المنشأة تلقائياً:**\n"
+    content += "-" * 40 + "\n"
+    content += f"📧 البريد الإلكتروني: {email}\n"
+    content += f"🔐 كلمة المرور: {password}\n\n"
+    
+    content += "=" * 60 + "\n"
+    content += f"📅 تاريخ الإستخراج: {timestamp}\n"
+    content += f"🌐 المنصة المستخدمة: {platform}\n"
+    content += f"🤖 المحرك: {engine_label or get_engine_label()}\n"
+    content += "=" * 60 + "\n"
+    
+    return content
+
+def create_filename(name):
+    """إنشاء اسم للملف"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if name and name != "مستخدم":
+        safe_name = re.sub(r'[^\w\s]', '', name)
+        safe_name = safe_name.strip().replace(' ', '_')[:20]
+        return f"معلومات_{safe_name}_{timestamp}.txt"
+    return f"معلومات_{timestamp}.txt"
+
+# ============= طابور مهام الاستخراج =============
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', '4'))
+EXTRACTION_QUEUE_SIZE = int(os.environ.get('EXTRACTION_QUEUE_SIZE', '50'))
+# حدود كل مستخدم: مهام منتظرة وقيد التنفيذ، وعدد الملفات في نافذة زمنية منزلقة
+USER_MAX_INFLIGHT = int(os.environ.get('USER_MAX_INFLIGHT', '3'))
+USER_RATE_LIMIT = int(os.environ.get('USER_RATE_LIMIT', '20'))
+USER_RATE_WINDOW = float(os.environ.get('USER_RATE_WINDOW', '60'))
+# رسالة الرفض تُرسل مرة واحدة على الأكثر خلال هذه المدة لكل مستخدم
+REJECTION_NOTICE_INTERVAL = 10
+
+def get_job_user(args):
+    """صاحب المهمة: مستخدم أول رسالة في معاملاتها (رسالة أو قائمة رسائل ألبوم)"""
+    message = args[0][0] if isinstance(args[0], list) else args[0]
+    return str(message.from_user.id)
+
+class ExtractionQueue:
+    """
+    طابور مهام الاستخراج مع مجموعة عمال محدودة العدد
+    لكل مستخدم طابوره، والعمال يتناوبون بين المستخدمين حتى لا يؤخر مستخدم بعشرات الصور الآخرين
+    """
+
+    def __init__(self, workers, max_size):
+        self.workers = max(1, workers)
+        self.max_size = max(1, max_size)
+        self._users = {}
+        self._ready = deque()
+        self._inflight = {}
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._busy = 0
+        self._processed = 0
+        self._rejected = 0
+        self._wait_times = deque(maxlen=200)
+
+    def _ensure_started(self):
+        """تشغيل العمال عند أول مهمة"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name=f"extraction-worker-{i + 1}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        """
+        إضافة مهمة إلى طابور صاحبها
+        تعيد ترتيب المهمة في الانتظار (0 = ستبدأ فوراً) أو None إذا كان الطابور ممتلئاً
+        """
+        user_id = get_job_user(args)
+        with self._cond:
+            self._ensure_started()
+            if self._depth >= self.max_size:
+                self._rejected += 1
+                return None
+
+            if user_id not in self._users:
+                self._users[user_id] = deque()
+                self._ready.append(user_id)
+            self._users[user_id].append((time.monotonic(), func, args))
+            self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+            self._depth += 1
+            self._cond.notify()
+
+            idle_workers = self.workers - self._busy
+            return max(0, self._depth - idle_workers)
+
+    def user_inflight(self, user_id):
+        """مهام المستخدم المنتظرة وقيد التنفيذ"""
+        with self._cond:
+            return self._inflight.get(user_id, 0)
+
+    def _next_job(self):
+        """مهمة أول مستخدم في الدور، ثم ينتقل المستخدم إلى آخر الدور إن بقيت له مهام"""
+        user_id = self._ready.popleft()
+        jobs = self._users[user_id]
+        job = jobs.popleft()
+        if jobs:
+            self._ready.append(user_id)
+        else:
+            del self._users[user_id]
+        self._depth -= 1
+        return user_id, job
+
+    def _worker_loop(self):
+        """حلقة العامل: سحب المهام بالتناوب وتنفيذها"""
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                user_id, (enqueued_at, func, args) = self._next_job()
+                self._busy += 1
+                self._wait_times.append(time.monotonic() - enqueued_at)
+
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"❌ خطأ في مهمة الاستخراج: {e}")
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._processed += 1
+                    self._inflight[user_id] -= 1
+                    if not self._inflight[user_id]:
+                        del self._inflight[user_id]
+
+    def stats(self):
+        """إحصائيات الطابور: العمق وزمن الانتظار"""
+        with self._cond:
+            waits = list(self._wait_times)
+            return {
+                'depth': self._depth,
+                'users': len(self._users),
+                'busy': self._busy,
+                'workers': self.workers,
+                'max_size': self.max_size,
+                'processed': self._processed,
+                'rejected': self._rejected,
+                'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+                'max_wait': max(waits) if waits else 0.0
+            }
+
+EXTRACTION_QUEUE = ExtractionQueue(EXTRACTION_WORKERS, EXTRACTION_QUEUE_SIZE)
+
+# ============= طابور الرسائل الصادرة =============
+# حدود تيليجرام: ~30 رسالة في الثانية إجمالاً و ~1 رسالة في الثانية لكل محادثة
+OUTGOING_RATE = float(os.environ.get('OUTGOING_RATE', '25'))
+OUTGOING_CHAT_INTERVAL = float(os.environ.get('OUTGOING_CHAT_INTERVAL', '1'))
+OUTGOING_WORKERS = int(os.environ.get('OUTGOING_WORKERS', '8'))
+OUTGOING_MAX_RETRIES = int(os.environ.get('OUTGOING_MAX_RETRIES', '3'))
+
+def get_retry_after(error):
+    """مدة الانتظار التي يطلبها تيليجرام في خطأ 429، أو None لباقي الأخطاء"""
+    if isinstance(error, ApiTelegramException) and error.error_code == 429:
+        parameters = (error.result_json or {}).get('parameters') or {}
+        return float(parameters.get('retry_after', 1))
+    return None
+
+class OutboundDispatcher:
+    """
+    موزع مركزي لكل استدعاءات الإرسال إلى تيليجرام:
+    طابور لكل محادثة مع تناوب عادل بين المحادثات، دلو رموز عام،
+    فاصل أدنى بين رسائل المحادثة الواحدة، واحترام retry_after عند الخطأ 429
+    """
+
+    def __init__(self, rate, chat_interval, workers):
+        self.chat_interval = chat_interval
+        self.workers = max(1, workers)
+        # 0 = بدون حد عام (يبقى فاصل المحادثة واحترام 429)
+        self._bucket = TokenBucket(rate, rate) if rate > 0 else None
+        self._chats = {}
+        self._ready = deque()
+        self._next_at = {}
+        self._cond = threading.Condition()
+        self._pool = None
+        self._latency = EngineStats(ENGINE_STATS_WINDOW)
+        self._sent = 0
+        self._failed = 0
+        self._throttled = 0
+
+    def _ensure_started(self):
+        """تشغيل خيط الجدولة ومجموعة الإرسال عند أول رسالة"""
+        if self._pool is not None:
+            return
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox')
+        threading.Thread(target=self._schedule_loop, name='outbox-scheduler', daemon=True).start()
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """إضافة استدعاء إلى طابور المحادثة، تعيد Future بنتيجته"""
+        future = Future()
+        with self._cond:
+            self._ensure_started()
+            if chat_id not in self._chats:
+                self._chats[chat_id] = deque()
+                self._ready.append(chat_id)
+            self._chats[chat_id].append((time.monotonic(), future, func, args, kwargs, 0))
+            self._cond.notify()
+        return future
+
+    def _next_job(self):
+        """
+        اختيار المهمة التالية بالتناوب: أول محادثة انتهى فاصلها الزمني ويتوفر لها رمز عام
+        تعيد (المحادثة، المهمة) أو مدة الانتظار قبل المحاولة التالية
+        """
+        now = time.monotonic()
+        wait_time = None
+        for chat_id in self._ready:
+            chat_wait = self._next_at.get(chat_id, 0.0) - now
+            if chat_wait > 0:
+                wait_time = chat_wait if wait_time is None else min(wait_time, chat_wait)
+                continue
+            
+            token_wait = self._bucket.try_acquire() if self._bucket is not None else 0.0
+            if token_wait:
+                return None, token_wait
+            
+            # المحادثة تخرج من التناوب حتى ينتهي إرسالها الحالي (للحفاظ على الترتيب)
+            self._ready.remove(chat_id)
+            return (chat_id, self._chats[chat_id].popleft()), None
+        return None, wait_time
+
+    def _schedule_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    picked, wait_time = self._next_job()
+                    if picked:
+                        break
+                    self._cond.wait(wait_time)
+            self._pool.submit(self._run, *picked)
+
+    def _run(self, chat_id, job):
+        enqueued_at, future, func, args, kwargs, attempts = job
+        if attempts == 0:
+            self._latency.record(time.monotonic() - enqueued_at, True)
+            OUTGOING_WAIT.observe(time.monotonic() - enqueued_at)
+            if not future.set_running_or_notify_cancel():
+                self._release(chat_id)
+                return
+        
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None and attempts < OUTGOING_MAX_RETRIES:
+                print(f"⏳ تيليجرام طلب الانتظار {retry_after:.0f} ث للمحادثة {chat_id}")
+                OUTGOING_REQUESTS.inc(outcome='throttled')
+                with self._cond:
+                    self._throttled += 1
+                    self._chats[chat_id].appendleft((enqueued_at, future, func, args, kwargs, attempts + 1))
+                self._release(chat_id, retry_after)
+                return
+            OUTGOING_REQUESTS.inc(outcome='failed')
+            with self._cond:
+                self._failed += 1
+            print(f"❌ فشل الإرسال إلى المحادثة {chat_id}: {e}")
+            future.set_exception(e)
+        else:
+            OUTGOING_REQUESTS.inc(outcome='sent')
+            with self._cond:
+                self._sent += 1
+            future.set_result(result)
+        self._release(chat_id)
+
+    def _release(self, chat_id, delay=None):
+        """انتهاء إرسال المحادثة: تحديد موعد رسالتها التالية وإعادتها إلى التناوب"""
+        with self._cond:
+            now = time.monotonic()
+            self._next_at[chat_id] = now + (self.chat_interval if delay is None else delay)
+            if self._chats[chat_id]:
+                self._ready.append(chat_id)
+            else:
+                del self._chats[chat_id]
+                # تنظيف مواعيد المحادثات الخاملة
+                if len(self._next_at) > 1000:
+                    self._next_at = {
+                        chat: at for chat, at in self._next_at.items()
+                        if at > now or chat in self._chats
+                    }
+            self._cond.notify()
+
+    # واجهات مطابقة لدوال البوت
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.submit(message.chat.id, bot.reply_to, message, text, **kwargs)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self.submit(chat_id, bot.send_document, chat_id, document, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(chat_id, bot.edit_message_text, text, chat_id=chat_id, message_id=message_id, **kwargs)
+
+    def delete_message(self, chat_id, message_id):
+        return self.submit(chat_id, bot.delete_message, chat_id, message_id)
+
+    def stats(self):
+        """إحصائيات الطابور الصادر: العمق وزمن الانتظار والأخطاء"""
+        with self._cond:
+            depth = sum(len(jobs) for jobs in self._chats.values())
+            stats = {
+                'depth': depth,
+                'chats': len(self._chats),
+                'sent': self._sent,
+                'failed': self._failed,
+                'throttled': self._throttled
+            }
+        stats['p50_wait'] = self._latency.percentile(50) or 0.0
+        stats['p95_wait'] = self._latency.percentile(95) or 0.0
+        return stats
+
+OUTBOX = OutboundDispatcher(OUTGOING_RATE, OUTGOING_CHAT_INTERVAL, OUTGOING_WORKERS)
+
+# ============= رسائل التقدم المدمجة =============
+# لا تظهر المرحلة إلا إذا استمرت أكثر من PROGRESS_THRESHOLD (المراحل السريعة تُتخطى)،
+# وبين كل تعديلين PROGRESS_MIN_INTERVAL على الأقل
+PROGRESS_THRESHOLD = float(os.environ.get('PROGRESS_THRESHOLD', '1.5'))
+PROGRESS_MIN_INTERVAL = float(os.environ.get('PROGRESS_MIN_INTERVAL', '3'))
+# ميزانية عامة لرسائل التقدم في الثانية (أقل من حد تيليجرام ~30 رسالة/ثانية)، 0 = بدون حد
+PROGRESS_RATE = float(os.environ.get('PROGRESS_RATE', '20'))
+PROGRESS_BUDGET = TokenBucket(PROGRESS_RATE, PROGRESS_RATE) if PROGRESS_RATE > 0 else None
+
+class ProgressReporter:
+    """
+    رسالة حالة واحدة لكل مهمة مع دمج التحديثات:
+    يُحتفظ بآخر نص فقط ويُرسل بعد انقضاء المهلة، فلا تكلف المراحل السريعة أي طلب
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.status_msg = None
+        self._pending = None
+        self._shown = None
+        self._pending_since = 0.0
+        self._next_at = 0.0
+        self._timer = None
+        self._closed = False
+        # _lock يحمي الحالة فقط ولا يُمسك أثناء طلبات Bot API، فلا ينتظر update() الشبكة
+        self._lock = threading.Lock()
+        # _send_lock يرتب الإرسال: الرسالة النهائية لا تسبق إرسال حالة جارٍ
+        self._send_lock = threading.Lock()
+
+    def update(self, text):
+        """تسجيل حالة جديدة؛ الإرسال يتم لاحقاً في خيط المؤقت دون حجز العامل"""
+        with self._lock:
+            if self._closed:
+                return
+            self._pending = text
+            self._pending_since = time.monotonic()
+            if self._timer is None:
+                self._schedule(self._flush_delay())
+
+    def _flush_delay(self):
+        """المدة المتبقية حتى يُسمح بإظهار آخر حالة"""
+        now = time.monotonic()
+        return max(self._pending_since + PROGRESS_THRESHOLD, self._next_at) - now
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(max(0.0, delay), self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._closed or self._pending is None or self._pending == self._shown:
+                return
+            # تغيرت المرحلة أثناء الانتظار: تُمنح المرحلة الجديدة مهلتها كاملة
+            if self._flush_delay() > 0:
+                self._schedule(self._flush_delay())
+                return
+
+            # رسائل التقدم غير ضرورية: عند نفاد الميزانية تؤجل بدلاً من إرسالها
+            wait_time = PROGRESS_BUDGET.try_acquire() if PROGRESS_BUDGET is not None else 0.0
+            if wait_time:
+                self._schedule(max(wait_time, PROGRESS_MIN_INTERVAL))
+                return
+            text = self._pending
+            self._next_at = time.monotonic() + PROGRESS_MIN_INTERVAL
+
+        with self._send_lock:
+            # انتهت المهمة أثناء انتظار الإرسال السابق: الرسالة النهائية تكفي
+            if self._closed:
+                return
+            try:
+                self._show(text)
+            except Exception as e:
+                print(f"⚠️ تعذر تحديث رسالة الحالة: {e}")
+
+    def _show(self, text):
+        """إرسال رسالة الحالة أو تعديلها"""
+        if self.status_msg is None:
+            self.status_msg = OUTBOX.reply_to(self.message, text, parse_mode='Markdown').result()
+        else:
+            OUTBOX.edit_message_text(
+                text,
+                chat_id=self.status_msg.chat.id,
+                message_id=self.status_msg.message_id,
+                parse_mode='Markdown'
+            ).result()
+        self._shown = text
+
+    def _close(self):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def fail(self, text):
+        """نص نهائي (خطأ): تعديل رسالة الحالة إن ظهرت وإلا الرد مباشرة"""
+        self._close()
+        with self._send_lock:
+            self._show(text)
+
+    def finish(self):
+        """انتهاء المهمة بنجاح: حذف رسالة الحالة فقط إن كانت قد أُرسلت"""
+        self._close()
+        with self._send_lock:
+            if self.status_msg is not None:
+                OUTBOX.delete_message(
+                    chat_id=self.status_msg.chat.id,
+                    message_id=self.status_msg.message_id
+                )
+
+# ============= معالجات البوت =============
+@bot.message_handler(commands=['start', 'help', 'ابدأ'])
+def handle_start(message):
+    """معالجة أمر /start"""
+    try:
+        user = message.from_user
+        user_id = str(user.id)
+        
+        # حفظ معلومات المستخدم
+        USER_STORE.register_user(user_id, {
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name
+        })
+        
+        # رسالة الترحيب
+        welcome_text = f"""
+🌟 أهلاً بك {user.first_name}! 
+
+🤖 **بوت استخراج النصوص من البطاقة والجواز**
+
+✨ **المميزات:**
+✅ استخراج تلقائي للنصوص العربية والإنجليزية
+✅ إنشاء بريد إلكتروني من الاسم
+✅ توليد كلمة مرور قوية
+✅ حفظ النتائج في ملف نصي
+✅ دعم الذكاء الاصطناعي (Gemini AI)
+
+📸 **كيفية الاستخدام:**
+1. أرسل صورة البطاقة أو الجواز
+2. انتظر قليلاً للمعالجة
+3. استلم الملف مع جميع المعلومات
+
+⚡ **الآن:** أرسل صورة مباشرة أو استخدم الأزرار!
+"""
+        
+        # إنشاء لوحة المفاتيح
+        keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+        keyboard.add(
             KeyboardButton("📸 إرسال صورة"),
             KeyboardButton("ℹ️ معلومات"),
             KeyboardButton("📊 إحصائيات"),
@@ -472,7 +2923,7 @@ def handle_start(message):
         )
         
         # إرسال الرسالة مع الأزرار
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             welcome_text,
             reply_markup=keyboard,
@@ -480,7 +2931,7 @@ def handle_start(message):
         )
         
         # إرسال صورة توضيحية
-        bot.send_message(
+        OUTBOX.send_message(
             message.chat.id,
             "💡 *نصائح للحصول على أفضل نتيجة:*\n"
             "• التقط الصورة بإضاءة جيدة\n"
@@ -492,12 +2943,12 @@ def handle_start(message):
         
     except Exception as e:
         print(f"❌ خطأ في أمر start: {e}")
-        bot.reply_to(message, "❌ حدث خطأ في معالجة الأمر. حاول مرة أخرى.")
+        OUTBOX.reply_to(message, "❌ حدث خطأ في معالجة الأمر. حاول مرة أخرى.")
 
 @bot.message_handler(func=lambda message: message.text == "📸 إرسال صورة")
 def handle_send_photo_button(message):
     """معالجة زر إرسال صورة"""
-    bot.reply_to(
+    OUTBOX.reply_to(
         message,
         "📸 **جاهز لاستقبال الصورة!**\n\n"
         "الرجاء إرسال صورة البطاقة أو الجواز الآن.\n"
@@ -513,9 +2964,9 @@ def handle_info_button(message):
 
 🛠 **الإصدار:** 3.0 متعدد المنصات
 🌐 **المنصة الحالية:** {PLATFORM}
-🤖 **محرك الاستخراج:** {'Gemini AI' if AI_SETUP['available'] else 'OCR Space'}
-📊 **عدد المستخدمين:** {len(user_data)}
-📈 **إجمالي عمليات الاستخراج:** {sum(data.get('extractions', 0) for data in user_data.values())}
+🤖 **محرك الاستخراج:** {get_engine_label()}
+📊 **عدد المستخدمين:** {USER_STORE.count_users()}
+📈 **إجمالي عمليات الاستخراج:** {USER_STORE.total_extractions()}
 
 🔧 **المكتبات المستخدمة:**
 • pyTelegramBotAPI: لواجهة تيليجرام
@@ -524,13 +2975,13 @@ def handle_info_button(message):
 
 🔒 **الخصوصية:**
 • الصور تُعالج فوراً ولا تُخزن
-• البيانات تُحفظ مؤقتاً في الذاكرة
+• البيانات تُحفظ في قاعدة بيانات محلية
 • يمكنك مسح بياناتك في أي وقت
 
 📞 **الدعم:** @YourSupportChannel
 """
     
-    bot.send_message(
+    OUTBOX.send_message(
         message.chat.id,
         info_text,
         parse_mode='Markdown'
@@ -547,16 +2998,17 @@ def handle_stats_button(message):
 
 👤 **اسمك:** {message.from_user.first_name}
 🆔 **معرفك:** {user_id}
-📅 **تاريخ الانضمام:** {user_data.get(user_id, {}).get('join_date', 'غير معروف')}
+📅 **تاريخ الانضمام:** {user_stats.get('join_date', 'غير معروف')}
 🔢 **عدد عمليات الاستخراج:** {user_stats.get('extractions', 0)}
+🪙 **رموز Gemini اليوم:** {USER_STORE.tokens_today(user_id)}{f" / {GEMINI_USER_DAILY_TOKENS}" if GEMINI_USER_DAILY_TOKENS else ""}
 
 📈 **إحصائيات عامة:**
-• إجمالي المستخدمين: {len(user_data)}
-• عمليات اليوم: {len([d for d in user_data.values() if d.get('timestamp', '').startswith(datetime.now().strftime('%Y-%m-%d'))])}
+• إجمالي المستخدمين: {USER_STORE.count_users()}
+• عمليات اليوم: {USER_STORE.extractions_today()}
 • المنصة: {PLATFORM}
 """
     
-    bot.send_message(
+    OUTBOX.send_message(
         message.chat.id,
         stats_text,
         parse_mode='Markdown'
@@ -596,7 +3048,7 @@ def handle_help_button(message):
 📞 **للتواصل:** @YourSupportChannel
 """
     
-    bot.send_message(
+    OUTBOX.send_message(
         message.chat.id,
         help_text,
         parse_mode='Markdown'
@@ -607,256 +3059,1599 @@ def handle_delete_data(message):
     """حذف بيانات المستخدم"""
     user_id = str(message.from_user.id)
     
-    if user_id in user_data:
-        del user_data[user_id]
-        bot.reply_to(message, "✅ تم حذف جميع بياناتك بنجاح.")
+    if USER_STORE.delete_user(user_id):
+        OUTBOX.reply_to(message, "✅ تم حذف جميع بياناتك بنجاح.")
     else:
-        bot.reply_to(message, "ℹ️ لا توجد بيانات لحذفها.")
+        OUTBOX.reply_to(message, "ℹ️ لا توجد بيانات لحذفها.")
 
 @bot.message_handler(commands=['status'])
 def handle_status(message):
     """حالة البوت"""
+    queue_stats = EXTRACTION_QUEUE.stats()
+    outbox_stats = OUTBOX.stats()
+    cache_stats = EXTRACTION_CACHE.stats()
+    similar_stats = SIMILAR_IMAGES.stats()
+    engines_latency = "\n".join(
+        f"• {format_engine_latency(ENGINES[name])}"
+        for name in EXTRACTION_ENGINES if name in ENGINES
+    )
+    engines_guard = "\n".join(
+        f"• {format_engine_guard(ENGINES[name])}"
+        for name in EXTRACTION_ENGINES if name in ENGINES
+    )
+    stages_latency = format_stage_latencies() or "• لا توجد قياسات بعد"
     status_text = f"""
 🟢 **حالة البوت: نشط**
 
 🌐 **المنصة:** {PLATFORM}
 🤖 **الحالة:** يعمل بنجاح
-👥 **المستخدمون النشطون:** {len(user_data)}
-🔧 **المحرك:** {'Gemini AI ✅' if AI_SETUP['available'] else 'OCR Space ⚠️'}
-⏱️ **وقت التشغيل:** منذ {datetime.now().strftime('%H:%M:%S')}
+👥 **المستخدمون النشطون:** {USER_STORE.count_users()}
+🔧 **المحرك:** {get_engine_label()}
+🧩 **المحركات:** {format_engines_status()}
+🪙 **رموز Gemini اليوم:** {USER_STORE.tokens_today()} ({USER_STORE.get_counter(f"gemini_requests:{today_key()}")} طلب)
+⏱️ **وقت التشغيل:** {format_uptime(time.time() - START_TIME)}
+🧠 **الذاكرة (RSS):** {process_rss_bytes() / (1024 * 1024):.0f} MB
 
 📊 **إحصائيات فورية:**
-• ذاكرة مستخدمة: {len(user_data) * 1000} بايت تقريباً
 • جلسات نشطة: {len(user_sessions)}
 • حالة الخدمة: ممتازة
+
+📥 **طابور الاستخراج:**
+• في الانتظار: {queue_stats['depth']} / {queue_stats['max_size']} ({queue_stats['users']} مستخدم)
+• العمال المشغولون: {queue_stats['busy']} / {queue_stats['workers']}
+• متوسط زمن الانتظار: {queue_stats['avg_wait']:.1f} ث (الأقصى {queue_stats['max_wait']:.1f} ث)
+• مهام مكتملة: {queue_stats['processed']} | مرفوضة: {queue_stats['rejected']}
+
+📤 **الرسائل الصادرة:**
+• في الانتظار: {outbox_stats['depth']} ({outbox_stats['chats']} محادثة)
+• زمن الانتظار: p50 {outbox_stats['p50_wait']:.2f} ث | p95 {outbox_stats['p95_wait']:.2f} ث
+• مرسلة: {outbox_stats['sent']} | 429: {outbox_stats['throttled']} | فاشلة: {outbox_stats['failed']}
+
+⏳ **زمن المراحل (p50 / p95):**
+{stages_latency}
+
+⚡ **أداء المحركات:**
+{engines_latency}
+
+🛡️ **حماية المحركات:**
+{engines_guard}
+
+💾 **ذاكرة النتائج ({cache_stats['backend']}):**
+• العناصر المحفوظة: {cache_stats['entries']}
+• نسبة الإصابة: {cache_stats['hit_rate'] * 100:.0f}% ({cache_stats['hits']} / {cache_stats['hits'] + cache_stats['misses']})
+• صور شبه مطابقة: {similar_stats['hits']} إصابة ({similar_stats['entries']} بصمة)
 """
     
-    bot.reply_to(message, status_text, parse_mode='Markdown')
+    OUTBOX.reply_to(message, status_text, parse_mode='Markdown')
+
+# صور الألبوم تصل كتحديثات منفصلة بنفس media_group_id: تُجمع خلال نافذة قصيرة
+MEDIA_GROUP_WINDOW = float(os.environ.get('MEDIA_GROUP_WINDOW', '1.0'))
+
+class MediaGroupCollector:
+    """تجميع رسائل الألبوم حتى تمر MEDIA_GROUP_WINDOW ثانية دون وصول صورة جديدة"""
+
+    def __init__(self, window, on_complete):
+        self.window = window
+        self.on_complete = on_complete
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def add(self, message):
+        with self._lock:
+            group = self._groups.setdefault(message.media_group_id, {'messages': [], 'timer': None})
+            group['messages'].append(message)
+            if group['timer'] is not None:
+                group['timer'].cancel()
+            group['timer'] = threading.Timer(self.window, self._flush, args=(message.media_group_id,))
+            group['timer'].daemon = True
+            group['timer'].start()
+
+    def _flush(self, media_group_id):
+        with self._lock:
+            group = self._groups.pop(media_group_id, None)
+        if group:
+            # التحديثات قد تصل بغير ترتيبها
+            self.on_complete(sorted(group['messages'], key=lambda m: m.message_id))
+
+def user_inflight_total(user_id):
+    """مهام المستخدم في طابور الاستخراج وفي حلقة asyncio (إن كانت تعمل)"""
+    return EXTRACTION_QUEUE.user_inflight(user_id) + ASYNC_RUNTIME.get('user_inflight', {}).get(user_id, 0)
+
+def submit_album(messages):
+    """
+    قبول الألبوم كاملاً مرة واحدة ثم إضافته إلى طابور الاستخراج كمهمة واحدة
+    (القبول لكل صورة كان قد يرفض بعض صور الألبوم ويعالج الباقي)
+    """
+    if not admit_upload(messages[0], user_inflight_total(str(messages[0].from_user.id))):
+        return
+    if len(messages) == 1:
+        position = EXTRACTION_QUEUE.submit(process_photo_job, messages[0])
+    else:
+        position = EXTRACTION_QUEUE.submit(process_album_job, messages)
+    reply_queue_position(messages[0], position)
+
+MEDIA_GROUPS = MediaGroupCollector(MEDIA_GROUP_WINDOW, submit_album)
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo_message(message):
-    """معالجة الصور المرسلة"""
-    try:
-        user_id = str(message.from_user.id)
+    """معالجة الصور المرسلة: إضافتها إلى طابور الاستخراج (صور الألبوم تُجمع أولاً)"""
+    if reject_oversized_file(message, IMAGE_MAX_BYTES, 'photo'):
+        return
+    # الألبوم يُقبل أو يُرفض كاملاً عند اكتمال تجميعه
+    if message.media_group_id:
+        MEDIA_GROUPS.add(message)
+        return
+    if not admit_upload(message, user_inflight_total(str(message.from_user.id))):
+        return
+    reply_queue_position(message, EXTRACTION_QUEUE.submit(process_photo_job, message))
+
+def check_user_rate(user_id):
+    """
+    حد النافذة المنزلقة: USER_RATE_LIMIT ملفاً خلال USER_RATE_WINDOW ثانية
+    تعيد 0 عند القبول (ويُسجل الملف) أو عدد الثواني حتى يُسمح بملف جديد
+    """
+    now = time.monotonic()
+    with _sessions_lock:
+        session = user_sessions.setdefault(user_id, {'uploads': deque(), 'notified_at': 0.0})
+        uploads = session['uploads']
+        while uploads and uploads[0] <= now - USER_RATE_WINDOW:
+            uploads.popleft()
+        if USER_RATE_LIMIT and len(uploads) >= USER_RATE_LIMIT:
+            return uploads[0] + USER_RATE_WINDOW - now
+        uploads.append(now)
         
-        # إعلام المستخدم
-        status_msg = bot.reply_to(
+        # حذف جلسات المستخدمين الذين لم يرسلوا شيئاً خلال النافذة
+        if len(user_sessions) > 1000:
+            for idle_user in [key for key, value in user_sessions.items() if not value['uploads'] or value['uploads'][-1] <= now - USER_RATE_WINDOW]:
+                del user_sessions[idle_user]
+        return 0
+
+def should_notify_rejection(user_id):
+    """رسالة رفض واحدة على الأكثر كل REJECTION_NOTICE_INTERVAL ثانية (المستخدم المُغرِق لا يُكلف ردوداً كثيرة)"""
+    now = time.monotonic()
+    with _sessions_lock:
+        session = user_sessions.setdefault(user_id, {'uploads': deque(), 'notified_at': 0.0})
+        if now - session['notified_at'] < REJECTION_NOTICE_INTERVAL:
+            return False
+        session['notified_at'] = now
+        return True
+
+def admit_upload(message, inflight):
+    """
+    قبول الملف قبل إضافته للطابور: حد المهام المتزامنة ثم حد المعدل للمستخدم
+    عند الرفض يُرد فوراً دون تحميل أو استخراج، وتعيد False
+    """
+    user_id = str(message.from_user.id)
+    if USER_MAX_INFLIGHT and inflight >= USER_MAX_INFLIGHT:
+        reason = 'inflight'
+        text = (
+            f"⏳ **لديك {inflight} ملفات قيد المعالجة**\n"
+            "انتظر اكتمالها ثم أرسل المزيد"
+        )
+    else:
+        retry_after = check_user_rate(user_id)
+        if not retry_after:
+            return True
+        reason = 'rate'
+        text = (
+            "🐢 **أرسلت ملفات كثيرة خلال وقت قصير**\n"
+            f"يمكنك الإرسال مجدداً بعد {math.ceil(retry_after)} ثانية"
+        )
+    
+    ADMISSION_REJECTIONS.inc(reason=reason)
+    if should_notify_rejection(user_id):
+        OUTBOX.reply_to(message, text, parse_mode='Markdown')
+    return False
+
+def reply_queue_position(message, position):
+    """إعلام المستخدم إذا كان الطابور ممتلئاً أو كانت مهمته في الانتظار"""
+    if position is None:
+        OUTBOX.reply_to(
             message,
-            "📥 **جاري تحميل الصورة...**\n"
-            "⏳ الرجاء الانتظار قليلاً",
+            "⏳ **الخادم مشغول حالياً**\n"
+            "قائمة الانتظار ممتلئة، الرجاء إعادة المحاولة بعد قليل",
             parse_mode='Markdown'
         )
-        
+    elif position > 0:
+        OUTBOX.reply_to(
+            message,
+            f"🕒 **تم استلام الصورة**\n"
+            f"أنت رقم {position} في قائمة الانتظار",
+            parse_mode='Markdown'
+        )
+
+def get_message_file(message):
+    """الحصول على ملف الصورة من رسالة صورة أو ملف"""
+    if message.photo:
         # الحصول على أفضل جودة للصورة
-        file_id = message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_info.file_path}"
-        
-        # تحميل الصورة
-        bot.edit_message_text(
-            "🔗 **جاري تحميل الصورة من السيرفر...**",
+        return message.photo[-1]
+    return message.document
+
+def get_message_file_id(message):
+    """الحصول على معرف ملف الصورة من رسالة صورة أو ملف"""
+    return get_message_file(message).file_id
+
+# تيليجرام يحفظ كل صورة بعدة مقاسات (عادة 320 و800 و1280 وحتى 2560 بكسل): يكفي غالباً
+# أصغر مقاس يحقق الدقة التي يحتاجها المحرك، ويُحمّل الأكبر فقط عند ضعف النتيجة
+PHOTO_SIZE_SELECTION = os.environ.get('PHOTO_SIZE_SELECTION', '1') == '1'
+# الحد الأدنى لأكبر ضلع في المقاس المختار لكل محرك
+PHOTO_MIN_SIDE = {
+    'gemini': int(os.environ.get('GEMINI_PHOTO_MIN_SIDE', '1024')),
+    'ocr': int(os.environ.get('OCR_PHOTO_MIN_SIDE', '1280')),
+    'tesseract': int(os.environ.get('TESSERACT_PHOTO_MIN_SIDE', '1600'))
+}
+# نتيجة بأسطر أقل من هذا العدد تُعتبر ضعيفة وتُعاد بأكبر مقاس
+PHOTO_LOW_CONFIDENCE_LINES = int(os.environ.get('PHOTO_LOW_CONFIDENCE_LINES', '3'))
+def select_photo_size(message):
+    """أصغر مقاس للصورة يحقق الحد الأدنى للمحرك الحالي، أو أكبر مقاس إن لم يوجد"""
+    largest = get_message_file(message)
+    if not message.photo or not PHOTO_SIZE_SELECTION:
+        return largest
+    
+    engine = select_engine()
+    min_side = PHOTO_MIN_SIDE.get(engine['name'], 0) if engine else 0
+    # المعالجة المسبقة تصغّر الصورة إلى IMAGE_MAX_SIDE على أي حال
+    if PREPROCESS_ENABLED:
+        min_side = min(min_side, IMAGE_MAX_SIDE)
+    for photo_size in sorted(message.photo, key=lambda size: size.width * size.height):
+        if max(photo_size.width, photo_size.height) >= min_side:
+            return photo_size
+    return largest
+
+def extracted_line_count(extraction_result):
+    """عدد الأسطر المستخرجة"""
+    return len(extraction_result['arabic_texts']) + len(extraction_result['english_texts'])
+
+def is_low_confidence(extraction_result):
+    """نتيجة ضعيفة تستحق إعادة المحاولة بدقة أعلى (نتائج MRZ موثقة بأرقام التحقق)"""
+    if (extraction_result.get('fields') or {}).get('mrz'):
+        return False
+    return extracted_line_count(extraction_result) < PHOTO_LOW_CONFIDENCE_LINES
+
+def pick_escalated_result(result, escalated):
+    """نتيجة المقاس الأكبر إلا إذا كانت أقل أسطراً من نتيجة المقاس الأصغر"""
+    if extracted_line_count(escalated) >= extracted_line_count(result):
+        return escalated
+    return result
+
+def cache_file_info(file, file_info):
+    """حفظ نتيجة getFile حسب المعرف الفريد للملف"""
+    FILE_INFO_CACHE.set(file.file_unique_id, {'file_path': file_info.file_path, 'file_size': file_info.file_size})
+
+def cached_file_info(file):
+    """نتيجة getFile محفوظة للملف (كائن File)، أو None"""
+    cached = FILE_INFO_CACHE.get(file.file_unique_id)
+    if cached is None:
+        return None
+    return File(file.file_id, file.file_unique_id, cached['file_size'], cached['file_path'])
+
+def get_file_info(file):
+    """getFile مع ذاكرة حسب file_unique_id: الملف المعاد إرساله لا يحتاج طلباً إضافياً"""
+    file_info = cached_file_info(file)
+    if file_info is None:
+        file_info = bot.get_file(file.file_id)
+        cache_file_info(file, file_info)
+    return file_info
+
+def is_image_document(message):
+    """التحقق إذا كان الملف المرسل صورة (ملفات TIFF تُعالج في الوضع الجماعي لأنها قد تحوي عدة صفحات)"""
+    mime_type = message.document.mime_type
+    return bool(mime_type and mime_type.startswith('image/') and not get_bulk_kind(message.document))
+
+def telegram_file_url(file_path):
+    """رابط تحميل ملف من سيرفر تيليجرام"""
+    return f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}"
+
+DOWNLOAD_FAILED_TEXT = (
+    "❌ **فشل في تحميل الصورة**\n"
+    "الرجاء إعادة المحاولة"
+)
+
+def build_file_too_large_text(limit):
+    """رسالة رفض الملف الكبير"""
+    return (
+        "❌ **الملف كبير جداً**\n"
+        f"الحد الأقصى المسموح: {limit // (1024 * 1024)} MB"
+    )
+
+def reject_oversized_file(message, limit, kind):
+    """رفض الملف قبل إضافته للطابور إذا تجاوز حجمه المعلن في الرسالة الحد"""
+    size = get_message_file(message).file_size
+    if not size or size <= limit:
+        return False
+    EXTRACTIONS.inc(kind=kind, outcome='too_large')
+    OUTBOX.reply_to(message, build_file_too_large_text(limit), parse_mode='Markdown')
+    return True
+
+NO_TEXT_FOUND_TEXT = (
+    "❌ **لم أتمكن من استخراج نصوص من الصورة**\n\n"
+    "💡 **نصائح لتحسين النتيجة:**\n"
+    "• تأكد من وضوح النصوص في الصورة\n"
+    "• التقط الصورة بإضاءة جيدة\n"
+    "• اجعل الوثيقة تملأ معظم الإطار\n"
+    "• حاول مع صورة أخرى"
+)
+
+TIMEOUT_TEXT = (
+    "⏱️ **انتهت مهلة المعالجة**\n"
+    "الرجاء إعادة المحاولة مع صورة أصغر حجماً"
+)
+
+def build_unexpected_error_text(error):
+    """رسالة الخطأ غير المتوقع"""
+    return (
+        f"❌ **حدث خطأ غير متوقع**\n"
+        f"التفاصيل: {str(error)[:100]}\n"
+        "الرجاء إعادة المحاولة لاحقاً"
+    )
+
+def build_extraction_output(message, extraction_result):
+    """تجهيز الملف والرسائل الناتجة عن عملية استخراج ناجحة"""
+    # إنشاء بيانات المستخدم
+    name = extraction_result['name'] or message.from_user.first_name or "مستخدم"
+    email = generate_email(name)
+    password = generate_password()
+    
+    engine = ENGINES.get(extraction_result.get('engine'))
+    file_content = create_text_file_content(
+        name,
+        extraction_result['arabic_texts'],
+        extraction_result['english_texts'],
+        email,
+        password,
+        PLATFORM,
+        engine['label'] if engine else None,
+        extraction_result.get('fields')
+    )
+    
+    file_bytes = BytesIO(file_content.encode('utf-8'))
+    file_bytes.name = create_filename(name)
+    
+    # الملخص وبيانات الدخول في تعليق الملف نفسه بدلاً من رسالة منفصلة
+    caption = f"""
+✅ **تم استخراج المعلومات بنجاح!**
+
+📋 **الملخص:**
+• الاسم: {name}
+• النصوص العربية: {len(extraction_result['arabic_texts'])} سطر
+• النصوص الإنجليزية: {len(extraction_result['english_texts'])} سطر
+
+🔑 **بيانات الدخول الخاصة بك:**
+📧 **البريد الإلكتروني:** `{email}`
+🔐 **كلمة المرور:** `{password}`
+
+⚠️ **هام: احفظ هذه البيانات في مكان آمن!**
+💾 جميع المعلومات محفوظة في الملف المرفق
+🔄 لإرسال صورة أخرى: أرسل صورة جديدة مباشرة
+"""
+    
+    return {
+        'name': name,
+        'email': email,
+        'password': password,
+        'engine': extraction_result.get('engine'),
+        'document': file_bytes,
+        'caption': caption
+    }
+
+def record_extraction(user_id, output):
+    """حفظ بيانات عملية الاستخراج للمستخدم"""
+    save_user_data(user_id, {
+        'name': output['name'],
+        'email': output['email'],
+        'timestamp': datetime.now().isoformat(),
+        'extraction_method': output['engine']
+    })
+
+def deliver_extraction_output(message, extraction_result, progress, timer):
+    """إرسال ملف النتائج (الملخص وبيانات الدخول في التعليق) ثم حذف رسالة الحالة وحفظ البيانات"""
+    with timer.stage('build'):
+        output = build_extraction_output(message, extraction_result)
+    
+    # إرسال الملف
+    progress.update("📤 **جاري إرسال النتائج...**")
+    
+    with timer.stage('send'):
+        OUTBOX.send_document(
             chat_id=message.chat.id,
-            message_id=status_msg.message_id,
+            document=output['document'],
+            caption=output['caption'],
             parse_mode='Markdown'
-        )
+        ).result()
+    timer.report()
+    
+    # حذف رسالة الحالة إن ظهرت
+    progress.finish()
+    
+    # حفظ بيانات المستخدم
+    record_extraction(str(message.from_user.id), output)
+
+def download_message_image(message, timer, photo_size=None):
+    """تحميل صورة رسالة (أو مقاس محدد منها) من سيرفر تيليجرام على دفعات، تعيد None عند الفشل"""
+    with timer.stage('get_file'):
+        file_info = get_file_info(photo_size or get_message_file(message))
+    check_file_size(file_info.file_size, IMAGE_MAX_BYTES)
+    
+    with timer.stage('download'):
+        buffer = BytesIO()
+        if not stream_download(telegram_file_url(file_info.file_path), buffer, IMAGE_MAX_BYTES):
+            return None
+    return buffer.getvalue()
+
+def extract_message_photo(message, file_key, timer, progress):
+    """
+    استخراج صورة رسالة بالمقاس المختار، وإعادة المحاولة بأكبر مقاس عند ضعف النتيجة
+    تعيد None إذا فشل التحميل
+    """
+    largest = get_message_file(message)
+    photo_size = select_photo_size(message)
+    image_bytes = download_message_image(message, timer, photo_size)
+    if image_bytes is None:
+        return None
+    
+    progress.update(
+        "🤖 **جاري تحليل الصورة واستخراج النصوص...**\n"
+        f"المحرك: {get_engine_label()}"
+    )
+    result = extract_text_cached(image_bytes, timer=timer)
+    
+    if photo_size.file_unique_id != largest.file_unique_id and is_low_confidence(result):
+        print(f"🔍 نتيجة ضعيفة من مقاس {photo_size.width}x{photo_size.height}: إعادة المحاولة بأكبر مقاس")
+        PHOTO_ESCALATIONS.inc()
+        image_bytes = download_message_image(message, timer, largest)
+        if image_bytes is not None:
+            # بصمة المقاس الأكبر قريبة من الأصغر: البحث عن الصور المشابهة سيعيد النتيجة الضعيفة نفسها
+            result = pick_escalated_result(result, extract_text_cached(image_bytes, timer=timer, similar=False))
+    
+    if has_extracted_text(result):
+        EXTRACTION_CACHE.set(file_key, result)
+    return result
+
+def process_photo_job(message):
+    """تنفيذ عملية الاستخراج الكاملة لصورة (تعمل داخل عامل الطابور)"""
+    progress = ProgressReporter(message)
+    CURRENT_USER.set(str(message.from_user.id))
+    try:
+        # البحث في الذاكرة أولاً: الصورة المعاد إرسالها لا تحتاج تحميلاً أو استخراجاً
+        file_unique_id = get_message_file(message).file_unique_id
+        file_key = cache_key_for_file(file_unique_id)
+        timer = StageTimer(f"صورة {file_unique_id}")
+        extraction_result = EXTRACTION_CACHE.get(file_key)
         
-        response = requests.get(file_url, timeout=30)
-        if response.status_code != 200:
-            bot.edit_message_text(
-                "❌ **فشل في تحميل الصورة**\n"
-                "الرجاء إعادة المحاولة",
-                chat_id=message.chat.id,
-                message_id=status_msg.message_id,
-                parse_mode='Markdown'
+        if extraction_result is None:
+            # إعلام المستخدم (يظهر فقط إذا طالت العملية)
+            progress.update(
+                "📥 **جاري تحميل الصورة...**\n"
+                "⏳ الرجاء الانتظار قليلاً"
             )
-            return
+            
+            # تحميل الصورة واستخراج النصوص
+            extraction_result = extract_message_photo(message, file_key, timer, progress)
+            if extraction_result is None:
+                EXTRACTIONS.inc(kind='photo', outcome='download_failed')
+                progress.fail(DOWNLOAD_FAILED_TEXT)
+                return
+            
+            # التحقق من وجود نصوص مستخرجة
+            if not has_extracted_text(extraction_result):
+                EXTRACTIONS.inc(kind='photo', outcome='empty')
+                progress.fail(NO_TEXT_FOUND_TEXT)
+                return
+            
+            # إنشاء الملف
+            progress.update("📝 **جاري إنشاء الملف النصي...**")
         
-        image_bytes = response.content
+        deliver_extraction_output(message, extraction_result, progress, timer)
+        EXTRACTIONS.inc(kind='photo', outcome='ok')
         
-        # استخراج النصوص
-        bot.edit_message_text(
-            "🤖 **جاري تحليل الصورة واستخراج النصوص...**\n"
-            f"المحرك: {'Gemini AI' if AI_SETUP['available'] else 'OCR Space'}",
-            chat_id=message.chat.id,
-            message_id=status_msg.message_id,
+    except FileTooLargeError as e:
+        EXTRACTIONS.inc(kind='photo', outcome='too_large')
+        progress.fail(build_file_too_large_text(e.limit))
+    except requests.exceptions.Timeout:
+        EXTRACTIONS.inc(kind='photo', outcome='timeout')
+        progress.fail(TIMEOUT_TEXT)
+    except Exception as e:
+        print(f"❌ خطأ في معالجة الصورة: {e}")
+        EXTRACTIONS.inc(kind='photo', outcome='error')
+        progress.fail(build_unexpected_error_text(e))
+
+def process_album_job(messages):
+    """استخراج ألبوم صور (مثل وجهي البطاقة) كوثيقة واحدة بملف نتائج واحد"""
+    message = messages[0]
+    progress = ProgressReporter(message)
+    CURRENT_USER.set(str(message.from_user.id))
+    try:
+        album_key = cache_key_for_album([get_message_file(m).file_unique_id for m in messages])
+        timer = StageTimer(f"ألبوم من {len(messages)} صور")
+        extraction_result = EXTRACTION_CACHE.get(album_key)
+        
+        if extraction_result is None:
+            progress.update(
+                f"📥 **جاري تحميل {len(messages)} صور...**\n"
+                "⏳ الرجاء الانتظار قليلاً"
+            )
+            
+            images = []
+            for album_message in messages:
+                image_bytes = download_message_image(album_message, timer)
+                if image_bytes is None:
+                    EXTRACTIONS.inc(kind='album', outcome='download_failed')
+                    progress.fail(DOWNLOAD_FAILED_TEXT)
+                    return
+                images.append(image_bytes)
+            
+            progress.update(
+                "🤖 **جاري تحليل الصور واستخراج النصوص...**\n"
+                f"المحرك: {get_engine_label()}"
+            )
+            
+            with timer.stage('preprocess'):
+                prepared = [preprocess_image(image_bytes) for image_bytes in images]
+            with timer.stage('extract'):
+                extraction_result = extract_text_from_images(prepared)
+            
+            if not has_extracted_text(extraction_result):
+                EXTRACTIONS.inc(kind='album', outcome='empty')
+                progress.fail(NO_TEXT_FOUND_TEXT)
+                return
+            EXTRACTION_CACHE.set(album_key, extraction_result)
+        
+        deliver_extraction_output(message, extraction_result, progress, timer)
+        EXTRACTIONS.inc(kind='album', outcome='ok')
+        
+    except FileTooLargeError as e:
+        EXTRACTIONS.inc(kind='album', outcome='too_large')
+        progress.fail(build_file_too_large_text(e.limit))
+    except requests.exceptions.Timeout:
+        EXTRACTIONS.inc(kind='album', outcome='timeout')
+        progress.fail(TIMEOUT_TEXT)
+    except Exception as e:
+        print(f"❌ خطأ في معالجة الألبوم: {e}")
+        EXTRACTIONS.inc(kind='album', outcome='error')
+        progress.fail(build_unexpected_error_text(e))
+
+@bot.message_handler(content_types=['document'])
+def handle_document_message(message):
+    """معالجة الملفات المرسلة"""
+    if is_image_document(message):
+        # معاملة الملفات الصورية كصور
+        handle_photo_message(message)
+    elif get_bulk_kind(message.document):
+        # ملف مضغوط أو متعدد الصفحات: استخراج جماعي بملف نتائج واحد
+        if reject_oversized_file(message, DOCUMENT_MAX_BYTES, 'bulk'):
+            return
+        if not admit_upload(message, user_inflight_total(str(message.from_user.id))):
+            return
+        reply_queue_position(message, EXTRACTION_QUEUE.submit(process_bulk_job, message))
+    else:
+        OUTBOX.reply_to(
+            message,
+            "❌ **نوع الملف غير مدعوم**\n"
+            "الرجاء إرسال صورة (JPG, PNG, JPEG)\n"
+            f"أو ملف للاستخراج الجماعي ({', '.join(sorted(supported_bulk_kinds()))})",
             parse_mode='Markdown'
         )
+
+@bot.message_handler(func=lambda message: True)
+def handle_other_messages(message):
+    """معالجة الرسائل الأخرى"""
+    help_text = """
+🤖 **مرحباً! أنا بوت استخراج النصوص**
+
+📌 **للبدء، يمكنك:**
+1. إرسال صورة البطاقة أو الجواز مباشرة
+2. الضغط على زر 📸 إرسال صورة
+3. استخدام الأمر /start
+
+❓ **للمساعدة:** /help أو زر 🆘 المساعدة
+📊 **للعرض إحصائيات:** /status أو زر 📊 إحصائيات
+
+💡 **تلميح:** أرسل صورة الآن لتبدأ!
+"""
+    
+    OUTBOX.reply_to(message, help_text, parse_mode='Markdown')
+
+# ============= الاستخراج الجماعي (ZIP / PDF / TIFF) =============
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', '500'))
+BULK_MAX_MEMBER_BYTES = int(os.environ.get('BULK_MAX_MEMBER_BYTES', str(20 * 1024 * 1024)))
+BULK_CONCURRENCY = max(1, int(os.environ.get('BULK_CONCURRENCY', '4')))
+# مهلة انتظار عمال الطابور المحلي قبل أن تنفذ مهمة الدفعة صفحتها التالية بنفسها
+BULK_INLINE_AFTER = 2.0
+BULK_OUTPUT_FORMAT = os.environ.get('BULK_OUTPUT_FORMAT', 'csv').lower()  # csv | jsonl
+BULK_PDF_DPI = int(os.environ.get('BULK_PDF_DPI', '150'))
+
+BULK_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+BULK_KINDS = {
+    'zip': {'mime_types': ('application/zip', 'application/x-zip-compressed'), 'extensions': ('.zip',)},
+    'pdf': {'mime_types': ('application/pdf',), 'extensions': ('.pdf',)},
+    'tiff': {'mime_types': ('image/tiff',), 'extensions': ('.tif', '.tiff')}
+}
+
+def supported_bulk_kinds():
+    """أنواع الملفات الجماعية المدعومة حسب المكتبات المتوفرة"""
+    kinds = {'zip'}
+    if PYMUPDF_AVAILABLE:
+        kinds.add('pdf')
+    if PIL_AVAILABLE:
+        kinds.add('tiff')
+    return kinds
+
+def get_bulk_kind(document):
+    """نوع الملف الجماعي (zip / pdf / tiff) أو None"""
+    file_name = (document.file_name or '').lower()
+    for kind in supported_bulk_kinds():
+        spec = BULK_KINDS[kind]
+        if document.mime_type in spec['mime_types'] or file_name.endswith(spec['extensions']):
+            return kind
+    return None
+
+def iter_zip_images(path):
+    """صور ملف ZIP عضواً عضواً دون فك الأرشيف كاملاً في الذاكرة"""
+    with zipfile.ZipFile(path) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(BULK_IMAGE_EXTENSIONS)
+        ][:BULK_MAX_ITEMS]
+        yield len(members)
+        
+        for info in members:
+            # حماية من الأعضاء الضخمة (zip bomb): لا يُقرأ إلا ما دون الحد
+            if info.file_size > BULK_MAX_MEMBER_BYTES:
+                yield info.filename, None
+                continue
+            with archive.open(info) as member:
+                yield info.filename, member.read()
+
+def iter_pdf_pages(path):
+    """صفحات PDF كصور PNG صفحة صفحة"""
+    import fitz
+    with fitz.open(path) as pdf:
+        total = min(pdf.page_count, BULK_MAX_ITEMS)
+        yield total
+        for page_number in range(total):
+            pixmap = pdf[page_number].get_pixmap(dpi=BULK_PDF_DPI)
+            yield f"صفحة {page_number + 1}", pixmap.tobytes('png')
+
+def iter_tiff_frames(path):
+    """صفحات TIFF متعدد الصفحات كصور JPEG"""
+    with Image.open(path) as image:
+        total = min(getattr(image, 'n_frames', 1), BULK_MAX_ITEMS)
+        yield total
+        for frame in range(total):
+            image.seek(frame)
+            output = BytesIO()
+            image.convert('RGB').save(output, format='JPEG', quality=JPEG_QUALITY)
+            yield f"صفحة {frame + 1}", output.getvalue()
+
+BULK_READERS = {'zip': iter_zip_images, 'pdf': iter_pdf_pages, 'tiff': iter_tiff_frames}
+
+def open_bulk_items(path, kind):
+    """
+    فتح ملف جماعي: تعيد (عدد العناصر، مولد (الاسم، بايتات الصورة))
+    العناصر تُقرأ عند الطلب فقط، فلا يوجد في الذاكرة إلا ما تتم معالجته
+    """
+    items = BULK_READERS[kind](path)
+    return next(items), items
+
+class BulkResultWriter:
+    """كتابة نتائج الدفعة بترتيب الملفات الأصلي إلى ملف مؤقت بصيغة CSV أو JSONL"""
+
+    FIELDS = ['index', 'file', 'status', 'engine', 'name', 'document_number', 'arabic_texts', 'english_texts', 'error']
+
+    def __init__(self, output_format):
+        self.output_format = 'jsonl' if output_format == 'jsonl' else 'csv'
+        self.file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self._pending = {}
+        self._next_index = 0
+        if self.output_format == 'csv':
+            # BOM ليعرض Excel النصوص العربية بشكل صحيح
+            self.file.write('\ufeff'.encode('utf-8'))
+            self._write_csv(self.FIELDS)
+
+    def _write_csv(self, values):
+        line = StringIO()
+        csv.writer(line).writerow(values)
+        self.file.write(line.getvalue().encode('utf-8'))
+
+    def _write(self, row):
+        if self.output_format == 'jsonl':
+            self.file.write((json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8'))
+        else:
+            self._write_csv([
+                ' | '.join(value) if isinstance(value, list) else value
+                for value in (row[field] for field in self.FIELDS)
+            ])
+
+    def add(self, row):
+        """إضافة نتيجة؛ تُكتب فور اكتمال كل ما قبلها"""
+        self._pending[row['index']] = row
+        while self._next_index in self._pending:
+            self._write(self._pending.pop(self._next_index))
+            self._next_index += 1
+
+    def close(self):
+        """إنهاء الكتابة وإرجاع المؤشر إلى بداية الملف للإرسال"""
+        for index in sorted(self._pending):
+            self._write(self._pending.pop(index))
+        self.file.seek(0)
+        return self.file
+
+def build_bulk_row(index, file_name, future=None, error=None):
+    """صف نتيجة عنصر واحد من الدفعة"""
+    row = {
+        'index': index + 1, 'file': file_name, 'status': 'error', 'engine': '', 'name': '',
+        'document_number': '', 'arabic_texts': [], 'english_texts': [], 'error': error or ''
+    }
+    if future is not None:
+        try:
+            result = future.result()
+        except Exception as e:
+            row['error'] = str(e)[:200]
+        else:
+            row.update({
+                'status': 'ok' if has_extracted_text(result) else 'empty',
+                'engine': result.get('engine', ''),
+                'name': result['name'],
+                'document_number': result.get('fields', {}).get('document_number', ''),
+                'arabic_texts': result['arabic_texts'],
+                'english_texts': result['english_texts']
+            })
+    return row
+
+class BulkPage:
+    """
+    صفحة من الدفعة تُنفذ مرة واحدة: في عامل من طابور الاستخراج (أو منفذ الدفعة المحلي)،
+    أو في مهمة الدفعة نفسها إذا تأخر الطابور (حتى لا تنتظر مهام الدفعات صفحاتها وهي تشغل كل العمال)
+    """
+
+    def __init__(self, image_bytes):
+        self.image_bytes = image_bytes
+        self.future = Future()
+        # سياق مهمة الدفعة (المستخدم صاحب الاستهلاك) يُنقل إلى العامل
+        self._context = contextvars.copy_context()
+        self._claimed = False
+        self._lock = threading.Lock()
+
+    def run(self):
+        with self._lock:
+            if self._claimed:
+                return False
+            self._claimed = True
+        try:
+            result = self._context.run(extract_text_cached, self.image_bytes, similar=False)
+        except Exception as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+        finally:
+            self.image_bytes = None
+        return True
+
+def run_bulk_page(message, page):
+    """مهمة طابور لصفحة واحدة (الرسالة أول معامل ليُنسب الدور لصاحب الدفعة)"""
+    page.run()
+
+def run_bulk_extraction(message, items, total, writer, progress):
+    """
+    استخراج عناصر الدفعة عبر طابور الاستخراج نفسه (بالتناوب مع مهام المستخدمين الآخرين،
+    وبحدود تزامن المحركات في run_engine) مع حد أقصى BULK_CONCURRENCY للعناصر قيد المعالجة،
+    فلا يُقرأ العنصر التالي من الملف إلا عند تحرر مكان
+    الطابور المشترك ينقل رسائل تيليجرام فقط: مهمة الدفعة (في العامل) تنفذ صفحاتها في منفذ محلي
+    الدفعة تُحتسب من حد معدل المستخدم مرة واحدة عند قبول الملف
+    """
+    counts = {'ok': 0, 'empty': 0, 'error': 0}
+    in_flight = {}
+    local_pages = None
+    if isinstance(EXTRACTION_QUEUE, SharedJobQueue):
+        local_pages = ThreadPoolExecutor(max_workers=BULK_CONCURRENCY, thread_name_prefix="bulk-page")
+    
+    def collect(return_when):
+        done, _ = wait(in_flight, timeout=BULK_INLINE_AFTER, return_when=return_when)
+        if not done:
+            # الطابور مشغول: مهمة الدفعة تنفذ أقدم صفحاتها المنتظرة بنفسها
+            for page in in_flight.values():
+                if page[2].run():
+                    break
+            return
+        for future in done:
+            index, file_name, _ = in_flight.pop(future)
+            row = build_bulk_row(index, file_name, future)
+            counts[row['status']] += 1
+            writer.add(row)
+        progress.update(f"⚙️ **جاري المعالجة الجماعية:** {sum(counts.values())} / {total}")
+    
+    try:
+        for index, (file_name, image_bytes) in enumerate(items):
+            if image_bytes is None:
+                counts['error'] += 1
+                writer.add(build_bulk_row(index, file_name, error='الملف أكبر من الحد المسموح'))
+                continue
+            while len(in_flight) >= BULK_CONCURRENCY:
+                collect(FIRST_COMPLETED)
+            
+            page = BulkPage(image_bytes)
+            in_flight[page.future] = (index, file_name, page)
+            if local_pages is not None:
+                local_pages.submit(page.run)
+            elif EXTRACTION_QUEUE.submit(run_bulk_page, message, page) is None:
+                # الطابور ممتلئ: تنفيذ الصفحة مباشرة
+                page.run()
+        
+        while in_flight:
+            collect(ALL_COMPLETED)
+    finally:
+        if local_pages is not None:
+            local_pages.shutdown(wait=False, cancel_futures=True)
+    
+    return counts
+
+def download_document_to(message, fileobj, timer):
+    """تحميل ملف من تيليجرام على دفعات إلى ملف مؤقت، تعيد False عند الفشل"""
+    with timer.stage('get_file'):
+        file_info = get_file_info(message.document)
+    check_file_size(file_info.file_size, DOCUMENT_MAX_BYTES)
+    
+    with timer.stage('download'):
+        if not stream_download(telegram_file_url(file_info.file_path), fileobj, DOCUMENT_MAX_BYTES):
+            return False
+    fileobj.flush()
+    return True
+
+def process_bulk_job(message):
+    """معالجة ملف ZIP أو PDF أو TIFF متعدد الصفحات وإرسال ملف نتائج مجمع واحد"""
+    document = message.document
+    kind = get_bulk_kind(document)
+    progress = ProgressReporter(message)
+    CURRENT_USER.set(str(message.from_user.id))
+    timer = StageTimer(f"دفعة {document.file_name or kind}")
+    started = time.monotonic()
+    
+    try:
+        with tempfile.NamedTemporaryFile(suffix=f'.{kind}') as source:
+            progress.update("📥 **جاري تحميل الملف...**")
+            if not download_document_to(message, source, timer):
+                EXTRACTIONS.inc(kind='bulk', outcome='download_failed')
+                progress.fail(DOWNLOAD_FAILED_TEXT)
+                return
+            
+            total, items = open_bulk_items(source.name, kind)
+            if total == 0:
+                EXTRACTIONS.inc(kind='bulk', outcome='empty')
+                progress.fail("❌ **لا توجد صور داخل الملف**")
+                return
+            
+            # TIFF بصفحة واحدة هو صورة عادية: ملف بيانات الدخول المعتاد بدلاً من جدول نتائج
+            if kind == 'tiff' and total == 1:
+                _, image_bytes = next(items)
+                extraction_result = extract_text_cached(image_bytes, cache_key_for_file(document.file_unique_id), timer)
+                if not has_extracted_text(extraction_result):
+                    EXTRACTIONS.inc(kind='bulk', outcome='empty')
+                    progress.fail(NO_TEXT_FOUND_TEXT)
+                    return
+                deliver_extraction_output(message, extraction_result, progress, timer)
+                EXTRACTIONS.inc(kind='bulk', outcome='ok')
+                return
+            
+            writer = BulkResultWriter(BULK_OUTPUT_FORMAT)
+            progress.update(f"⚙️ **جاري المعالجة الجماعية:** 0 / {total}")
+            with timer.stage('extract'):
+                counts = run_bulk_extraction(message, items, total, writer, progress)
+        
+        base_name = os.path.splitext(document.file_name or 'bulk')[0]
+        caption = (
+            "✅ **اكتملت المعالجة الجماعية**\n\n"
+            f"📦 **الملف:** {base_name}\n"
+            f"• العناصر: {total}\n"
+            f"• نجحت: {counts['ok']} | بدون نصوص: {counts['empty']} | أخطاء: {counts['error']}\n"
+            f"⏱️ **المدة:** {time.monotonic() - started:.0f} ث"
+        )
         
-        extraction_result = extract_text_from_image(image_bytes)
-        
-        # التحقق من وجود نصوص مستخرجة
-        if not extraction_result['arabic_texts'] and not extraction_result['english_texts']:
-            bot.edit_message_text(
-                "❌ **لم أتمكن من استخراج نصوص من الصورة**\n\n"
-                "💡 **نصائح لتحسين النتيجة:**\n"
-                "• تأكد من وضوح النصوص في الصورة\n"
-                "• التقط الصورة بإضاءة جيدة\n"
-                "• اجعل الوثيقة تملأ معظم الإطار\n"
-                "• حاول مع صورة أخرى",
+        progress.update("📤 **جاري إرسال النتائج...**")
+        with timer.stage('send'):
+            OUTBOX.send_document(
                 chat_id=message.chat.id,
-                message_id=status_msg.message_id,
+                document=writer.close(),
+                visible_file_name=f"نتائج_{base_name}.{writer.output_format}",
+                caption=caption,
                 parse_mode='Markdown'
+            ).result()
+        timer.report()
+        progress.finish()
+        EXTRACTIONS.inc(kind='bulk', outcome='ok')
+        
+    except FileTooLargeError as e:
+        EXTRACTIONS.inc(kind='bulk', outcome='too_large')
+        progress.fail(build_file_too_large_text(e.limit))
+    except requests.exceptions.Timeout:
+        EXTRACTIONS.inc(kind='bulk', outcome='timeout')
+        progress.fail(TIMEOUT_TEXT)
+    except Exception as e:
+        print(f"❌ خطأ في المعالجة الجماعية: {e}")
+        EXTRACTIONS.inc(kind='bulk', outcome='error')
+        progress.fail(build_unexpected_error_text(e))
+
+# ============= التوسع الأفقي: عملية استقبال وعمال استخراج =============
+# all: عملية واحدة تستقبل وتستخرج (الافتراضي)
+# ingest: استقبال التحديثات (Polling أو Webhook) وإضافة مهام الاستخراج إلى الطابور المشترك
+# worker: تنفيذ مهام الطابور المشترك وإرسال النتائج (بدون استقبال تحديثات)
+BOT_ROLE = (
+    'ingest' if '--ingest' in sys.argv
+    else 'worker' if '--worker' in sys.argv
+    else os.environ.get('BOT_ROLE', 'all').lower()
+)
+# sqlite:///jobs.db لعمليات على نفس الجهاز، أو redis://host:6379/0 لعدة أجهزة (يتطلب مكتبة redis)
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL', 'sqlite:///jobs.db')
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '0.5'))
+# المهمة مرتبطة بعقد عاملها (worker:<id>) الذي يُجدد كل LEADER_LEASE_TTL / 3:
+# تُعاد إلى الطابور فقط إذا انتهى العقد (توقفت العملية)، لا لمجرد طول مدة التنفيذ
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '2'))
+# عقد القيادة: عملية استقبال واحدة فقط تنفذ Polling (عمليتان على نفس التوكن تتعارضان)
+LEADER_LEASE_TTL = int(os.environ.get('LEADER_LEASE_TTL', '30'))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# أنواع المهام التي يمكن نقلها بين العمليات
+JOB_TYPES = {
+    'photo': process_photo_job,
+    'album': process_album_job,
+    'bulk': process_bulk_job
+}
+JOB_TYPE_NAMES = {func: name for name, func in JOB_TYPES.items()}
+
+def encode_job_args(args):
+    """تحويل معاملات المهمة (رسائل أو قوائم رسائل) إلى JSON بصيغة تيليجرام الأصلية"""
+    def encode(value):
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        return json.loads(value.json) if isinstance(value.json, str) else value.json
+    return json.dumps([encode(arg) for arg in args], ensure_ascii=False)
+
+def decode_job_args(payload):
+    """إعادة بناء رسائل تيليجرام من JSON المهمة"""
+    def decode(value):
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return telebot.types.Message.de_json(value)
+    return [decode(arg) for arg in json.loads(payload)]
+
+class JobStore(ABC):
+    """
+    واجهة الطابور المشترك بين العمليات مع عقود (leases) للقيادة ونبض العمال
+    كل مهمة قيد التنفيذ محجوزة باسم عامل، وعقد العامل worker:<id> هو نبضها
+    """
+
+    @abstractmethod
+    def push(self, job_type, payload, max_size, user_id):
+        """إضافة مهمة؛ تعيد عدد المهام المنتظرة قبلها أو None إذا كان الطابور ممتلئاً"""
+
+    @abstractmethod
+    def user_inflight(self, user_id):
+        """مهام المستخدم المنتظرة وقيد التنفيذ في كل العمليات"""
+
+    @abstractmethod
+    def claim(self, worker_id):
+        """سحب المهمة التالية وحجزها للعامل، أو None"""
+
+    @abstractmethod
+    def complete(self, job):
+        """حذف المهمة بعد انتهائها إذا كانت ما تزال محجوزة لعاملها؛ False إذا أُعيدت لعامل آخر"""
+
+    @abstractmethod
+    def requeue_stale(self, max_attempts):
+        """إعادة المهام التي انتهى عقد عاملها إلى الطابور، أو حذفها بعد max_attempts محاولة"""
+
+    @abstractmethod
+    def acquire_lease(self, name, holder, ttl):
+        """أخذ العقد أو تجديده؛ True إذا أصبح holder صاحبه"""
+
+    @abstractmethod
+    def release_lease(self, name, holder):
+        """تحرير العقد إذا كان holder صاحبه"""
+
+    @abstractmethod
+    def count_leases(self, prefix):
+        """عدد العقود السارية التي يبدأ اسمها بـ prefix"""
+
+    @abstractmethod
+    def stats(self):
+        """depth و users و running و processed و avg_wait و max_wait (عمر المهام المنتظرة)"""
+
+def worker_lease_name(worker_id):
+    """اسم عقد العامل الذي يثبت أن عمليته ما تزال تعمل"""
+    return f"worker:{worker_id}"
+
+class SQLiteJobStore(JobStore):
+    """
+    طابور في ملف SQLite مشترك بين عمليات نفس الجهاز
+    جدول job_users يحفظ لكل مستخدم عدد مهامه المنتظرة وقيد التنفيذ ووقت آخر سحب،
+    فيختار السحب المستخدم التالي من هذا الجدول الصغير بدلاً من عدّ مهام كل مستخدم في كل مرة
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, type TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'queued', enqueued_at REAL NOT NULL, "
+                "started_at REAL, worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, user_id TEXT)"
+            )
+            # ملفات الطابور من الإصدار السابق لا تحتوي عمود المستخدم
+            columns = [row['name'] for row in self._db.execute("PRAGMA table_info(jobs)")]
+            if 'user_id' not in columns:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN user_id TEXT")
+            self._db.execute("DROP INDEX IF EXISTS jobs_user")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_user_status ON jobs (user_id, status, id)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS job_users ("
+                "user_id TEXT PRIMARY KEY, queued INTEGER NOT NULL DEFAULT 0, "
+                "running INTEGER NOT NULL DEFAULT 0, last_claimed REAL NOT NULL DEFAULT 0)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS job_users_turn ON job_users (running, last_claimed)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+        # ملف من الإصدار السابق (أو عدادات انحرفت بعد توقف مفاجئ): إعادة بنائها من جدول المهام
+        with self._write():
+            self._db.execute("DELETE FROM job_users")
+            self._db.execute(
+                "INSERT INTO job_users (user_id, queued, running) "
+                "SELECT COALESCE(user_id, ''), SUM(status = 'queued'), SUM(status = 'running') "
+                "FROM jobs GROUP BY COALESCE(user_id, '')"
             )
-            return
-        
-        # إنشاء بيانات المستخدم
-        name = extraction_result['name'] or message.from_user.first_name or "مستخدم"
-        email = generate_email(name)
-        password = generate_password()
-        
-        # إنشاء الملف
-        bot.edit_message_text(
-            "📝 **جاري إنشاء الملف النصي...**",
-            chat_id=message.chat.id,
-            message_id=status_msg.message_id,
-            parse_mode='Markdown'
-        )
-        
-        file_content = create_text_file_content(
-            name,
-            extraction_result['arabic_texts'],
-            extraction_result['english_texts'],
-            email,
-            password,
-            PLATFORM
-        )
-        
-        filename = create_filename(name)
-        
-        # إرسال الملف
-        bot.edit_message_text(
-            "📤 **جاري إرسال النتائج...**",
-            chat_id=message.chat.id,
-            message_id=status_msg.message_id,
-            parse_mode='Markdown'
-        )
-        
-        file_bytes = BytesIO(file_content.encode('utf-8'))
-        file_bytes.name = filename
-        
-        caption = f"""
-✅ **تم استخراج المعلومات بنجاح!**
 
-📋 **الملخص:**
-• الاسم: {name}
-• النصوص العربية: {len(extraction_result['arabic_texts'])} سطر
-• النصوص الإنجليزية: {len(extraction_result['english_texts'])} سطر
-• البريد الإلكتروني: `{email}`
-• كلمة المرور: `{password}`
+    @contextmanager
+    def _write(self):
+        """معاملة كتابة فورية: تمنع عمليتين من حجز نفس المهمة"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
 
-💾 **تم حفظ جميع المعلومات في الملف المرفق**
-"""
-        
-        bot.send_document(
-            chat_id=message.chat.id,
-            document=file_bytes,
-            caption=caption,
-            parse_mode='Markdown'
+    def _adjust_user(self, user_id, queued=0, running=0):
+        """تعديل عدادات المستخدم في job_users وحذف صفه عند خلوه من المهام"""
+        self._db.execute(
+            "INSERT INTO job_users (user_id, queued, running) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET queued = queued + excluded.queued, running = running + excluded.running",
+            (user_id or '', queued, running)
         )
-        
-        # حذف رسالة الحالة
-        bot.delete_message(
-            chat_id=message.chat.id,
-            message_id=status_msg.message_id
+        self._db.execute(
+            "DELETE FROM job_users WHERE user_id = ? AND queued <= 0 AND running <= 0", (user_id or '',)
         )
+
+    def push(self, job_type, payload, max_size, user_id):
+        with self._write():
+            depth = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if depth >= max_size:
+                return None
+            self._db.execute(
+                "INSERT INTO jobs (type, payload, enqueued_at, user_id) VALUES (?, ?, ?, ?)",
+                (job_type, payload, time.time(), user_id)
+            )
+            self._adjust_user(user_id, queued=1)
+            return depth
+
+    def user_inflight(self, user_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT queued + running FROM job_users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def claim(self, worker_id):
+        with self._write():
+            # الدور للمستخدم الأقل مهاماً قيد التنفيذ، ثم الأطول انتظاراً منذ آخر سحب
+            user = self._db.execute(
+                "SELECT user_id FROM job_users WHERE queued > 0 ORDER BY running, last_claimed LIMIT 1"
+            ).fetchone()
+            if user is None:
+                return None
+            row = self._db.execute(
+                "SELECT id, type, payload, enqueued_at, user_id FROM jobs "
+                "WHERE COALESCE(user_id, '') = ? AND status = 'queued' ORDER BY id LIMIT 1",
+                (user['user_id'],)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, worker = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), worker_id, row['id'])
+            )
+            self._adjust_user(row['user_id'], queued=-1, running=1)
+            self._db.execute(
+                "UPDATE job_users SET last_claimed = ? WHERE user_id = ?", (time.time(), user['user_id'])
+            )
+            job = dict(row)
+            job['worker'] = worker_id
+            return job
+
+    def complete(self, job):
+        with self._write():
+            deleted = self._db.execute(
+                "DELETE FROM jobs WHERE id = ? AND status = 'running' AND worker = ?", (job['id'], job['worker'])
+            ).rowcount
+            if not deleted:
+                return False
+            self._adjust_user(job['user_id'], running=-1)
+            self._db.execute(
+                "INSERT INTO counters (name, value) VALUES ('processed', 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+            )
+            return True
+
+    def requeue_stale(self, max_attempts):
+        requeued = 0
+        with self._write():
+            stale = self._db.execute(
+                "SELECT id, user_id, attempts FROM jobs WHERE status = 'running' AND NOT EXISTS ("
+                "SELECT 1 FROM leases WHERE leases.name = 'worker:' || jobs.worker AND leases.expires_at >= ?)",
+                (time.time(),)
+            ).fetchall()
+            for job in stale:
+                if job['attempts'] >= max_attempts:
+                    self._db.execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+                    self._adjust_user(job['user_id'], running=-1)
+                    continue
+                self._db.execute(
+                    "UPDATE jobs SET status = 'queued', started_at = NULL, worker = NULL WHERE id = ?", (job['id'],)
+                )
+                self._adjust_user(job['user_id'], queued=1, running=-1)
+                requeued += 1
+        return requeued
+
+    def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        with self._write():
+            return self._db.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now)
+            ).rowcount > 0
+
+    def release_lease(self, name, holder):
+        with self._write():
+            self._db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def count_leases(self, prefix):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM leases WHERE name LIKE ? AND expires_at >= ?",
+                (prefix + '%', time.time())
+            ).fetchone()[0]
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            queued = self._db.execute(
+                "SELECT COUNT(*), AVG(? - enqueued_at), MAX(? - enqueued_at) FROM jobs WHERE status = 'queued'",
+                (now, now)
+            ).fetchone()
+            users, running = self._db.execute(
+                "SELECT COALESCE(SUM(queued > 0), 0), COALESCE(SUM(running), 0) FROM job_users"
+            ).fetchone()
+            processed = self._db.execute("SELECT value FROM counters WHERE name = 'processed'").fetchone()
+        return {
+            'depth': queued[0],
+            'users': users,
+            'running': running,
+            'processed': processed[0] if processed else 0,
+            'avg_wait': queued[1] or 0.0,
+            'max_wait': queued[2] or 0.0
+        }
+
+class RedisJobStore(JobStore):
+    """
+    طابور في Redis للعمليات الموزعة على عدة أجهزة
+    الترتيب بحسب الوصول، وحد USER_MAX_INFLIGHT هو ما يمنع مستخدماً واحداً من ملء الطابور
+    """
+
+    # سحب المهمة وتسجيلها قيد التنفيذ باسم العامل في خطوة واحدة (لا تضيع إذا توقف العامل بينهما)
+    CLAIM_SCRIPT = """
+    local raw = redis.call('RPOP', KEYS[1])
+    if raw then redis.call('HSET', KEYS[2], raw, ARGV[1]) end
+    return raw
+    """
+    # الإنهاء لا يُحتسب إلا إذا كانت المهمة ما تزال محجوزة لنفس العامل
+    COMPLETE_SCRIPT = """
+    if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then return 0 end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('INCR', KEYS[3])
+    if redis.call('HINCRBY', KEYS[2], ARGV[3], -1) <= 0 then redis.call('HDEL', KEYS[2], ARGV[3]) end
+    return 1
+    """
+    # إعادة مهمة عاملها متوقف: ARGV[3] نسختها الجديدة، أو فارغ لحذفها بعد استنفاد المحاولات
+    REQUEUE_SCRIPT = """
+    if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then return 0 end
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    if ARGV[3] ~= '' then
+        redis.call('RPUSH', KEYS[2], ARGV[3])
+        return 1
+    end
+    if redis.call('HINCRBY', KEYS[3], ARGV[4], -1) <= 0 then redis.call('HDEL', KEYS[3], ARGV[4]) end
+    return 2
+    """
+    LEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        return 1
+    end
+    if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then return 1 end
+    return 0
+    """
+
+    def __init__(self, url, prefix='telegram-bot'):
+        import redis
         
-        # حفظ بيانات المستخدم
-        save_user_data(user_id, {
-            'name': name,
-            'email': email,
-            'timestamp': datetime.now().isoformat(),
-            'extraction_method': AI_SETUP['type']
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self._queue = f"{prefix}:jobs"
+        self._running = f"{prefix}:running"
+        self._inflight = f"{prefix}:inflight"
+        self._processed = f"{prefix}:processed"
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+        self._complete = self._redis.register_script(self.COMPLETE_SCRIPT)
+        self._requeue = self._redis.register_script(self.REQUEUE_SCRIPT)
+        self._lease = self._redis.register_script(self.LEASE_SCRIPT)
+
+    def _lease_key(self, name):
+        return f"{self._prefix}:lease:{name}"
+
+    def push(self, job_type, payload, max_size, user_id):
+        depth = self._redis.llen(self._queue)
+        if depth >= max_size:
+            return None
+        job_id = self._redis.incr(f"{self._prefix}:job_id")
+        raw = json.dumps({
+            'id': job_id, 'type': job_type, 'payload': payload,
+            'enqueued_at': time.time(), 'attempts': 0, 'user': user_id
         })
-        
-        # إرسال تعليمات نهائية
-        final_message = f"""
-🎉 **عملية الاستخراج اكتملت بنجاح!**
+        self._redis.hincrby(self._inflight, user_id, 1)
+        return self._redis.lpush(self._queue, raw) - 1
 
-📋 **بيانات الدخول الخاصة بك:**
-📧 **البريد الإلكتروني:** `{email}`
-🔐 **كلمة المرور:** `{password}`
+    def user_inflight(self, user_id):
+        return int(self._redis.hget(self._inflight, user_id) or 0)
 
-⚠️ **هام: احفظ هذه البيانات في مكان آمن!**
+    def claim(self, worker_id):
+        raw = self._claim(keys=[self._queue, self._running], args=[worker_id])
+        if raw is None:
+            return None
+        job = json.loads(raw)
+        job['raw'] = raw
+        job['worker'] = worker_id
+        return job
 
-🔄 **لإرسال صورة أخرى:** أرسل صورة جديدة مباشرة
-📊 **لعرض إحصائياتك:** اضغط على زر 📊 إحصائيات
-❓ **للمساعدة:** اضغط على زر 🆘 المساعدة
+    def complete(self, job):
+        return bool(self._complete(
+            keys=[self._running, self._inflight, self._processed],
+            args=[job['raw'], job['worker'], job['user']]
+        ))
 
-💡 **تذكر:** يمكنك تغيير كلمة المرور لاحقاً لأمان أفضل.
-"""
-        
-        bot.send_message(
-            message.chat.id,
-            final_message,
-            parse_mode='Markdown'
-        )
-        
-    except requests.exceptions.Timeout:
-        bot.reply_to(
-            message,
-            "⏱️ **انتهت مهلة المعالجة**\n"
-            "الرجاء إعادة المحاولة مع صورة أصغر حجماً",
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        print(f"❌ خطأ في معالجة الصورة: {e}")
-        bot.reply_to(
-            message,
-            f"❌ **حدث خطأ غير متوقع**\n"
-            f"التفاصيل: {str(e)[:100]}\n"
-            "الرجاء إعادة المحاولة لاحقاً",
-            parse_mode='Markdown'
-        )
+    def requeue_stale(self, max_attempts):
+        requeued = 0
+        for raw, worker_id in self._redis.hgetall(self._running).items():
+            if self._redis.exists(self._lease_key(worker_lease_name(worker_id))):
+                continue
+            job = json.loads(raw)
+            job['attempts'] += 1
+            # في مقدمة الطابور لأنها الأقدم
+            retry = json.dumps(job) if job['attempts'] < max_attempts else ''
+            if self._requeue(
+                keys=[self._running, self._queue, self._inflight], args=[raw, worker_id, retry, job['user']]
+            ) == 1:
+                requeued += 1
+        return requeued
 
-@bot.message_handler(content_types=['document'])
-def handle_document_message(message):
-    """معالجة الملفات المرسلة"""
-    if message.document.mime_type and message.document.mime_type.startswith('image/'):
-        # معاملة الملفات الصورية كصور
-        handle_photo_message(message)
-    else:
-        bot.reply_to(
-            message,
-            "❌ **نوع الملف غير مدعوم**\n"
-            "الرجاء إرسال صورة فقط (JPG, PNG, JPEG)",
-            parse_mode='Markdown'
-        )
+    def acquire_lease(self, name, holder, ttl):
+        return bool(self._lease(keys=[self._lease_key(name)], args=[holder, int(ttl)]))
 
-@bot.message_handler(func=lambda message: True)
-def handle_other_messages(message):
-    """معالجة الرسائل الأخرى"""
-    help_text = """
-🤖 **مرحباً! أنا بوت استخراج النصوص**
+    def release_lease(self, name, holder):
+        key = self._lease_key(name)
+        if self._redis.get(key) == holder:
+            self._redis.delete(key)
 
-📌 **للبدء، يمكنك:**
-1. إرسال صورة البطاقة أو الجواز مباشرة
-2. الضغط على زر 📸 إرسال صورة
-3. استخدام الأمر /start
+    def count_leases(self, prefix):
+        return sum(1 for _ in self._redis.scan_iter(match=self._lease_key(prefix) + '*'))
 
-❓ **للمساعدة:** /help أو زر 🆘 المساعدة
-📊 **للعرض إحصائيات:** /status أو زر 📊 إحصائيات
+    def stats(self):
+        now = time.time()
+        waits = [now - json.loads(raw)['enqueued_at'] for raw in self._redis.lrange(self._queue, -100, -1)]
+        return {
+            'depth': self._redis.llen(self._queue),
+            'users': self._redis.hlen(self._inflight),
+            'running': self._redis.hlen(self._running),
+            'processed': int(self._redis.get(self._processed) or 0),
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'max_wait': max(waits) if waits else 0.0
+        }
 
-💡 **تلميح:** أرسل صورة الآن لتبدأ!
-"""
+def create_job_store(url):
+    """إنشاء الطابور المشترك من JOB_QUEUE_URL"""
+    if url.startswith(('redis://', 'rediss://')):
+        if importlib.util.find_spec('redis') is None:
+            print("❌ JOB_QUEUE_URL يشير إلى Redis لكن مكتبة redis غير مثبتة (pip install redis)")
+            sys.exit(1)
+        print("🧰 الطابور المشترك: Redis")
+        return RedisJobStore(url)
     
-    bot.reply_to(message, help_text, parse_mode='Markdown')
+    path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else url
+    print(f"🧰 الطابور المشترك: SQLite ({path})")
+    return SQLiteJobStore(path)
+
+class SharedJobQueue:
+    """نفس واجهة ExtractionQueue لكن المهام تُنفذ في عمليات العمال عبر JobStore"""
+
+    def __init__(self, store, max_size):
+        self.store = store
+        self.max_size = max(1, max_size)
+        self._rejected = 0
+
+    def submit(self, func, *args):
+        """
+        إضافة مهمة إلى الطابور المشترك
+        تعيد عدد المهام المنتظرة قبلها (قد تبدأ فوراً إذا وُجد عامل متفرغ) أو None إذا كان ممتلئاً
+        """
+        position = self.store.push(JOB_TYPE_NAMES[func], encode_job_args(args), self.max_size, get_job_user(args))
+        if position is None:
+            self._rejected += 1
+        return position
+
+    def user_inflight(self, user_id):
+        return self.store.user_inflight(user_id)
+
+    def stats(self):
+        stats = self.store.stats()
+        return {
+            'depth': stats['depth'],
+            'users': stats['users'],
+            'busy': stats['running'],
+            'workers': self.store.count_leases('worker:'),
+            'max_size': self.max_size,
+            'processed': stats['processed'],
+            'rejected': self._rejected,
+            'avg_wait': stats['avg_wait'],
+            'max_wait': stats['max_wait']
+        }
+
+# يُفتح في open_stores() لدوري ingest وworker
+JOB_STORE = None
+
+def job_worker_loop(worker_id):
+    """حلقة عامل: سحب المهام من الطابور المشترك وتنفيذها"""
+    while True:
+        try:
+            job = JOB_STORE.claim(worker_id)
+        except Exception as e:
+            print(f"⚠️ تعذر الوصول للطابور المشترك: {e}")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        
+        try:
+            JOB_TYPES[job['type']](*decode_job_args(job['payload']))
+        except Exception as e:
+            print(f"❌ خطأ في مهمة الاستخراج {job['id']}: {e}")
+        finally:
+            if not JOB_STORE.complete(job):
+                print(f"⚠️ المهمة {job['id']} أُعيدت لعامل آخر بعد انتهاء عقد هذا العامل")
+
+def renew_worker_leases(worker_ids):
+    """تجديد عقود العمال: نبض مهامهم قيد التنفيذ وعددهم في /status"""
+    for worker_id in worker_ids:
+        JOB_STORE.acquire_lease(worker_lease_name(worker_id), INSTANCE_ID, LEADER_LEASE_TTL)
+
+def worker_heartbeat_loop(worker_ids):
+    """تجديد نبض العمال وإعادة المهام التي انتهت عقود عمالها (عمليات متوقفة)"""
+    while True:
+        time.sleep(LEADER_LEASE_TTL / 3)
+        try:
+            renew_worker_leases(worker_ids)
+            requeued = JOB_STORE.requeue_stale(JOB_MAX_ATTEMPTS)
+            if requeued:
+                print(f"♻️ أُعيدت {requeued} مهمة عالقة إلى الطابور")
+        except Exception as e:
+            print(f"⚠️ تعذر تجديد نبض العمال: {e}")
+
+def run_job_workers():
+    """تشغيل عمال الاستخراج في هذه العملية (يحجز الخيط الحالي)"""
+    worker_ids = [f"{INSTANCE_ID}:{i + 1}" for i in range(max(1, EXTRACTION_WORKERS))]
+    # العقود قبل أول سحب: مهمة عامل بلا عقد تبدو لعملية أخرى مهمة متوقفة
+    renew_worker_leases(worker_ids)
+    for worker_id in worker_ids:
+        threading.Thread(target=job_worker_loop, args=(worker_id,), name=f"job-worker-{worker_id}", daemon=True).start()
+    print(f"⚙️ {len(worker_ids)} عامل استخراج يسحبون المهام من الطابور المشترك")
+    worker_heartbeat_loop(worker_ids)
+
+def renew_leader_lease(stop):
+    """تجديد عقد القيادة؛ إيقاف Polling إذا أخذته عملية أخرى"""
+    while not stop.wait(LEADER_LEASE_TTL / 3):
+        try:
+            renewed = JOB_STORE.acquire_lease('poller', INSTANCE_ID, LEADER_LEASE_TTL)
+        except Exception as e:
+            print(f"⚠️ تعذر تجديد عقد القيادة: {e}")
+            continue
+        if not renewed:
+            bot.stop_polling()
+            return
+
+def run_leader_polling():
+    """Polling من عملية استقبال واحدة فقط: صاحبة عقد القيادة، والبقية تنتظر لتحل محلها"""
+    try:
+        while True:
+            if not JOB_STORE.acquire_lease('poller', INSTANCE_ID, LEADER_LEASE_TTL):
+                time.sleep(LEADER_LEASE_TTL / 3)
+                continue
+            
+            print("👑 هذه العملية تحمل عقد القيادة وتستقبل التحديثات")
+            stop = threading.Event()
+            threading.Thread(target=renew_leader_lease, args=(stop,), name="leader-lease", daemon=True).start()
+            try:
+                # مهلة الاستطلاع أقصر من مدة العقد حتى ينتهي آخر طلب قبل أن يبدأ القائد الجديد
+                bot.polling(none_stop=True, interval=0, timeout=60, long_polling_timeout=min(20, LEADER_LEASE_TTL // 2))
+            finally:
+                stop.set()
+            print("⚠️ فقدت العملية عقد القيادة، بانتظار استعادته")
+    finally:
+        JOB_STORE.release_lease('poller', INSTANCE_ID)
 
 # ============= دعم Webhook للخدمات السحابية =============
+WEBHOOK_PORT = int(os.environ.get('PORT', '8000'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_DISPATCHERS = int(os.environ.get('WEBHOOK_DISPATCHERS', '2'))
+# سر ثابت مشتق من التوكن إذا لم يُحدد، حتى تتفق عليه جميع النسخ خلف موازن الحمل
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]
+
+UPDATE_QUEUE = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+Gauge('bot_update_queue_depth', 'Webhook updates waiting for dispatch', func=UPDATE_QUEUE.qsize)
+
 def setup_webhook():
-    """إعداد Webhook للخدمات التي تدعمه"""
+    """
+    إعداد Webhook عند تعيين WEBHOOK_URL صراحةً (على أي منصة، بما فيها الخوادم الخاصة)
+    بدون رابط يعمل البوت بنمط Polling
+    """
+    webhook_url = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+    if not webhook_url:
+        return False
+    
     try:
-        # الحصول على رابط Webhook من متغيرات البيئة
-        webhook_url = os.environ.get('WEBHOOK_URL')
+        bot.remove_webhook()
+        bot.set_webhook(url=f"{webhook_url}/{TELEGRAM_TOKEN}", secret_token=WEBHOOK_SECRET)
+        print(f"✅ Webhook معين على: {webhook_url} (المنصة: {PLATFORM})")
+        return True
+    except Exception as e:
+        print(f"⚠️ تعذر تعيين Webhook، سيتم استخدام Polling: {e}")
+    
+    return False
+
+def dispatch_updates_loop():
+    """سحب التحديثات من الطابور وتمريرها لمعالجات البوت"""
+    while True:
+        update = UPDATE_QUEUE.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            print(f"❌ خطأ في معالجة التحديث: {e}")
+
+def json_response(start_response, status, payload):
+    """إرسال استجابة JSON"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    start_response(status, [
+        ('Content-Type', 'application/json; charset=utf-8'),
+        ('Content-Length', str(len(body)))
+    ])
+    return [body]
+
+def webhook_app(environ, start_response):
+    """تطبيق WSGI: استقبال تحديثات تيليجرام، وباقي المسارات لـ metrics_app"""
+    path = environ.get('PATH_INFO', '')
+    method = environ.get('REQUEST_METHOD', 'GET')
+    
+    if path == f"/{TELEGRAM_TOKEN}" and method == 'POST':
+        if environ.get('HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN') != WEBHOOK_SECRET:
+            return json_response(start_response, '403 Forbidden', {'error': 'invalid secret token'})
         
-        if webhook_url and PLATFORM in ['Render.com', 'Railway.app', 'Koyeb.com', 'Cyclic.sh']:
-            bot.remove_webhook()
-            bot.set_webhook(url=f"{webhook_url}/{TELEGRAM_TOKEN}")
-            print(f"✅ Webhook معين على: {webhook_url}")
-            return True
-    except:
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            update = telebot.types.Update.de_json(environ['wsgi.input'].read(length).decode('utf-8'))
+        except Exception:
+            return json_response(start_response, '400 Bad Request', {'error': 'invalid update'})
+        
+        try:
+            UPDATE_QUEUE.put_nowait(update)
+        except queue.Full:
+            # تيليجرام يعيد إرسال التحديث لاحقاً
+            return json_response(start_response, '503 Service Unavailable', {'error': 'busy'})
+        
+        return json_response(start_response, '200 OK', {'ok': True})
+    
+    return metrics_app(environ, start_response)
+
+def health_payload():
+    """بيانات فحص الصحة"""
+    return {
+        'status': 'ok',
+        'platform': PLATFORM,
+        'engine': get_engine_label(),
+        'uptime': int(time.time() - START_TIME),
+        'rss_bytes': process_rss_bytes(),
+        'update_queue': UPDATE_QUEUE.qsize(),
+        'extraction_queue': EXTRACTION_QUEUE.stats()['depth']
+    }
+
+def metrics_app(environ, start_response):
+    """تطبيق WSGI: مقاييس Prometheus وفحص الصحة"""
+    path = environ.get('PATH_INFO', '')
+    method = environ.get('REQUEST_METHOD', 'GET')
+    
+    if path == '/metrics' and method in ('GET', 'HEAD'):
+        body = render_metrics().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))
+        ])
+        return [body]
+    
+    if path in ('/healthz', '/') and method in ('GET', 'HEAD'):
+        return json_response(start_response, '200 OK', health_payload())
+    
+    return json_response(start_response, '404 Not Found', {'error': 'not found'})
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """خادم WSGI متعدد الخيوط"""
+    daemon_threads = True
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """تعطيل سجل الطلبات (المسار يحتوي على توكن البوت)"""
+
+    def log_message(self, format, *args):
         pass
+
+def run_webhook_server():
+    """تشغيل خادم Webhook المدمج (يحجز الخيط الحالي)"""
+    for i in range(WEBHOOK_DISPATCHERS):
+        threading.Thread(target=dispatch_updates_loop, name=f"update-dispatcher-{i + 1}", daemon=True).start()
     
-    return False
+    server = make_server(
+        '0.0.0.0',
+        WEBHOOK_PORT,
+        webhook_app,
+        server_class=ThreadingWSGIServer,
+        handler_class=QuietRequestHandler
+    )
+    print(f"🌐 خادم Webhook يستمع على المنفذ {WEBHOOK_PORT} (/healthz للفحص، /metrics للمقاييس)")
+    server.serve_forever()
+
+def start_metrics_server():
+    """تشغيل خادم /metrics في الخلفية لنمط Polling (إذا حُدد METRICS_PORT)"""
+    if not METRICS_PORT:
+        return
+    
+    try:
+        server = make_server(
+            '0.0.0.0',
+            METRICS_PORT,
+            metrics_app,
+            server_class=ThreadingWSGIServer,
+            handler_class=QuietRequestHandler
+        )
+    except OSError as e:
+        print(f"⚠️ تعذر تشغيل خادم المقاييس على المنفذ {METRICS_PORT}: {e}")
+        return
+    
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"📈 المقاييس متاحة على المنفذ {METRICS_PORT} (/metrics)")
 
 # ============= بدء التشغيل =============
 def start_bot():
@@ -866,23 +4661,42 @@ def start_bot():
     print("=" * 60)
     
     try:
+        # فحص المحركات في الخلفية بينما يبدأ الاستقبال مباشرة
+        start_background_health_check()
+        
         # الحصول على معلومات البوت
         bot_info = bot.get_me()
+        mark_startup_phase('الاتصال بتيليجرام (get_me)')
         print(f"✅ البوت: {bot_info.first_name} (@{bot_info.username})")
         print(f"🆔 المعرف: {bot_info.id}")
         print(f"🌐 المنصة: {PLATFORM}")
-        print(f"🤖 المحرك: {'Gemini AI' if AI_SETUP['available'] else 'OCR Space'}")
+        print(f"🤖 المحرك: {get_engine_label()}")
+        
+        # عامل الاستخراج لا يستقبل تحديثات: ينفذ مهام الطابور المشترك فقط
+        if BOT_ROLE == 'worker':
+            print("⚙️ البوت يعمل كعامل استخراج")
+            start_metrics_server()
+            report_startup_profile()
+            run_job_workers()
+            return True
         
         # محاولة إعداد Webhook
         if setup_webhook():
             print("🔗 البوت يعمل بنمط Webhook")
+            report_startup_profile()
+            run_webhook_server()
             return True
         else:
             print("🔄 البوت يعمل بنمط Polling")
             print("📱 اذهب إلى تيليجرام وأرسل /start")
+            start_metrics_server()
+            report_startup_profile()
             
-            # تشغيل Polling
-            bot.polling(none_stop=True, interval=0, timeout=60)
+            # تشغيل Polling (عمليات الاستقبال المتعددة تتناوب عليه بعقد القيادة)
+            if BOT_ROLE == 'ingest':
+                run_leader_polling()
+            else:
+                bot.polling(none_stop=True, interval=0, timeout=60)
             return True
             
     except Exception as e:
@@ -894,15 +4708,508 @@ def start_bot():
         print("4. جرب إعادة تشغيل البوت")
         return False
 
+# ============= وضع التشغيل غير المتزامن (asyncio) =============
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'sync').lower()  # sync | async
+ASYNC_MAX_INFLIGHT = int(os.environ.get('ASYNC_MAX_INFLIGHT', '200'))
+ASYNC_HTTP_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_CONNECTIONS', '100'))
+# خيوط الاستدعاءات المتزامنة في نمط asyncio (معالجات الأوامر، قاعدة البيانات، بناء ملف النتائج)
+ASYNC_SYNC_THREADS = max(1, int(os.environ.get('ASYNC_SYNC_THREADS', '4')))
+HTTP_TIMEOUT = 30
+
+# حالة وقت التشغيل غير المتزامن (البوت، جلسة aiohttp، حدود التزامن)
+ASYNC_RUNTIME = {}
+
+async def extract_with_gemini_async(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص باستخدام Gemini AI (غير متزامن)"""
+    model = AI_SETUP['model'] or await asyncio.to_thread(get_gemini_model)
+    images = await asyncio.to_thread(fit_images_to_budget, [(image_bytes, mime_type)])
+    request = build_gemini_batch_request(images)
+    response = await model.generate_content_async(request)
+    await asyncio.to_thread(record_gemini_usage, response, request, images)
+    # الإصلاح (عند الحاجة فقط) طلب متزامن، لذا يجري التحليل خارج حلقة asyncio
+    return await asyncio.to_thread(parse_gemini_output, response.text, repair_gemini_json)
+
+async def extract_with_ocr_async(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص باستخدام OCR.space عبر جلسة aiohttp المشتركة"""
+    import aiohttp
+    
+    payload = aiohttp.FormData()
+    # aiohttp يقبل قيم نصية فقط في بيانات النموذج
+    for key, value in build_ocr_payload(mime_type).items():
+        payload.add_field(key, str(value))
+    payload.add_field('file', image_bytes, filename=ocr_file_name(mime_type), content_type=mime_type)
+    
+    async with ASYNC_RUNTIME['session'].post(OCR_API_URL, data=payload) as response:
+        if response.status != 200:
+            raise ExtractionError(
+                f"OCR.space HTTP {response.status}",
+                retryable=response.status == 429 or response.status >= 500
+            )
+        return parse_ocr_response(await response.json(content_type=None))
+
+async def extract_with_tesseract_async(image_bytes, mime_type='image/jpeg'):
+    """استخراج النصوص محلياً باستخدام Tesseract دون حجز حلقة asyncio"""
+    future = get_tesseract_pool().submit(run_tesseract, image_bytes, TESSERACT_LANG)
+    text = await asyncio.wait_for(asyncio.wrap_future(future), TESSERACT_TIMEOUT)
+    return parse_ocr_text(text)
+
+ENGINES['gemini']['extract_async'] = extract_with_gemini_async
+ENGINES['ocr']['extract_async'] = extract_with_ocr_async
+ENGINES['tesseract']['extract_async'] = extract_with_tesseract_async
+
+async def run_engine_async(engine, image_bytes, mime_type):
+    """استدعاء محرك واحد (غير متزامن) مع حد التزامن وتسجيل الزمن والنتيجة"""
+    started = time.monotonic()
+    try:
+        async with ASYNC_RUNTIME['engine_semaphores'][engine['name']]:
+            if engine['extract_async']:
+                result = await engine['client'].call_async(engine['extract_async'], image_bytes, mime_type)
+            else:
+                result = await asyncio.to_thread(engine['client'].call, engine['extract'], image_bytes, mime_type)
+    except Exception as e:
+        record_engine_call(engine, time.monotonic() - started, e)
+        raise
+    
+    record_engine_call(engine, time.monotonic() - started)
+    result['engine'] = engine['name']
+    return result
+
+async def extract_with_fallback_async(engines, image_bytes, mime_type):
+    """تجربة المحركات بالترتيب حتى يعيد أحدها نصوصاً (غير متزامن)"""
+    result = None
+    for engine in engines:
+        try:
+            result = await run_engine_async(engine, image_bytes, mime_type)
+        except Exception as e:
+            print(f"❌ خطأ في {engine['label']}: {e}")
+            continue
+        if has_extracted_text(result):
+            return result
+    return result or empty_result()
+
+async def extract_hedged_async(engines, image_bytes, mime_type):
+    """نسخة asyncio من الطلبات الاحتياطية: أول نتيجة تحتوي نصوصاً تفوز"""
+    primary, secondary = engines[0], engines[1]
+    tasks = {asyncio.create_task(run_engine_async(primary, image_bytes, mime_type)): primary}
+    hedge_delay = primary['stats'].hedge_delay()
+    hedged = False
+    
+    try:
+        while tasks:
+            timeout = None if hedged else hedge_delay
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            
+            if not done:
+                print(f"⏳ {primary['label']} تجاوز {hedge_delay:.1f} ث، إرسال طلب احتياطي إلى {secondary['label']}")
+                tasks[asyncio.create_task(run_engine_async(secondary, image_bytes, mime_type))] = secondary
+                hedged = True
+                continue
+            
+            for task in done:
+                engine = tasks.pop(task)
+                if task.exception():
+                    print(f"❌ خطأ في {engine['label']}: {task.exception()}")
+                elif has_extracted_text(task.result()):
+                    return task.result()
+            
+            if not hedged and not tasks:
+                tasks[asyncio.create_task(run_engine_async(secondary, image_bytes, mime_type))] = secondary
+                hedged = True
+    finally:
+        # إلغاء الطلب الخاسر
+        for task in tasks:
+            task.cancel()
+    
+    return await extract_with_fallback_async(engines[2:], image_bytes, mime_type)
+
+async def extract_text_from_image_async(image_bytes, mime_type='image/jpeg'):
+    """الدالة الرئيسية لاستخراج النصوص (غير متزامنة)"""
+    # ترتيب المحركات يقرأ ميزانية المستخدم من قاعدة البيانات
+    engines = await asyncio.to_thread(rank_engines)
+    if not engines:
+        print("❌ لا يوجد محرك استخراج متوفر")
+        return empty_result()
+    
+    if HEDGE_REQUESTS and len(engines) > 1:
+        return await extract_hedged_async(engines, image_bytes, mime_type)
+    return await extract_with_fallback_async(engines, image_bytes, mime_type)
+
+class AsyncProgressReporter:
+    """نسخة asyncio من ProgressReporter: نفس دمج التحديثات باستخدام مهمة مؤجلة بدلاً من مؤقت"""
+
+    def __init__(self, message):
+        self.message = message
+        self.status_msg = None
+        self._pending = None
+        self._shown = None
+        self._pending_since = 0.0
+        self._next_at = 0.0
+        self._task = None
+        self._closed = False
+        self._lock = asyncio.Lock()
+
+    def update(self, text):
+        """تسجيل حالة جديدة دون انتظار الإرسال"""
+        if self._closed:
+            return
+        self._pending = text
+        self._pending_since = time.monotonic()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later(self._flush_delay()))
+
+    def _flush_delay(self):
+        now = time.monotonic()
+        return max(self._pending_since + PROGRESS_THRESHOLD, self._next_at) - now
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(max(0.0, delay))
+        # بعد الاستيقاظ لا تُلغى المهمة حتى لا ينقطع إرسال جارٍ
+        self._task = None
+        async with self._lock:
+            if self._closed or self._pending is None or self._pending == self._shown:
+                return
+            if self._flush_delay() > 0:
+                self._task = asyncio.create_task(self._flush_later(self._flush_delay()))
+                return
+            
+            wait_time = PROGRESS_BUDGET.try_acquire() if PROGRESS_BUDGET is not None else 0.0
+            if wait_time:
+                self._task = asyncio.create_task(self._flush_later(max(wait_time, PROGRESS_MIN_INTERVAL)))
+                return
+            
+            try:
+                await self._show(self._pending)
+            except Exception as e:
+                print(f"⚠️ تعذر تحديث رسالة الحالة: {e}")
+            self._next_at = time.monotonic() + PROGRESS_MIN_INTERVAL
+
+    async def _show(self, text):
+        if self.status_msg is None:
+            self.status_msg = await asyncio.wrap_future(
+                OUTBOX.reply_to(self.message, text, parse_mode='Markdown')
+            )
+        else:
+            await asyncio.wrap_future(OUTBOX.edit_message_text(
+                text,
+                chat_id=self.status_msg.chat.id,
+                message_id=self.status_msg.message_id,
+                parse_mode='Markdown'
+            ))
+        self._shown = text
+
+    async def _close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # انتظار أي إرسال جارٍ حتى تستقر رسالة الحالة
+        async with self._lock:
+            pass
+
+    async def fail(self, text):
+        await self._close()
+        await self._show(text)
+
+    async def finish(self):
+        await self._close()
+        if self.status_msg is not None:
+            OUTBOX.delete_message(
+                chat_id=self.status_msg.chat.id,
+                message_id=self.status_msg.message_id
+            )
+
+async def send_extraction_output_async(message, extraction_result):
+    """إرسال ملف النتائج مع الملخص وبيانات الدخول في التعليق (غير متزامن)"""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    output = await loop.run_in_executor(
+        ASYNC_RUNTIME['sync_executor'], build_extraction_output, message, extraction_result
+    )
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='build')
+    
+    started = time.perf_counter()
+    await asyncio.wrap_future(OUTBOX.send_document(
+        chat_id=message.chat.id,
+        document=output['document'],
+        caption=output['caption'],
+        parse_mode='Markdown'
+    ))
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='send')
+    
+    # الكتابة في قاعدة بيانات المستخدمين (SQLite) عملية حاجبة
+    await loop.run_in_executor(
+        ASYNC_RUNTIME['sync_executor'], record_extraction, str(message.from_user.id), output
+    )
+
+async def process_photo_job_async(message):
+    """قبول الصورة (الحجم وحدود المستخدم) ثم استخراجها داخل حلقة asyncio"""
+    if reject_oversized_file(message, IMAGE_MAX_BYTES, 'photo'):
+        return
+    # الألبومات تُجمع وتُقبل مرة واحدة ثم تُعالج كمهمة واحدة في طابور الاستخراج
+    if message.media_group_id:
+        MEDIA_GROUPS.add(message)
+        return
+    
+    user_id = str(message.from_user.id)
+    if not admit_upload(message, user_inflight_total(user_id)):
+        return
+    
+    user_inflight = ASYNC_RUNTIME['user_inflight']
+    user_inflight[user_id] = user_inflight.get(user_id, 0) + 1
+    try:
+        await run_photo_job_async(message)
+    finally:
+        user_inflight[user_id] -= 1
+        if not user_inflight[user_id]:
+            del user_inflight[user_id]
+
+async def download_message_image_async(photo_size, timer):
+    """تحميل مقاس صورة عبر جلسة aiohttp المشتركة، تعيد None عند الفشل"""
+    with timer.stage('get_file'):
+        file_info = cached_file_info(photo_size)
+        if file_info is None:
+            file_info = await ASYNC_RUNTIME['bot'].get_file(photo_size.file_id)
+            cache_file_info(photo_size, file_info)
+    check_file_size(file_info.file_size, IMAGE_MAX_BYTES)
+    
+    with timer.stage('download'):
+        async with ASYNC_RUNTIME['session'].get(telegram_file_url(file_info.file_path)) as response:
+            if response.status != 200:
+                return None
+            check_file_size(response.content_length, IMAGE_MAX_BYTES)
+            buffer = BytesIO()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+                check_file_size(buffer.tell(), IMAGE_MAX_BYTES)
+            return buffer.getvalue()
+
+async def extract_text_cached_async(image_bytes, timer, similar=True):
+    """نسخة غير متزامنة من extract_text_cached: الأعمال الثقيلة في خيوط منفصلة والمحرك عبر aiohttp"""
+    content_key = cache_key_for_content(image_bytes)
+    result = EXTRACTION_CACHE.get(content_key)
+    hashes = None
+    if result is None and similar:
+        with timer.stage('phash'):
+            hashes = await asyncio.to_thread(perceptual_hashes, image_bytes)
+        result = find_similar_result(hashes)
+    if result is not None:
+        return result
+    
+    with timer.stage('preprocess'):
+        prepared_bytes, mime_type = await asyncio.to_thread(preprocess_image, image_bytes)
+    with timer.stage('mrz'):
+        result = await asyncio.to_thread(extract_mrz_fast_path, prepared_bytes, mime_type)
+    if result is None:
+        with timer.stage('extract'):
+            result = await extract_text_from_image_async(prepared_bytes, mime_type)
+    if has_extracted_text(result):
+        EXTRACTION_CACHE.set(content_key, result)
+        remember_similar_image(hashes, content_key)
+    return result
+
+async def extract_message_photo_async(message, file_key, timer, progress):
+    """نسخة غير متزامنة من extract_message_photo"""
+    largest = get_message_file(message)
+    photo_size = select_photo_size(message)
+    image_bytes = await download_message_image_async(photo_size, timer)
+    if image_bytes is None:
+        return None
+    
+    progress.update(
+        "🤖 **جاري تحليل الصورة واستخراج النصوص...**\n"
+        f"المحرك: {get_engine_label()}"
+    )
+    result = await extract_text_cached_async(image_bytes, timer)
+    
+    if photo_size.file_unique_id != largest.file_unique_id and is_low_confidence(result):
+        print(f"🔍 نتيجة ضعيفة من مقاس {photo_size.width}x{photo_size.height}: إعادة المحاولة بأكبر مقاس")
+        PHOTO_ESCALATIONS.inc()
+        image_bytes = await download_message_image_async(largest, timer)
+        if image_bytes is not None:
+            result = pick_escalated_result(result, await extract_text_cached_async(image_bytes, timer, similar=False))
+    
+    if has_extracted_text(result):
+        EXTRACTION_CACHE.set(file_key, result)
+    return result
+
+async def run_photo_job_async(message):
+    """تنفيذ عملية الاستخراج الكاملة لصورة داخل حلقة asyncio"""
+    async with ASYNC_RUNTIME['inflight']:
+        progress = AsyncProgressReporter(message)
+        CURRENT_USER.set(str(message.from_user.id))
+        try:
+            file_key = cache_key_for_file(get_message_file(message).file_unique_id)
+            extraction_result = EXTRACTION_CACHE.get(file_key)
+            if extraction_result is not None:
+                await send_extraction_output_async(message, extraction_result)
+                EXTRACTIONS.inc(kind='photo', outcome='ok')
+                return
+            
+            progress.update(
+                "📥 **جاري تحميل الصورة...**\n"
+                "⏳ الرجاء الانتظار قليلاً"
+            )
+            
+            timer = StageTimer(f"صورة {get_message_file(message).file_unique_id}")
+            extraction_result = await extract_message_photo_async(message, file_key, timer, progress)
+            timer.report()
+            if extraction_result is None:
+                EXTRACTIONS.inc(kind='photo', outcome='download_failed')
+                await progress.fail(DOWNLOAD_FAILED_TEXT)
+                return
+            if not has_extracted_text(extraction_result):
+                EXTRACTIONS.inc(kind='photo', outcome='empty')
+                await progress.fail(NO_TEXT_FOUND_TEXT)
+                return
+            
+            progress.update("📤 **جاري إرسال النتائج...**")
+            await send_extraction_output_async(message, extraction_result)
+            await progress.finish()
+            EXTRACTIONS.inc(kind='photo', outcome='ok')
+            
+        except FileTooLargeError as e:
+            EXTRACTIONS.inc(kind='photo', outcome='too_large')
+            await progress.fail(build_file_too_large_text(e.limit))
+        except asyncio.TimeoutError:
+            EXTRACTIONS.inc(kind='photo', outcome='timeout')
+            await progress.fail(TIMEOUT_TEXT)
+        except Exception as e:
+            print(f"❌ خطأ في معالجة الصورة: {e}")
+            EXTRACTIONS.inc(kind='photo', outcome='error')
+            await progress.fail(build_unexpected_error_text(e))
+
+async def on_first_update_async(messages):
+    """مستمع التحديثات في نمط asyncio"""
+    on_first_update(messages)
+
+async def forward_to_sync_handlers(message):
+    """
+    تمرير باقي الرسائل إلى معالجات البوت المتزامنة (الأوامر والأزرار)
+    المعالجات تستدعي قاعدة البيانات والطوابير المتزامنة فتعمل في خيوط منفصلة لا داخل حلقة asyncio
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(ASYNC_RUNTIME['sync_executor'], bot.process_new_messages, [message])
+
+async def run_async_bot():
+    """تشغيل البوت باستخدام العميل غير المتزامن وجلسة aiohttp مشتركة"""
+    import aiohttp
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    
+    if TELEGRAM_API_URL != 'https://api.telegram.org':
+        asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+        asyncio_helper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+    async_bot = AsyncTeleBot(TELEGRAM_TOKEN)
+    connector = aiohttp.TCPConnector(limit=ASYNC_HTTP_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    
+    # الرسائل الصادرة تمر عبر OUTBOX (طابور بخيط إرسال مستقل يعيد Future) فلا تحجب الحلقة،
+    # أما الاستدعاءات المتزامنة الأخرى (المعالجات، قاعدة البيانات) فتعمل في هذا المنفذ
+    sync_executor = ThreadPoolExecutor(max_workers=ASYNC_SYNC_THREADS, thread_name_prefix='async-sync')
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        ASYNC_RUNTIME.update({
+            'bot': async_bot,
+            'session': session,
+            'sync_executor': sync_executor,
+            'inflight': asyncio.Semaphore(ASYNC_MAX_INFLIGHT),
+            # مهام كل مستخدم الجارية (لحد USER_MAX_INFLIGHT)
+            'user_inflight': {},
+            'engine_semaphores': {
+                name: asyncio.Semaphore(ENGINE_CONCURRENCY.get(name, 2))
+                for name in ENGINES
+            }
+        })
+        
+        async_bot.register_message_handler(process_photo_job_async, content_types=['photo'])
+        async_bot.register_message_handler(
+            process_photo_job_async,
+            content_types=['document'],
+            func=is_image_document
+        )
+        async_bot.register_message_handler(
+            forward_to_sync_handlers,
+            content_types=['text', 'document'],
+            func=lambda message: True
+        )
+        
+        async_bot.set_update_listener(on_first_update_async)
+        start_background_health_check()
+        
+        bot_info = await async_bot.get_me()
+        mark_startup_phase('الاتصال بتيليجرام (get_me)')
+        print(f"✅ البوت: {bot_info.first_name} (@{bot_info.username})")
+        print(f"🆔 المعرف: {bot_info.id}")
+        print(f"🌐 المنصة: {PLATFORM}")
+        print(f"🤖 المحرك: {get_engine_label()}")
+        print("⚡ البوت يعمل بنمط asyncio (Polling)")
+        print("📱 اذهب إلى تيليجرام وأرسل /start")
+        start_metrics_server()
+        report_startup_profile()
+        
+        try:
+            await async_bot.polling(non_stop=True, interval=0, timeout=60)
+        finally:
+            sync_executor.shutdown(wait=False)
+
+def start_bot_async():
+    """بدء تشغيل البوت بنمط asyncio"""
+    print("\n" + "=" * 60)
+    print("🚀 بدء تشغيل البوت (asyncio)...")
+    print("=" * 60)
+    
+    try:
+        asyncio.run(run_async_bot())
+        return True
+    except ImportError as e:
+        print(f"❌ نمط asyncio يتطلب مكتبة aiohttp: {e}")
+        return False
+    except Exception as e:
+        print(f"❌ خطأ في تشغيل البوت: {e}")
+        return False
+
 # ============= نقطة الدخول الرئيسية =============
-if __name__ == "__main__":
+def open_stores():
+    """
+    فتح المخازن المحددة في الإعدادات: قاعدة المستخدمين، ذاكرة النتائج على القرص، والطابور المشترك
+    استيراد الوحدة لا يفتح أي ملف: عمليات spawn لمجموعة Tesseract تعيد تنفيذ هذا الملف
+    باسم __mp_main__ فلا تصل إلى main()
+    """
+    global USER_STORE, EXTRACTION_CACHE, JOB_STORE, EXTRACTION_QUEUE
+    USER_STORE = create_user_store()
+    if CACHE_BACKEND == 'sqlite':
+        EXTRACTION_CACHE = ExtractionCache(CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, db_path=CACHE_PATH)
+    if BOT_ROLE in ('ingest', 'worker'):
+        JOB_STORE = create_job_store(JOB_QUEUE_URL)
+        # المهام تذهب إلى الطابور المشترك بدلاً من عمال هذه العملية
+        EXTRACTION_QUEUE = SharedJobQueue(JOB_STORE, EXTRACTION_QUEUE_SIZE)
+    mark_startup_phase('فتح المخازن')
+
+def main():
+    """تشغيل البوت من سطر الأوامر"""
+    print("=" * 60)
+    print("🚀 بوت استخراج النصوص بالذكاء الاصطناعي")
+    print("=" * 60)
+    
     # عرض معلومات النظام
     print(f"\n📋 معلومات النظام:")
+    print(f"• المنصة: {PLATFORM}")
     print(f"• نظام التشغيل: {sys.platform}")
     print(f"• إصدار Python: {sys.version.split()[0]}")
     print(f"• المسار: {os.path.dirname(os.path.abspath(__file__))}")
     
-    # بدء البوت
-    if not start_bot():
+    open_stores()
+    
+    # بدء البوت (المتزامن افتراضياً، أو asyncio عبر BOT_RUNTIME=async أو --async)
+    # نمط asyncio يعالج الصور داخل حلقته، فأدوار الاستقبال والعمال تعمل بالنمط المتزامن
+    if (BOT_RUNTIME == 'async' or '--async' in sys.argv) and BOT_ROLE == 'all':
+        started = start_bot_async()
+    else:
+        started = start_bot()
+    
+    if not started:
         print("\n❌ فشل تشغيل البوت. تحقق من الأخطاء أعلاه.")
         sys.exit(1)
+
+if __name__ == "__main__":
+    main()
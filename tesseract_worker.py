@@ -0,0 +1,20 @@
+"""
+تشغيل Tesseract داخل عمليات ProcessPoolExecutor
+
+العمليات تُنشأ بطريقة spawn لا fork: نسخ عملية البوت متعددة الخيوط قد يورث العملية
+الجديدة أقفالاً محجوزة (السجلات، المكتبات، الاتصالات). الدالة في وحدة مستقلة بلا آثار جانبية
+حتى تستوردها كل عملية دون الاعتماد على محتوى main.py، الذي يعاد تنفيذه فيها باسم __mp_main__
+(تعريفات فقط: المخازن والتشغيل في main()).
+"""
+
+from io import BytesIO
+
+def run_tesseract(image_bytes, lang, config=''):
+    """تشغيل Tesseract على صورة وإعادة النص (تُنفذ داخل عملية منفصلة)"""
+    import pytesseract
+    from PIL import Image
+    try:
+        return pytesseract.image_to_string(Image.open(BytesIO(image_bytes)), lang=lang, config=config)
+    except pytesseract.TesseractNotFoundError as e:
+        # هذا الاستثناء لا يُعاد إنشاؤه في العملية الأم (بلا معاملات)، وفشل نقله يعطل مجموعة العمليات كلها
+        raise RuntimeError(str(e)) from None
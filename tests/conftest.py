@@ -0,0 +1,17 @@
+"""
+إعداد الاختبارات: main.py يقرأ الإعدادات عند استيراده (والمخازن تُفتح في main() فقط)،
+لذا تُحدد متغيرات البيئة قبل أول استيراد (توكن وهمي ومخازن في الذاكرة)
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+os.environ['USER_STORE_BACKEND'] = 'memory'
+os.environ['CACHE_BACKEND'] = 'memory'
+os.environ['BOT_ROLE'] = 'all'
+os.environ.setdefault('GEMINI_API_KEY', '')
@@ -0,0 +1,92 @@
+import json
+import zipfile
+from concurrent.futures import Future
+
+import pytest
+
+import main
+
+RESULT = {'name': 'علي', 'arabic_texts': ['سطر'], 'english_texts': ['LINE']}
+
+class FakeProgress:
+    def __init__(self, message):
+        self.failed = []
+        self.finished = False
+
+    def update(self, text):
+        pass
+
+    def fail(self, text):
+        self.failed.append(text)
+
+    def finish(self):
+        self.finished = True
+
+def bulk_message():
+    return main.telebot.types.Message.de_json({
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 7, 'type': 'private'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'test'},
+        'document': {'file_id': 'f1', 'file_unique_id': 'u1', 'file_name': 'scans.zip', 'mime_type': 'application/zip'}
+    })
+
+@pytest.fixture
+def bulk_env(monkeypatch):
+    """تحميل ZIP من ثلاث صور ومحرك وهمي، مع تسجيل الملف المرسل وتقارير التقدم"""
+    env = {'sent': [], 'progress': [], 'extracted': []}
+
+    def download(message, fileobj, timer):
+        with zipfile.ZipFile(fileobj, 'w') as archive:
+            for i in range(3):
+                archive.writestr(f'page{i}.png', f'image-{i}')
+        fileobj.flush()
+        return True
+
+    def extract(image_bytes, file_key=None, timer=None, similar=True):
+        env['extracted'].append(image_bytes)
+        return dict(RESULT)
+
+    def send_document(**kwargs):
+        env['sent'].append(kwargs['document'].read().decode('utf-8'))
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def progress(message):
+        reporter = FakeProgress(message)
+        env['progress'].append(reporter)
+        return reporter
+
+    monkeypatch.setattr(main, 'BULK_OUTPUT_FORMAT', 'jsonl')
+    monkeypatch.setattr(main, 'download_document_to', download)
+    monkeypatch.setattr(main, 'extract_text_cached', extract)
+    monkeypatch.setattr(main.OUTBOX, 'send_document', send_document)
+    monkeypatch.setattr(main, 'ProgressReporter', progress)
+    return env
+
+def test_bulk_job_runs_under_shared_queue(bulk_env, monkeypatch, tmp_path):
+    store = main.SQLiteJobStore(str(tmp_path / 'jobs.db'))
+    monkeypatch.setattr(main, 'EXTRACTION_QUEUE', main.SharedJobQueue(store, 10))
+    assert main.EXTRACTION_QUEUE.submit(main.process_bulk_job, bulk_message()) == 0
+
+    # عامل يسحب مهمة الدفعة وينفذها كما في job_worker_loop
+    job = store.claim('w1')
+    main.JOB_TYPES[job['type']](*main.decode_job_args(job['payload']))
+    assert store.complete(job)
+
+    reporter, = bulk_env['progress']
+    assert reporter.failed == [] and reporter.finished
+    rows = [json.loads(line) for line in bulk_env['sent'][0].splitlines()]
+    assert [(row['index'], row['status']) for row in rows] == [(1, 'ok'), (2, 'ok'), (3, 'ok')]
+    assert sorted(bulk_env['extracted']) == [b'image-0', b'image-1', b'image-2']
+    # الصفحات لم تُضف إلى الطابور المشترك
+    assert store.stats()['depth'] == 0
+
+def test_bulk_pages_are_not_charged_per_image(bulk_env, monkeypatch):
+    charged = []
+    monkeypatch.setattr(main, 'check_user_rate', lambda user_id: charged.append(user_id))
+    main.process_bulk_job(bulk_message())
+    assert bulk_env['progress'][0].failed == []
+    assert len(bulk_env['sent']) == 1
+    assert charged == []
@@ -0,0 +1,128 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+RESULT = {'name': 'علي', 'arabic_texts': ['سطر'], 'english_texts': ['LINE']}
+
+# ============= ذاكرة نتائج الاستخراج =============
+def test_cache_get_set_and_stats():
+    cache = main.ExtractionCache(60, 10, 1024 * 1024)
+    assert cache.get('a') is None
+    cache.set('a', RESULT)
+    assert cache.get('a') == RESULT
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['backend']) == (1, 1, 1, 'memory')
+
+def test_cache_evicts_least_recently_used():
+    cache = main.ExtractionCache(60, 2, 1024 * 1024)
+    cache.set('a', RESULT)
+    cache.set('b', RESULT)
+    cache.get('a')
+    cache.set('c', RESULT)
+    assert cache.get('b') is None
+    assert cache.get('a') == RESULT and cache.get('c') == RESULT
+
+def test_cache_evicts_by_size():
+    size = len(json.dumps(RESULT, ensure_ascii=False).encode('utf-8'))
+    cache = main.ExtractionCache(60, 100, size * 2)
+    for key in 'abc':
+        cache.set(key, RESULT)
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] <= size * 2
+
+def test_cache_expires_entries(monkeypatch):
+    cache = main.ExtractionCache(10, 10, 1024 * 1024)
+    now = main.time.time()
+    monkeypatch.setattr(main.time, 'time', lambda: now)
+    cache.set('a', RESULT)
+    monkeypatch.setattr(main.time, 'time', lambda: now + 9)
+    assert cache.get('a') == RESULT
+    monkeypatch.setattr(main.time, 'time', lambda: now + 11)
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+
+def test_cache_sqlite_survives_restart(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    main.ExtractionCache(60, 10, 1024 * 1024, path).set('a', RESULT)
+    reopened = main.ExtractionCache(60, 10, 1024 * 1024, path)
+    assert reopened.get('a') == RESULT
+    assert reopened.stats()['backend'] == 'sqlite'
+
+def test_cache_sqlite_keeps_evicted_entries_until_expiry(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cache.db')
+    now = main.time.time()
+    monkeypatch.setattr(main.time, 'time', lambda: now)
+    cache = main.ExtractionCache(10, 1, 1024 * 1024, path)
+    cache.set('a', RESULT)
+    cache.set('b', RESULT)
+    # الذاكرة محدودة بعنصر واحد، والقرص يعيد العنصر المُخرج منها
+    assert cache.stats()['entries'] == 1
+    assert cache.get('a') == RESULT
+
+    # المدخلات المنتهية تُحذف من القرص عند إعادة الفتح
+    monkeypatch.setattr(main.time, 'time', lambda: now + 11)
+    reopened = main.ExtractionCache(10, 1, 1024 * 1024, path)
+    assert reopened.get('a') is None and reopened.get('b') is None
+    assert reopened._db.execute("SELECT COUNT(*) FROM extraction_cache").fetchone()[0] == 0
+
+# ============= البحث حسب المعرف الفريد وبصمة المحتوى =============
+@pytest.fixture
+def engine_calls(monkeypatch):
+    """ذاكرة جديدة ومحرك وهمي يسجل استدعاءاته"""
+    calls = []
+
+    def fake_extract(image_bytes, mime_type='image/jpeg'):
+        calls.append(image_bytes)
+        return dict(RESULT)
+
+    monkeypatch.setattr(main, 'EXTRACTION_CACHE', main.ExtractionCache(60, 100, 1024 * 1024))
+    monkeypatch.setattr(main, 'preprocess_image', lambda image_bytes: (image_bytes, 'image/jpeg'))
+    monkeypatch.setattr(main, 'extract_mrz_fast_path', lambda image_bytes, mime_type: None)
+    monkeypatch.setattr(main, 'extract_text_from_image', fake_extract)
+    return calls
+
+def test_same_content_is_extracted_once(engine_calls):
+    first = main.extract_text_cached(b'image-1', similar=False)
+    second = main.extract_text_cached(b'image-1', similar=False)
+    assert first == second == RESULT
+    assert engine_calls == [b'image-1']
+
+    main.extract_text_cached(b'image-2', similar=False)
+    assert engine_calls == [b'image-1', b'image-2']
+
+def test_result_is_stored_under_file_and_content_keys(engine_calls):
+    main.extract_text_cached(b'image-1', main.cache_key_for_file('u1'), similar=False)
+    assert main.EXTRACTION_CACHE.get(main.cache_key_for_file('u1')) == RESULT
+    assert main.EXTRACTION_CACHE.get(main.cache_key_for_content(b'image-1')) == RESULT
+
+    # الملف نفسه بمعرف آخر (صورة ثم ملف) يجد النتيجة ببصمة المحتوى
+    main.extract_text_cached(b'image-1', main.cache_key_for_file('u2'), similar=False)
+    assert engine_calls == [b'image-1']
+    assert main.EXTRACTION_CACHE.get(main.cache_key_for_file('u2')) == RESULT
+
+def test_empty_results_are_not_cached(engine_calls, monkeypatch):
+    def extract_nothing(image_bytes, mime_type='image/jpeg'):
+        engine_calls.append(image_bytes)
+        return {'name': '', 'arabic_texts': [], 'english_texts': []}
+
+    monkeypatch.setattr(main, 'extract_text_from_image', extract_nothing)
+    main.extract_text_cached(b'blank', main.cache_key_for_file('u1'), similar=False)
+    main.extract_text_cached(b'blank', similar=False)
+    assert engine_calls == [b'blank', b'blank']
+    assert main.EXTRACTION_CACHE.get(main.cache_key_for_file('u1')) is None
+
+def test_file_key_hit_skips_download(engine_calls, monkeypatch):
+    downloads = []
+    delivered = []
+    monkeypatch.setattr(main, 'extract_message_photo', lambda *args: downloads.append(args))
+    monkeypatch.setattr(main, 'deliver_extraction_output', lambda message, result, progress, timer: delivered.append(result))
+    main.EXTRACTION_CACHE.set(main.cache_key_for_file('u1'), RESULT)
+
+    photo = SimpleNamespace(file_id='f1', file_unique_id='u1')
+    message = SimpleNamespace(from_user=SimpleNamespace(id=1), chat=SimpleNamespace(id=1), photo=[photo], document=None)
+    main.process_photo_job(message)
+    assert delivered == [RESULT]
+    assert downloads == [] and engine_calls == []
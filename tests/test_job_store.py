@@ -0,0 +1,73 @@
+import pytest
+
+import main
+
+# ============= الطابور المشترك (SQLite) =============
+@pytest.fixture
+def job_store(tmp_path):
+    return main.SQLiteJobStore(str(tmp_path / 'jobs.db'))
+
+def push(store, user_id, payload='{}'):
+    return store.push('photo', payload, 100, user_id)
+
+def test_job_store_claims_round_robin_between_users(job_store):
+    for payload in ('a1', 'a2', 'a3'):
+        push(job_store, 'a', payload)
+    push(job_store, 'b', 'b1')
+    
+    first = job_store.claim('w1')
+    second = job_store.claim('w2')
+    assert {first['user_id'], second['user_id']} == {'a', 'b'}
+    assert job_store.user_inflight('a') == 3
+    assert job_store.stats()['running'] == 2
+
+def test_job_store_complete_is_owner_checked(job_store):
+    push(job_store, 'a')
+    job = job_store.claim('w1')
+    stale = dict(job, worker='w2')
+    assert not job_store.complete(stale)
+    assert job_store.complete(job)
+    assert not job_store.complete(job)
+    assert job_store.user_inflight('a') == 0
+    assert job_store.stats()['processed'] == 1
+
+def test_job_store_requeue_skips_live_workers(job_store):
+    push(job_store, 'a')
+    job = job_store.claim('w1')
+    assert job_store.acquire_lease(main.worker_lease_name('w1'), 'w1', 60)
+    assert job_store.requeue_stale(max_attempts=3) == 0
+    
+    # عقد العامل انتهى (توقفت عمليته): المهمة تعود للطابور ولا يستطيع العامل القديم إنهاءها
+    job_store.release_lease(main.worker_lease_name('w1'), 'w1')
+    assert job_store.requeue_stale(max_attempts=3) == 1
+    assert not job_store.complete(job)
+    reclaimed = job_store.claim('w2')
+    assert reclaimed['id'] == job['id']
+    assert job_store.complete(reclaimed)
+
+def test_job_store_drops_jobs_after_max_attempts(job_store):
+    push(job_store, 'a')
+    job_store.claim('w1')
+    assert job_store.requeue_stale(max_attempts=1) == 0
+    assert job_store.claim('w2') is None
+    assert job_store.user_inflight('a') == 0
+
+def test_job_store_rejects_when_full(job_store):
+    assert job_store.push('photo', '{}', 1, 'a') == 0
+    assert job_store.push('photo', '{}', 1, 'a') is None
+
+def test_job_store_counters_survive_reopen(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    store = main.SQLiteJobStore(path)
+    push(store, 'a')
+    push(store, 'a')
+    store.claim('w1')
+    reopened = main.SQLiteJobStore(path)
+    assert reopened.user_inflight('a') == 2
+    assert reopened.stats()['depth'] == 1
+
+def test_leases_are_exclusive(job_store):
+    assert job_store.acquire_lease('poller', 'p1', 60)
+    assert not job_store.acquire_lease('poller', 'p2', 60)
+    assert job_store.acquire_lease('poller', 'p1', 60)
+    assert job_store.count_leases('poll') == 1
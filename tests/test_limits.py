@@ -0,0 +1,105 @@
+import pytest
+
+import main
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, 'monotonic', clock)
+    return clock
+
+# ============= دلو الرموز =============
+def test_token_bucket_burst_then_wait(clock):
+    bucket = main.TokenBucket(2, 3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0.0
+
+def test_token_bucket_without_rate_is_unlimited():
+    bucket = main.TokenBucket(0, 0)
+    assert all(bucket.try_acquire() == 0.0 for _ in range(100))
+
+# ============= قاطع الدائرة =============
+def test_breaker_opens_after_threshold_and_half_opens(clock):
+    breaker = main.CircuitBreaker(2, 30)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == main.CircuitBreaker.OPEN
+    assert not breaker.allow()
+    
+    clock.now += 30
+    assert breaker.state == main.CircuitBreaker.HALF_OPEN
+    # طلب تجريبي واحد فقط
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == main.CircuitBreaker.CLOSED
+
+def test_breaker_half_open_failure_reopens(clock):
+    breaker = main.CircuitBreaker(1, 30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == main.CircuitBreaker.OPEN
+
+# ============= غلاف استدعاءات المحرك =============
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, 'ENGINE_MAX_RETRIES', 1)
+    monkeypatch.setattr(main, 'BREAKER_FAILURES', 2)
+    monkeypatch.setattr(main, 'retry_delay', lambda attempt: 0)
+    return main.EngineClient('test', 0)
+
+def failing(error):
+    calls = []
+    def func():
+        calls.append(1)
+        raise error
+    func.calls = calls
+    return func
+
+def test_engine_client_retries_transient_errors(client):
+    func = failing(main.ExtractionError('HTTP 503', retryable=True))
+    with pytest.raises(main.ExtractionError):
+        client.call(func)
+    assert len(func.calls) == 2
+
+def test_content_errors_do_not_open_breaker(client):
+    func = failing(ValueError('unparseable'))
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            client.call(func)
+    assert len(func.calls) == 5
+    assert client.breaker.state == main.CircuitBreaker.CLOSED
+
+def test_transport_errors_open_breaker(client):
+    func = failing(main.requests.exceptions.ConnectionError('refused'))
+    for _ in range(2):
+        with pytest.raises(main.requests.exceptions.ConnectionError):
+            client.call(func)
+    assert client.breaker.state == main.CircuitBreaker.OPEN
+    with pytest.raises(main.EngineUnavailableError):
+        client.call(lambda: None)
+
+def test_content_errors_do_not_clear_transport_failures(client):
+    transport = failing(main.requests.exceptions.ConnectionError('refused'))
+    with pytest.raises(main.requests.exceptions.ConnectionError):
+        client.call(transport)
+    with pytest.raises(ValueError):
+        client.call(failing(ValueError('unparseable')))
+    assert client.breaker.state == main.CircuitBreaker.CLOSED
+    
+    # الفشل السابق ما زال محسوباً: فشل نقل واحد آخر يفتح القاطع
+    with pytest.raises(main.requests.exceptions.ConnectionError):
+        client.call(transport)
+    assert client.breaker.state == main.CircuitBreaker.OPEN
@@ -0,0 +1,55 @@
+import pytest
+
+import main
+
+# النماذج من مواصفة ICAO 9303
+TD3 = [
+    'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<',
+    'L898902C36UTO7408122F1204159ZE184226B<<<<<10',
+]
+TD1 = [
+    'I<UTOD231458907<<<<<<<<<<<<<<<',
+    '7408122F1204159UTO<<<<<<<<<<<6',
+    'ERIKSSON<<ANNA<MARIA<<<<<<<<<<',
+]
+
+@pytest.mark.parametrize('data, digit', [
+    ('L898902C3', '6'),
+    ('740812', '2'),
+    ('120415', '9'),
+    ('D23145890', '7'),
+    ('<<<<<<<<<', '0'),
+])
+def test_mrz_check_digit(data, digit):
+    assert main.mrz_check_digit(data) == digit
+
+def test_parse_mrz_td3():
+    mrz = main.parse_mrz('\n'.join(['REPUBLIC OF UTOPIA', 'PASSPORT'] + TD3))
+    assert mrz['format'] == 'TD3'
+    assert mrz['document_number'] == 'L898902C3'
+    assert mrz['nationality'] == 'UTO'
+    assert (mrz['birth_date'], mrz['expiry_date'], mrz['sex']) == ('740812', '120415', 'F')
+    assert (mrz['surname'], mrz['given_names']) == ('ERIKSSON', 'ANNA MARIA')
+
+def test_parse_mrz_td1():
+    mrz = main.parse_mrz('\n'.join(TD1))
+    assert mrz['format'] == 'TD1'
+    assert mrz['document_number'] == 'D23145890'
+    assert (mrz['surname'], mrz['given_names']) == ('ERIKSSON', 'ANNA MARIA')
+
+def test_parse_mrz_fixes_ocr_confusions_in_digit_fields():
+    # O بدلاً من 0 و I بدلاً من 1 في حقول التاريخ ورقم التحقق
+    line2 = TD3[1].replace('7408122', '74O8I22')
+    mrz = main.parse_mrz('\n'.join([TD3[0], line2]))
+    assert mrz['birth_date'] == '740812'
+    assert mrz['lines'][1] == TD3[1]
+
+def test_parse_mrz_rejects_wrong_check_digit():
+    line2 = TD3[1][:9] + '7' + TD3[1][10:]
+    assert main.parse_mrz('\n'.join([TD3[0], line2])) is None
+
+def test_parse_mrz_tolerates_length_off_by_one():
+    assert main.parse_mrz('\n'.join([TD3[0][:-1], TD3[1]]))['document_number'] == 'L898902C3'
+
+def test_parse_mrz_without_mrz():
+    assert main.parse_mrz('الاسم: أحمد\nNAME AHMED') is None
@@ -0,0 +1,49 @@
+import random
+
+import main
+
+def test_bk_tree_search_matches_brute_force():
+    rng = random.Random(1)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    tree = main.BKTree()
+    for i, value in enumerate(hashes):
+        tree.add(value, i)
+    
+    query = hashes[42] ^ 0b1011  # 3 بتات مختلفة
+    found = tree.search(query, 6)
+    expected = sorted(
+        (main.hamming_distance(query, value), i) for i, value in enumerate(hashes)
+        if main.hamming_distance(query, value) <= 6
+    )
+    assert sorted(found) == expected
+    assert found[0] == (3, 42)
+    assert tree.size == 300
+
+def test_bk_tree_keeps_duplicates():
+    tree = main.BKTree()
+    tree.add(5, 'a')
+    tree.add(5, 'b')
+    assert tree.search(5, 0) == [(0, 'a'), (0, 'b')]
+
+def test_similar_index_find_verifies_fine_hash():
+    index = main.SimilarImageIndex(10, 10)
+    index.add('u', (0b1111, 0), 'key')
+    assert index.find('u', (0b1110, 1), 2, 4) == ['key']
+    # البصمة الدقيقة بعيدة: ليست الصورة نفسها
+    assert index.find('u', (0b1110, 0xFFFF), 2, 4) == []
+    assert index.find('other', (0b1111, 0), 2, 4) == []
+
+def test_similar_index_evicts_oldest_entries_per_user():
+    index = main.SimilarImageIndex(10, 4)
+    for i in range(20):
+        index.add('u', (i << 8, i), f'k{i}')
+    assert index.stats()['entries'] <= 4 + index.evict_batch
+    assert index.find('u', (19 << 8, 19), 0, 0) == ['k19']
+    assert index.find('u', (0, 0), 0, 0) == []
+
+def test_similar_index_evicts_least_recent_users():
+    index = main.SimilarImageIndex(2, 10)
+    for user in ('a', 'b', 'c'):
+        index.add(user, (1, 1), user)
+    assert index.stats()['users'] == 2
+    assert index.find('a', (1, 1), 0, 0) == []
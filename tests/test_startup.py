@@ -0,0 +1,31 @@
+import pytest
+
+import main
+
+@pytest.fixture
+def runtime(monkeypatch):
+    """استعادة المخازن العامة بعد كل اختبار"""
+    for name in ('USER_STORE', 'EXTRACTION_CACHE', 'JOB_STORE', 'EXTRACTION_QUEUE'):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    return monkeypatch
+
+def test_import_opens_no_store():
+    # عمليات Tesseract تعيد تنفيذ main.py دون main(): لا ملفات ولا طابور مشترك
+    assert isinstance(main.USER_STORE, main.MemoryUserStore)
+    assert main.EXTRACTION_CACHE.stats()['backend'] == 'memory'
+    assert main.JOB_STORE is None
+    assert isinstance(main.EXTRACTION_QUEUE, main.ExtractionQueue)
+
+def test_open_stores_uses_configured_backends(runtime, tmp_path):
+    runtime.setattr(main, 'USER_STORE_BACKEND', 'sqlite')
+    runtime.setattr(main, 'USER_DB_PATH', str(tmp_path / 'users.db'))
+    runtime.setattr(main, 'CACHE_BACKEND', 'sqlite')
+    runtime.setattr(main, 'CACHE_PATH', str(tmp_path / 'cache.db'))
+    runtime.setattr(main, 'BOT_ROLE', 'worker')
+    runtime.setattr(main, 'JOB_QUEUE_URL', f"sqlite:///{tmp_path / 'jobs.db'}")
+    main.open_stores()
+
+    assert isinstance(main.USER_STORE, main.SQLiteUserStore)
+    assert main.EXTRACTION_CACHE.stats()['backend'] == 'sqlite'
+    assert isinstance(main.EXTRACTION_QUEUE, main.SharedJobQueue)
+    assert main.EXTRACTION_QUEUE.store is main.JOB_STORE
@@ -0,0 +1,35 @@
+from text_processing import classify_lines, split_mixed_line, transliterate_name
+
+PAGE = """
+الجمهورية العربية
+الاسم: أحمد علي
+REPUBLIC OF EXAMPLE
+Name / الاسم
+1990/01/02
+
+"""
+
+def test_classify_lines_keeps_order_and_finds_name():
+    result = classify_lines(PAGE, split_mixed=False)
+    assert result['name'] == 'أحمد علي'
+    assert result['arabic_texts'] == ['الجمهورية العربية', 'الاسم: أحمد علي', 'Name / الاسم']
+    assert result['english_texts'] == ['REPUBLIC OF EXAMPLE', '1990/01/02']
+
+def test_classify_lines_splits_mixed_lines_in_place():
+    result = classify_lines(PAGE, split_mixed=True)
+    assert result['arabic_texts'] == ['الجمهورية العربية', 'الاسم: أحمد علي', 'الاسم']
+    # المقطع اللاتيني يأخذ موضع السطر المختلط بين الأسطر اللاتينية (مع الرموز التي تليه)
+    assert result['english_texts'] == ['REPUBLIC OF EXAMPLE', 'Name /', '1990/01/02']
+
+def test_classify_lines_empty_text():
+    assert classify_lines('') == {'name': '', 'arabic_texts': [], 'english_texts': []}
+
+def test_split_mixed_line():
+    assert split_mixed_line('رقم الهوية ID No 12345') == (['رقم الهوية'], ['ID No 12345'])
+
+def test_transliterate_name():
+    assert transliterate_name('أحمد علي') == 'ahmd.aly'
+    assert transliterate_name('  John   SMITH ') == 'john.smith'
+    # النقاط والرموز في الاسم نفسه لا تصل إلى البريد
+    assert transliterate_name('A.B-C') == 'abc'
+    assert transliterate_name('') == ''
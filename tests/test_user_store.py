@@ -0,0 +1,48 @@
+import pytest
+
+import main
+
+# ============= مخازن المستخدمين =============
+@pytest.fixture(params=['memory', 'sqlite'])
+def user_store(request, tmp_path):
+    if request.param == 'memory':
+        return main.MemoryUserStore()
+    return main.SQLiteUserStore(str(tmp_path / 'users.db'))
+
+def test_user_store_register_and_counters(user_store):
+    assert user_store.register_user('1', {'username': 'a'})
+    assert not user_store.register_user('1', {'username': 'a'})
+    user_store.record_extraction('1', {'name': 'x'})
+    # التسجيل الضمني عند أول عملية استخراج
+    user_store.record_extraction('2', {'name': 'y'})
+    
+    assert user_store.count_users() == 2
+    assert user_store.total_extractions() == 2
+    assert user_store.extractions_today() == 2
+    assert user_store.get_user('1')['extractions'] == 1
+    assert user_store.get_user('2')['data'] == {'name': 'y'}
+
+def test_user_store_delete(user_store):
+    user_store.register_user('1', {})
+    assert user_store.delete_user('1')
+    assert not user_store.delete_user('1')
+    assert user_store.get_user('1') is None
+    assert user_store.count_users() == 0
+
+def test_user_store_usage_and_pruning(user_store, monkeypatch):
+    monkeypatch.setattr(main, 'today_key', lambda: '2026-01-01')
+    user_store.record_usage('1', 100, 20)
+    user_store.record_usage('1', 10, 5)
+    assert user_store.tokens_today('1') == 135
+    assert user_store.tokens_today() == 135
+    
+    # يوم جديد: عدادات المستخدم للأيام السابقة تُحذف والعدادات الإجمالية تبقى
+    monkeypatch.setattr(main, 'today_key', lambda: '2026-01-02')
+    user_store.record_usage('2', 1, 1)
+    assert user_store.get_counter('tokens:1:2026-01-01') == 0
+    assert user_store.get_counter('tokens:2026-01-01') == 135
+    assert user_store.tokens_today('2') == 2
+
+def test_user_store_is_abstract():
+    with pytest.raises(TypeError):
+        main.UserStore()
@@ -0,0 +1,67 @@
+import io
+import json
+
+import main
+
+def call(path, method='GET', body=b'', headers=None):
+    environ = {
+        'PATH_INFO': path,
+        'REQUEST_METHOD': method,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    environ.update(headers or {})
+    response = {}
+    
+    def start_response(status, response_headers):
+        response['status'] = status
+        response['headers'] = dict(response_headers)
+    
+    payload = b''.join(main.webhook_app(environ, start_response))
+    return response['status'], payload
+
+UPDATE = json.dumps({
+    'update_id': 1,
+    'message': {
+        'message_id': 1, 'date': 0, 'text': '/start',
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'x'},
+    },
+}).encode()
+
+SECRET = {'HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN': main.WEBHOOK_SECRET}
+
+def drain_updates():
+    while not main.UPDATE_QUEUE.empty():
+        main.UPDATE_QUEUE.get_nowait()
+
+def test_update_is_queued():
+    drain_updates()
+    status, body = call(f'/{main.TELEGRAM_TOKEN}', 'POST', UPDATE, SECRET)
+    assert status == '200 OK'
+    assert json.loads(body) == {'ok': True}
+    assert main.UPDATE_QUEUE.get_nowait().update_id == 1
+
+def test_update_with_wrong_secret_is_rejected():
+    drain_updates()
+    status, _ = call(f'/{main.TELEGRAM_TOKEN}', 'POST', UPDATE, {'HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN': 'x'})
+    assert status == '403 Forbidden'
+    assert main.UPDATE_QUEUE.empty()
+
+def test_invalid_update_body():
+    status, _ = call(f'/{main.TELEGRAM_TOKEN}', 'POST', b'not json', SECRET)
+    assert status == '400 Bad Request'
+
+def test_health_and_metrics_routes():
+    status, body = call('/healthz')
+    assert status == '200 OK'
+    assert json.loads(body)['status'] == 'ok'
+    
+    status, body = call('/metrics')
+    assert status == '200 OK'
+    assert b'# TYPE bot_extractions_total counter' in body
+
+def test_unknown_route():
+    assert call('/nope')[0] == '404 Not Found'
+    # مسار التحديثات يقبل POST فقط
+    assert call(f'/{main.TELEGRAM_TOKEN}')[0] == '404 Not Found'
@@ -0,0 +1,107 @@
+"""
+معالجة النصوص المستخرجة بعد المحرك
+
+تصنيف الأسطر حسب الكتابة (عربية / لاتينية)، فصل الأسطر المختلطة إلى مقطعيها،
+اكتشاف حقل الاسم، وتحويل الأسماء العربية إلى حروف لاتينية.
+التعابير النمطية وجداول التحويل تُجهز مرة واحدة عند الاستيراد، والأسطر تُصنف
+عبر map بدلاً من حلقة بايثون مع re.search (التي تبحث في ذاكرة re الداخلية عند كل سطر).
+"""
+
+import re
+from functools import lru_cache
+
+ARABIC_RANGE = '\u0600-\u06FF'
+
+_ARABIC_CHAR = re.compile(f'[{ARABIC_RANGE}]')
+_LATIN_LETTER = re.compile('[A-Za-z]')
+# مقطع كتابة واحد: رموز محايدة اختيارية (أرقام، علامات) ثم حرف عربي أو لاتيني
+# يمتد حتى أول حرف من الكتابة الأخرى
+_SCRIPT_RUN = re.compile(
+    f'[^A-Za-z{ARABIC_RANGE}]*'
+    f'(?:[{ARABIC_RANGE}][^A-Za-z]*|[A-Za-z][^{ARABIC_RANGE}]*)'
+)
+_NAME_FIELD = re.compile(r'(اسم|الاسم|Name)[:\s]*', re.IGNORECASE)
+
+# تحويل الحروف العربية إلى لاتينية لإنشاء البريد الإلكتروني
+ARABIC_TO_LATIN = {
+    'أ': 'a', 'ا': 'a', 'إ': 'e', 'آ': 'a',
+    'ب': 'b', 'ت': 't', 'ث': 'th',
+    'ج': 'j', 'ح': 'h', 'خ': 'kh',
+    'د': 'd', 'ذ': 'dh', 'ر': 'r', 'ز': 'z',
+    'س': 's', 'ش': 'sh', 'ص': 's', 'ض': 'd',
+    'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'gh',
+    'ف': 'f', 'ق': 'q', 'ك': 'k', 'ل': 'l',
+    'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w',
+    'ي': 'y', 'ى': 'a', 'ئ': 'e',
+    'ة': 'h', ' ': '.'
+}
+_TRANSLITERATION_TABLE = str.maketrans({
+    **ARABIC_TO_LATIN,
+    **{upper: upper.lower() for upper in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'},
+    # النقاط في الناتج تأتي من المسافات فقط
+    '.': None
+})
+# كل ما لم يتحول إلى حرف لاتيني صغير أو نقطة يُحذف
+_NON_EMAIL_CHARS = re.compile(r'[^a-z.]+')
+_REPEATED_DOTS = re.compile(r'\.{2,}')
+
+def split_mixed_line(line):
+    """تقسيم سطر يجمع العربية واللاتينية إلى مقاطع: تعيد (المقاطع العربية، المقاطع اللاتينية)"""
+    arabic, latin = [], []
+    for run in _SCRIPT_RUN.findall(line):
+        run = run.strip()
+        if run:
+            (arabic if _ARABIC_CHAR.search(run) else latin).append(run)
+    return arabic, latin
+
+@lru_cache(maxsize=4096)
+def _split_mixed_cached(line):
+    # عناوين الحقول المختلطة ("الاسم / Name") تتكرر في كل صفحة من الدفعة
+    arabic, latin = split_mixed_line(line)
+    return ' '.join(arabic), ' '.join(latin)
+
+def find_name(lines):
+    """الاسم من أول سطر يحتوي حقل الاسم (اسم / الاسم / Name) بعد حذف عنوان الحقل"""
+    for line in lines:
+        if _NAME_FIELD.search(line):
+            return _NAME_FIELD.sub('', line).strip(' :/-|')
+    return ''
+
+def classify_lines(text, split_mixed=True):
+    """
+    فصل نص OCR الخام إلى أسطر عربية وأسطر لاتينية بترتيبها مع استخراج الاسم
+    السطر الذي يحوي حرفاً عربياً عربي؛ ومع split_mixed يُقسم السطر المختلط إلى مقطعيه
+    تعيد {'name', 'arabic_texts', 'english_texts'}
+    """
+    lines = [line for line in map(str.strip, text.split('\n')) if line]
+    flags = list(map(_ARABIC_CHAR.search, lines))
+    arabic_lines = [line for line, flag in zip(lines, flags) if flag]
+    english_texts = [line for line, flag in zip(lines, flags) if not flag]
+
+    # الاسم يُبحث عنه في الأسطر العربية كاملة قبل التقسيم ("الاسم: JOHN" يبقى سطراً واحداً)
+    name = find_name(arabic_lines)
+
+    if not split_mixed:
+        return {'name': name, 'arabic_texts': arabic_lines, 'english_texts': english_texts}
+
+    mixed = {
+        line: _split_mixed_cached(line)
+        for line, latin in zip(arabic_lines, map(_LATIN_LETTER.search, arabic_lines)) if latin
+    }
+    if not mixed:
+        return {'name': name, 'arabic_texts': arabic_lines, 'english_texts': english_texts}
+
+    # المقطع اللاتيني من السطر المختلط يأخذ موضع السطر بين الأسطر اللاتينية
+    return {
+        'name': name,
+        'arabic_texts': [mixed[line][0] if line in mixed else line for line in arabic_lines],
+        'english_texts': [
+            mixed[line][1] if line in mixed else line
+            for line, flag in zip(lines, flags) if not flag or line in mixed
+        ]
+    }
+
+def transliterate_name(name):
+    """تحويل الاسم إلى جزء محلي صالح للبريد: حروف لاتينية صغيرة والمسافات نقاط"""
+    latin_name = _NON_EMAIL_CHARS.sub('', str(name).translate(_TRANSLITERATION_TABLE))
+    return _REPEATED_DOTS.sub('.', latin_name).strip('.')